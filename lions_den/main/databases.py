@@ -0,0 +1,105 @@
+"""
+	Zoo databases are SQLite files named <zoo_id>.sqlite3 in a single directory. Rather than listing them all at startup,
+	they are registered in DATABASES on first use of their alias, so zoos can be added without restarting any workers.
+	SQLite connections whose settings have PRAGMAS get them applied as soon as they are opened.
+"""
+import re
+
+from pathlib import Path
+
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+
+ZOO_ID_REGEX = re.compile(r'^\w+$')
+ZOO_DATABASE_SUFFIX = '.sqlite3'
+
+# WAL lets readers and a writer work concurrently, and synchronous=NORMAL is safe with WAL (only durability of the last
+# transactions on power loss is at stake). A negative cache_size is in KiB rather than pages
+DEFAULT_PRAGMAS = {
+	'journal_mode': 'WAL',
+	'synchronous': 'NORMAL',
+	'mmap_size': 256 * 1024 * 1024,
+	'cache_size': -16 * 1024,
+}
+DEFAULT_BUSY_TIMEOUT = 20 # seconds to wait for a lock before raising "database is locked"
+
+
+class ZooDatabases(dict):
+	""" DATABASES setting which discovers zoo databases lazily, when their alias is first looked up """
+	def __init__(self, databases, zoos_dir, idle_timeout=300, pragmas=DEFAULT_PRAGMAS, busy_timeout=DEFAULT_BUSY_TIMEOUT, zoo_overrides=None):
+		"""
+			:param pragmas: PRAGMAs applied to every zoo database connection
+			:param zoo_overrides: per zoo id, settings to update the zoo database's settings with, e.g. {'PRAGMAS': {'cache_size': -65536}}
+		"""
+		super().__init__(databases)
+		self.zoos_dir = Path(zoos_dir)
+		self.idle_timeout = idle_timeout
+		self.pragmas = pragmas
+		self.busy_timeout = busy_timeout
+		self.zoo_overrides = zoo_overrides or {}
+	
+	def __missing__(self, alias):
+		settings_dict = self.discover(alias)
+		if settings_dict is None:
+			raise KeyError(alias)
+		return self.setdefault(alias, settings_dict)
+	
+	def __contains__(self, alias):
+		return super().__contains__(alias) or self.discover(alias) is not None
+	
+	def get(self, alias, default=None):
+		try:
+			return self[alias]
+		except KeyError:
+			return default
+	
+	def discover(self, alias):
+		""" Returns the settings for the zoo database of the given alias, or None if there is no such database """
+		if not isinstance(alias, str) or not ZOO_ID_REGEX.match(alias):
+			return None
+		db_file = self.zoos_dir / f'{alias}{ZOO_DATABASE_SUFFIX}'
+		if not db_file.is_file():
+			return None
+		settings_dict = {
+			'ENGINE': 'main.zoo_sqlite3',
+			'NAME': db_file,
+			'CONN_MAX_AGE': None, # kept open across requests, until idle for longer than IDLE_TIMEOUT
+			'IDLE_TIMEOUT': self.idle_timeout,
+			'OPTIONS': {'timeout': self.busy_timeout},
+			'PRAGMAS': dict(self.pragmas),
+		}
+		overrides = self.zoo_overrides.get(alias, {})
+		settings_dict.update({key: value for key, value in overrides.items() if key not in ('OPTIONS', 'PRAGMAS')})
+		settings_dict['OPTIONS'].update(overrides.get('OPTIONS', {}))
+		settings_dict['PRAGMAS'].update(overrides.get('PRAGMAS', {}))
+		return settings_dict
+	
+	def discover_all(self):
+		""" Registers every zoo database in zoos_dir, for commands which need to go through all of them, returning their aliases """
+		zoo_ids = [db_file.name[:-len(ZOO_DATABASE_SUFFIX)] for db_file in sorted(self.zoos_dir.glob(f'*{ZOO_DATABASE_SUFFIX}'))]
+		return [zoo_id for zoo_id in zoo_ids if self.get(zoo_id) is not None]
+
+
+def close_idle_zoo_connections(**kwargs):
+	""" Closes this thread's zoo database connections which have not been used for longer than their IDLE_TIMEOUT """
+	from django.db import connections
+	for connection in connections.all():
+		idle_timeout = connection.settings_dict.get('IDLE_TIMEOUT')
+		if idle_timeout is not None and connection.is_idle(idle_timeout):
+			connection.close()
+
+
+def apply_pragmas(sqlite_connection, pragmas):
+	""" Applies PRAGMAs to a raw sqlite3 connection """
+	for name, value in pragmas.items():
+		sqlite_connection.execute(f'PRAGMA {name} = {value}').fetchall()
+
+
+def apply_connection_pragmas(sender, connection, **kwargs):
+	pragmas = connection.settings_dict.get('PRAGMAS')
+	if pragmas and connection.vendor == 'sqlite':
+		apply_pragmas(connection.connection, pragmas)
+
+
+request_finished.connect(close_idle_zoo_connections)
+connection_created.connect(apply_connection_pragmas)
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 
+from .databases import ZooDatabases, DEFAULT_PRAGMAS, DEFAULT_BUSY_TIMEOUT
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,6 +50,7 @@ MIDDLEWARE = [
 	'django.middleware.common.CommonMiddleware',
 	'django.middleware.csrf.CsrfViewMiddleware',
 	'django.contrib.auth.middleware.AuthenticationMiddleware',
+	'zoo_auth.middleware.ZooCacheMiddleware',
 	'django.contrib.messages.middleware.MessageMiddleware',
 	'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -75,19 +78,25 @@ WSGI_APPLICATION = 'main.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
-	'default': {
-		'ENGINE': 'django.db.backends.sqlite3',
-		'NAME': BASE_DIR / 'default.sqlite3',
-	}
-}
-# Add custom databases
-for db_file in (BASE_DIR / 'zoo_editor' / 'databases').iterdir():
-    zoo_id = db_file.name.split('.')[0]
-    DATABASES[zoo_id] = {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': db_file,
-    }
+DATABASES = ZooDatabases(
+	databases={
+		'default': {
+			'ENGINE': 'django.db.backends.sqlite3',
+			'NAME': BASE_DIR / 'default.sqlite3',
+			'OPTIONS': {'timeout': DEFAULT_BUSY_TIMEOUT},
+			'PRAGMAS': DEFAULT_PRAGMAS,
+		}
+	},
+	# Zoo databases are registered on first use, see main.databases
+	zoos_dir=BASE_DIR / 'zoo_editor' / 'databases',
+	idle_timeout=300,
+	pragmas=DEFAULT_PRAGMAS,
+	busy_timeout=DEFAULT_BUSY_TIMEOUT,
+	zoo_overrides={}, # e.g. {'<zoo_id>': {'PRAGMAS': {'cache_size': -64 * 1024}}}
+)
+
+# Registers the in-memory zoo database the tests use
+TEST_RUNNER = 'main.test_runner.ZooTestRunner'
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -132,6 +141,17 @@ STATICFILES_DIRS = [
 MEDIA_ROOT = BASE_DIR / 'media/'
 MEDIA_URL = 'media/'
 
+# Cache for normalised image renditions (see zoo_editor.utils.rendition_cache)
+RENDITION_CACHE = {
+	'PATH': BASE_DIR / 'renditions.sqlite3',
+	'MAX_MEMORY_ITEMS': 512,
+	'MAX_DISK_BYTES': 256 * 1024 * 1024,
+}
+
+# If True, the renditions of images uploaded through subject forms are generated by the process_image_jobs command, which must
+# then be kept running alongside the site, rather than in the upload request (uploads are stripped of their metadata either way)
+IMAGE_RENDITIONS_IN_WORKER = False
+
 # Crispy
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
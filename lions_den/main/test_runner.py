@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+TEST_ZOO_ID = 'testzoo'
+
+
+class ZooTestRunner(DiscoverRunner):
+	""" Test runner which registers an in-memory zoo database for the tests, as zoo databases are otherwise only found on disk """
+	def setup_databases(self, **kwargs):
+		settings.DATABASES[TEST_ZOO_ID] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+		return super().setup_databases(**kwargs)
+	
+	def teardown_databases(self, old_config, **kwargs):
+		super().teardown_databases(old_config, **kwargs)
+		settings.DATABASES.pop(TEST_ZOO_ID, None)
@@ -0,0 +1,15 @@
+import time
+
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+	""" SQLite backend for zoo databases, which keeps track of when the connection was last used so idle connections can be closed """
+	last_used = None
+	
+	def create_cursor(self, name=None):
+		self.last_used = time.monotonic()
+		return super().create_cursor(name)
+	
+	def is_idle(self, idle_timeout):
+		return self.connection is not None and (self.last_used is None or time.monotonic() - self.last_used > idle_timeout)
@@ -128,6 +128,7 @@ class AbstractDynamicBlobInput {
 		this.input = $('#' + inputId);
 		this.displayWidget = $('#' + inputId + '-display');
 		this.initialDisplayValue = this.displayWidget.prop('src');
+		this.initialDisplaySrcset = this.displayWidget.attr('srcset');
 
 		// Add events
 		if (this.input.length){
@@ -135,9 +136,7 @@ class AbstractDynamicBlobInput {
 			this.input.on('change', function() {
 				var file = _this.input.prop('files')[0];
 				if (file){
-					var reader = new FileReader();
-					reader.onload = _this.updateDisplayFromInput();
-					reader.readAsDataURL(file);
+					_this.updateDisplayFromFile(file);
 				} else {
 					_this.setDisplayWidget(null);
 				}
@@ -145,18 +144,26 @@ class AbstractDynamicBlobInput {
 		}
 	}
 
+	updateDisplayFromFile(file) {
+		var reader = new FileReader();
+		reader.onload = this.updateDisplayFromInput();
+		reader.readAsDataURL(file);
+	}
+
 	updateDisplayFromInput() {
-		// Must be defined per subclass
+		// Must be defined per subclass, unless it overrides updateDisplayFromFile
 	}
 
 	setDisplayWidget(newBlob, alertUser){
 		if (!newBlob){
 			this.displayWidget.prop('src', this.initialDisplayValue);
+			this.displayWidget.attr('srcset', this.initialDisplaySrcset || null);
 			this.input.val(''); // clear input contents
 			if (alertUser) {
 				alert('The provided file format is not supported');
 			}
 		} else {
+			this.displayWidget.removeAttr('srcset'); // which would otherwise take precedence over the new src
 			this.displayWidget.prop('src', newBlob);
 		}
 	}
@@ -165,14 +172,17 @@ class AbstractDynamicBlobInput {
 class DynamicImageInput extends AbstractDynamicBlobInput {
 	constructor(){ super('image'); }
 
-	updateDisplayFromInput() {
+	updateDisplayFromFile(file) {
+		// The server returns a small preview of the image as it will be displayed, so the file is not read here
 		var _this = this;
-		var file = this.input.prop('files')[0];
 		let formdata = new FormData();
 		if (formdata) {
 			formdata.append("image", file);
 			formdata.append("update_image_display", null);
-			$.ajax({
+			if (this.previewRequest){
+				this.previewRequest.abort(); // so the preview of a previously selected file cannot replace this one's
+			}
+			this.previewRequest = $.ajax({
 				url: document.URL,
 				type: "POST",
 				data: formdata,
@@ -302,6 +312,8 @@ document.addEventListener("DOMContentLoaded", function(){
 				data: 'species_filter&species_id=' + $(this).val(),
 				success: function (response) {
 					$('#subject-table').replaceWith(response);
+					initSubjectTableScrolling();
+					pollImageStatuses();
 				}
 			});
 		});
@@ -309,6 +321,77 @@ document.addEventListener("DOMContentLoaded", function(){
 });
 //----------------------------------------------------------------------------------------------------------------------
 
+// Subject Lists - Infinite Scrolling-----------------------------------------------------------------------------------
+function loadMoreSubjects(){
+	let loadMoreDiv = $('#subject-table .subject-table-more');
+	let nextPageQuery = loadMoreDiv.attr('data-next-page-query');
+	if (!nextPageQuery || loadMoreDiv.data('loading')){
+		return;
+	}
+	loadMoreDiv.data('loading', true);
+	$.ajax({
+		type: 'GET',
+		url: document.URL,
+		data: 'subjects_page&' + nextPageQuery,
+		success: function (response) {
+			$('#subject-table table').append(response['rows']);
+			loadMoreDiv.attr('data-next-page-query', response['next_page_query'] || '');
+			loadMoreDiv.prop('hidden', !response['next_page_query']);
+			initSubjectTableScrolling(); // in case the next page is already in view
+			pollImageStatuses();
+		},
+		complete: function () {
+			loadMoreDiv.data('loading', false);
+		}
+	});
+}
+
+function initSubjectTableScrolling(){
+	// Loads the next page of subjects when the "Load more" button gets close to being in view
+	if (window.subjectTableObserver){
+		window.subjectTableObserver.disconnect();
+	}
+	let loadMoreDiv = document.querySelector('#subject-table .subject-table-more');
+	if (loadMoreDiv && !loadMoreDiv.hidden && 'IntersectionObserver' in window){
+		window.subjectTableObserver = new IntersectionObserver(function(entries){
+			if (entries[0].isIntersecting){
+				loadMoreSubjects();
+			}
+		}, {rootMargin: '500px'});
+		window.subjectTableObserver.observe(loadMoreDiv);
+	}
+}
+
+document.addEventListener("DOMContentLoaded", initSubjectTableScrolling);
+//----------------------------------------------------------------------------------------------------------------------
+
+// Images Being Processed - Poll Until Done-----------------------------------------------------------------------------
+function pollImageStatuses(){
+	// Replaces the placeholders of images still being processed once they are done
+	$('img[data-status-url]').each(function(){
+		let img = $(this);
+		if (img.data('polling')){
+			return;
+		}
+		img.data('polling', true);
+		let poll = function(){
+			$.getJSON(img.attr('data-status-url'), function(response){
+				if (response['status'] === 'pending' || response['status'] === 'running'){
+					setTimeout(poll, 2000);
+				} else if (response['status'] === 'done'){
+					img.attr('srcset', response['srcset'] || null);
+					img.attr('src', response[img.attr('data-status-src')]);
+					img.removeAttr('data-status-url');
+				}
+			});
+		};
+		setTimeout(poll, 1000);
+	});
+}
+
+document.addEventListener("DOMContentLoaded", pollImageStatuses);
+//----------------------------------------------------------------------------------------------------------------------
+
 // Group Page - Show and Edit Members-----------------------------------------------------------------------------------
 function addMemberToGroup(membersType){
 	memberId = document.getElementById('group_select_' + membersType).value;
@@ -0,0 +1,68 @@
+import itertools
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template.defaultfilters import pluralize
+from django.template.loader import render_to_string
+
+# noinspection PyUnresolvedReferences
+from zoo_auth.models import ZooUser
+
+from ticket_system.models import TicketActionDigestEntry
+
+DIGEST_METHODS = {
+	'hourly': ZooUser.NotificationMethod.HOURLY_DIGEST,
+	'daily': ZooUser.NotificationMethod.DAILY_DIGEST,
+}
+
+
+def get_digest_users(period):
+	""" Users whose digest is due in this period; daily runs also flush what is left for users who have since left digest mode """
+	if period == 'hourly':
+		return ZooUser.objects.filter(notification_method=DIGEST_METHODS['hourly'])
+	return ZooUser.objects.exclude(notification_method=DIGEST_METHODS['hourly'])
+
+
+def send_digests(period):
+	"""
+		Queues a single email per user in the outbox, with all the actions pending for them grouped by ticket,
+		removing their digest entries in the same transaction
+		:return: number of digests queued, and number of actions they cover (i.e. the emails they replace)
+	"""
+	entries = (
+		TicketActionDigestEntry.objects.filter(user__in=get_digest_users(period))
+		.select_related('user', 'action__ticket', 'action__user')
+		.prefetch_related('action__target', 'action__changes')
+		.order_by('user_id', 'action__ticket_id', 'action__timestamp', 'action_id')
+	)
+	num_digests = num_actions = 0
+	for user, user_entries in itertools.groupby(entries, key=lambda entry: entry.user):
+		user_entries = list(user_entries)
+		tickets = [
+			(ticket, [entry.action for entry in ticket_entries])
+			for ticket, ticket_entries in itertools.groupby(user_entries, key=lambda entry: entry.action.ticket)
+		]
+		with transaction.atomic():
+			# users who have since switched to emails still get what was collected for them, unlike those who turned emails off
+			if user.wants_digest_notifications() or user.wants_email_notifications():
+				user.notify(
+					subject=f'{len(user_entries)} update{pluralize(len(user_entries))} to {len(tickets)} ticket{pluralize(len(tickets))}',
+					html_message=render_to_string(template_name='ticket_system/emails/digest.html', context={'tickets': tickets}),
+					ignore_preferences=True,
+					queue=True
+				)
+				num_digests += 1
+				num_actions += len(user_entries)
+			TicketActionDigestEntry.objects.filter(id__in=[entry.id for entry in user_entries]).delete()
+	return num_digests, num_actions
+
+
+class Command(BaseCommand):
+	help = 'Queues the digest emails of the users who chose hourly or daily digests of their ticket notifications (run it on that schedule)'
+
+	def add_arguments(self, parser):
+		parser.add_argument('period', choices=DIGEST_METHODS.keys(), help='Which digests to send')
+
+	def handle(self, *args, **options):
+		num_digests, num_actions = send_digests(options['period'])
+		self.stdout.write(f'{num_digests} digests queued, replacing {num_actions} notification emails')
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.4 on 2026-10-18 13:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ticket_system', '0014_auto_20210515_2319'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketActionDigestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digest_entries', to='ticket_system.ticketaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_digest_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
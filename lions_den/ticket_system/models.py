@@ -1,5 +1,7 @@
+import collections
+
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.template.loader import render_to_string
@@ -8,35 +10,78 @@ from django.utils.translation import gettext_lazy as _
 
 
 class TrackedFieldsModel(models.Model):
+	"""
+		Records the changes to its tracked_fields as a TicketAction with its TicketChanges and notifications, in the same transaction as the save
+		The tracked fields are snapshotted when loaded (and on save), so changes are found without fetching the instance again
+	"""
 	class Meta:
 		abstract = True
 	
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super().from_db(db, field_names, values)
+		instance._snapshot_tracked_fields()
+		return instance
+	
+	def refresh_from_db(self, using=None, fields=None):
+		super().refresh_from_db(using=using, fields=fields)
+		self._snapshot_tracked_fields()
+	
+	def _snapshot_tracked_fields(self):
+		""" Values of the tracked fields as stored, by attname (i.e. ids for foreign keys), leaving out deferred ones """
+		self._tracked_snapshot = {field.attname: self.__dict__[field.attname] for field in self.tracked_fields if field.attname in self.__dict__}
+	
+	def _get_stored_values(self):
+		""" Snapshot of the tracked fields, fetching those missing from it (e.g. deferred when loaded, or if the instance was not loaded) """
+		stored_values = dict(getattr(self, '_tracked_snapshot', {}))
+		missing_attnames = [field.attname for field in self.tracked_fields if field.attname not in stored_values]
+		if missing_attnames:
+			stored_values.update(type(self)._base_manager.using(self._state.db).filter(pk=self.pk).values(*missing_attnames).get())
+		return stored_values
+	
+	@staticmethod
+	def _get_display_values(stored_values):
+		"""
+			Values as recorded in TicketChanges, i.e. the related objects themselves for foreign keys (as TicketChanges store their str)
+			:param stored_values: (field, stored value) pairs; the related objects are fetched with one query per related model
+		"""
+		related_ids = collections.defaultdict(set)
+		for field, stored_value in stored_values:
+			if field.is_relation and stored_value is not None:
+				related_ids[field.related_model].add(stored_value)
+		related_objects = {model: model._base_manager.in_bulk(ids) for model, ids in related_ids.items()}
+		return [
+			related_objects[field.related_model][stored_value] if field.is_relation and stored_value is not None else stored_value
+			for field, stored_value in stored_values
+		]
+	
 	def save(self, *args, **kwargs):
 		action_ticket = self if type(self) == Ticket else self.ticket
-		ticket_changes = []
-		if self.pk: # pre-existing model instance
-			old_instance = type(self).objects.get(pk=self.pk)
-			
-			super().save(*args, **kwargs)
+		changed_values = [] # (field, old value, new value) of each changed tracked field
+		with transaction.atomic():
+			if self.pk: # pre-existing model instance
+				stored_values = self._get_stored_values()
+				super().save(*args, **kwargs)
+				action_type = TicketAction.Type.EDIT
+				changed_fields = [field for field in self.tracked_fields if stored_values[field.attname] != getattr(self, field.attname)]
+				old_values = self._get_display_values([(field, stored_values[field.attname]) for field in changed_fields])
+				changed_values = [(field, old_value, getattr(self, field.name)) for field, old_value in zip(changed_fields, old_values)]
+			else: # new model instance
+				super().save(*args, **kwargs)
+				action_type = TicketAction.Type.CREATE
+				for tracked_field in self.tracked_fields:
+					new_value = getattr(self, tracked_field.name)
+					if new_value:
+						changed_values.append((tracked_field, None, new_value))
+			self._snapshot_tracked_fields()
 			
-			ticket_action = TicketAction(ticket=action_ticket, target=self, user=action_ticket.last_updater, type=TicketAction.Type.EDIT)
-			for tracked_field in self.tracked_fields:
-				old_value, new_value = getattr(old_instance, tracked_field.name), getattr(self, tracked_field.name)
-				if old_value != new_value:
-					ticket_changes.append(TicketChange(action=ticket_action, field=tracked_field.name, old_value=old_value, new_value=new_value))
-		else: # new model instance
-			super().save(*args, **kwargs)
-			ticket_action = TicketAction(ticket=action_ticket, target=self, user=action_ticket.last_updater, type=TicketAction.Type.CREATE)
-			for tracked_field in self.tracked_fields:
-				new_value = getattr(self, tracked_field.name)
-				if new_value:
-					ticket_changes.append(TicketChange(action=ticket_action, field=tracked_field.name, new_value=new_value))
-		
-		if ticket_changes:
-			ticket_action.save()
-			for ticket_change in ticket_changes:
-				ticket_change.save()
-			ticket_action.trigger_notifications()
+			if changed_values:
+				ticket_action = TicketAction.objects.create(ticket=action_ticket, target=self, user_id=action_ticket.last_updater_id, type=action_type)
+				TicketChange.objects.bulk_create(
+					TicketChange(action=ticket_action, field=tracked_field.name, old_value=old_value, new_value=new_value)
+					for tracked_field, old_value, new_value in changed_values
+				)
+				ticket_action.trigger_notifications()
 
 
 class Ticket(TrackedFieldsModel):
@@ -183,23 +228,31 @@ class TicketAction(models.Model):
 		return f'<b>{self.user}</b> {self._get_predicate_str(as_html=True)}'
 	
 	def trigger_notifications(self):
+		"""
+			Notifies the watchers of the ticket, queueing their emails in the outbox so they are sent outside of the request
+			The watchers are fetched once along with their preferences, so the number of queries does not grow with them
+		"""
+		users_to_notify = list(self.ticket.watchers.exclude(id=self.user_id)) # users shouldn't be notified of their own actions
+		
 		# In-app notifications
-		for user in self.ticket.watchers.all():
-			if user != self.user and user.wants_app_notifications(): # users shouldn't be notified of their own actions
-				TicketActionNotification(
-					user=user,
-					action=self
-				).save()
+		TicketActionNotification.objects.bulk_create(
+			TicketActionNotification(user=user, action=self) for user in users_to_notify if user.wants_app_notifications()
+		)
+		
+		# Digest notifications, sent later by the send_digests command
+		TicketActionDigestEntry.objects.bulk_create(
+			TicketActionDigestEntry(user=user, action=self) for user in users_to_notify if user.wants_digest_notifications()
+		)
 
 		# Email notifications
-		users_to_notify = self.ticket.watchers.exclude(id=self.user.id).all() # users shouldn't be notified of their own actions
 		get_user_model().notify_users(
 			users=users_to_notify,
 			subject=str(self),
 			html_message=render_to_string(
 				template_name='ticket_system/emails/notification.html',
 				context={'action': self}
-			)
+			),
+			queue=True
 		)
 
 
@@ -241,4 +294,10 @@ class TicketActionNotification(models.Model):
 		return self.action.timestamp
 	
 	def url(self):
-		return reverse_lazy('ticket_page', kwargs={'pk': self.action.ticket.id})
\ No newline at end of file
+		return reverse_lazy('ticket_page', kwargs={'pk': self.action.ticket.id})
+
+
+class TicketActionDigestEntry(models.Model):
+	""" Action to include in the next digest email of a user who chose to receive digests (see the send_digests command) """
+	user = models.ForeignKey(get_user_model(), related_name='ticket_digest_entries', on_delete=models.CASCADE)
+	action = models.ForeignKey(TicketAction, related_name='digest_entries', on_delete=models.CASCADE)
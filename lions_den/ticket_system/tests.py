@@ -1,3 +1,134 @@
+from unittest import mock
+
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+# noinspection PyUnresolvedReferences
+from zoo_auth.models import ZooUser, OutboxEmail
+
+from .models import Ticket, Comment, TicketAction, TicketChange, TicketActionDigestEntry
+from .management.commands.send_digests import send_digests
+
+
+class TicketTestCase(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.reporter = ZooUser.objects.create_user(email='keeper@zooverse.org', password='password')
+		cls.assignee = ZooUser.objects.create_user(email='developer@zooverse.org', password='password', is_staff=True)
+
+	def create_ticket(self):
+		ticket = Ticket(
+			title='Lion roars twice', description='The roar plays twice', app=Ticket.App.ZOOVERSE, type=Ticket.Type.BUG,
+			priority=Ticket.Priority.LOW, reporter=self.reporter, last_updater=self.reporter
+		)
+		ticket.save()
+		return ticket
+
+
+class TrackedFieldsTests(TicketTestCase):
+	def test_changes_recorded_without_refetch(self):
+		ticket = Ticket.objects.get(pk=self.create_ticket().pk)
+		ticket.title, ticket.priority, ticket.status = 'Lion roars three times', Ticket.Priority.HIGH, Ticket.Status.IN_ANALYSIS
+		with mock.patch.object(TicketAction, 'trigger_notifications'), self.assertNumQueries(5): # savepoint, update, action, changes, release
+			ticket.save()
+
+		action = TicketAction.objects.filter(type=TicketAction.Type.EDIT).get()
+		self.assertEqual(
+			set(action.changes.values_list('field', 'old_value', 'new_value')),
+			{('title', 'Lion roars twice', 'Lion roars three times'), ('priority', '1', '3'), ('status', 'U', 'A')}
+		)
+
+	def test_foreign_key_change_recorded(self):
+		ticket = Ticket.objects.get(pk=self.create_ticket().pk)
+		ticket.assignee = self.assignee
+		with mock.patch.object(TicketAction, 'trigger_notifications'):
+			ticket.save()
+			ticket.save() # nothing changed since the previous save
+
+		change = TicketChange.objects.get(action__type=TicketAction.Type.EDIT)
+		self.assertEqual((change.field, change.old_value, change.new_value), ('assignee', None, str(self.assignee)))
+
+	def test_foreign_key_changes_fetch_old_values_together(self):
+		ticket = self.create_ticket()
+		ticket.assignee = self.assignee
+		ticket.save()
+		tracked_fields = Ticket.tracked_fields + [Ticket._meta.get_field('reporter')]
+		with mock.patch.object(Ticket, 'tracked_fields', tracked_fields), mock.patch.object(TicketAction, 'trigger_notifications'):
+			ticket = Ticket.objects.get(pk=ticket.pk)
+			ticket.assignee, ticket.reporter = self.reporter, self.assignee
+			with self.assertNumQueries(6): # savepoint, update, old assignee and reporter, action, changes, release
+				ticket.save()
+
+		action = TicketAction.objects.filter(type=TicketAction.Type.EDIT).latest('id')
+		self.assertEqual(
+			set(action.changes.values_list('field', 'old_value', 'new_value')),
+			{('assignee', str(self.assignee), str(self.reporter)), ('reporter', str(self.reporter), str(self.assignee))}
+		)
+
+	def test_deferred_fields_compared_with_stored_values(self):
+		ticket = self.create_ticket()
+		with mock.patch.object(TicketAction, 'trigger_notifications'):
+			Comment(ticket=ticket, creator=self.reporter, text='Seen on Safari').save()
+			comment = Comment.objects.defer('text').get()
+			comment.text = 'Seen on Safari and Firefox'
+			comment.save()
+
+		change = TicketChange.objects.get(action__type=TicketAction.Type.EDIT)
+		self.assertEqual((change.old_value, change.new_value), ('Seen on Safari', 'Seen on Safari and Firefox'))
+
+
+class TicketNotificationTests(TicketTestCase):
+	def test_comment_emails_queued_in_outbox(self):
+		ticket = self.create_ticket()
+		self.reporter.notification_method = ZooUser.NotificationMethod.APP_AND_EMAIL
+		self.reporter.save()
+		ticket.watchers.add(self.reporter)
+		ticket.last_updater = self.assignee
+		Comment(ticket=ticket, creator=self.assignee, text='Fixed in the next release').save()
+
+		self.assertEqual(len(mail.outbox), 0)
+		self.assertEqual(list(OutboxEmail.objects.values_list('to', flat=True)), [[self.reporter.email]])
+		self.assertEqual(self.reporter.ticket_notifications.count(), 1)
+
+	def count_notification_queries(self, num_watchers):
+		ticket = self.create_ticket()
+		watchers = [
+			ZooUser.objects.create(email=f'watcher{num_watchers}-{i}@zooverse.org', notification_method=ZooUser.NotificationMethod.APP_AND_EMAIL)
+			for i in range(num_watchers)
+		]
+		ticket.watchers.add(*watchers)
+		action = TicketAction.objects.create(ticket=ticket, target=ticket, user=self.reporter, type=TicketAction.Type.EDIT)
+		action = TicketAction.objects.get(id=action.id)
+		ZooUser.get_notified_admins() # cached, as it would be on later actions
+		with CaptureQueriesContext(connection) as queries:
+			action.trigger_notifications()
+		self.assertEqual(action.user_notifications.count(), num_watchers)
+		self.assertEqual(OutboxEmail.objects.filter(subject=str(action)).count(), num_watchers)
+		return len(queries)
+
+	def test_notification_queries_independent_of_watchers(self):
+		cache.clear()
+		self.assertEqual(self.count_notification_queries(2), self.count_notification_queries(20))
+
+
+class DigestTests(TicketTestCase):
+	def test_actions_collected_into_one_digest(self):
+		self.assignee.notification_method = ZooUser.NotificationMethod.HOURLY_DIGEST
+		self.assignee.save()
+		ticket = self.create_ticket()
+		ticket.watchers.add(self.assignee)
+		for text in ('Seen on Safari', 'Seen on Firefox', 'Seen on Edge'):
+			Comment(ticket=ticket, creator=self.reporter, text=text).save()
+		self.assertFalse(OutboxEmail.objects.exists())
+		self.assertEqual(self.assignee.ticket_digest_entries.count(), 3)
 
-# Create your tests here.
+		self.assertEqual(send_digests('daily'), (0, 0))
+		self.assertEqual(send_digests('hourly'), (1, 3))
+		email = OutboxEmail.objects.get()
+		self.assertEqual((email.to, email.subject), ([self.assignee.email], '3 updates to 1 ticket'))
+		self.assertIn(str(ticket), email.html_body)
+		self.assertIn('Seen on Edge', email.html_body)
+		self.assertFalse(TicketActionDigestEntry.objects.exists())
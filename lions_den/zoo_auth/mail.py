@@ -0,0 +1,25 @@
+"""
+	Delivery of notification emails, in batches of messages sharing one connection to the mail server
+	(rather than a new SSL connection per message, which takes most of the time of sending it)
+"""
+import functools
+import html2text
+
+from django.core.mail import get_connection
+
+BATCH_SIZE = 100 # messages sent over each connection, as mail servers drop connections kept open for too long
+
+
+@functools.lru_cache(maxsize=64)
+def html_to_text(html):
+	""" Text version of an HTML email; memoised, as the same notification is usually rendered once and sent to several users """
+	return html2text.html2text(html)
+
+
+def send_messages(email_messages, fail_silently=False, batch_size=BATCH_SIZE):
+	""" Sends the messages in batches, each over a single connection, returning the number of messages sent """
+	num_sent = 0
+	for start in range(0, len(email_messages), batch_size):
+		with get_connection(fail_silently=fail_silently) as connection:
+			num_sent += connection.send_messages(email_messages[start:start + batch_size]) or 0
+	return num_sent
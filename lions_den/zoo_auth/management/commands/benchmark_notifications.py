@@ -0,0 +1,84 @@
+import time
+import threading
+import socketserver
+
+from django.core.mail import EmailMultiAlternatives
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from zoo_auth.models import ZooUser
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+	""" Replies to each SMTP command as a mail server accepting everything would, discarding the messages """
+	def handle(self):
+		time.sleep(self.server.connect_delay) # e.g. the SSL handshake with the real mail server
+		self.wfile.write(b'220 sink ESMTP\r\n')
+		in_data = False
+		for line in self.rfile:
+			if in_data:
+				if line == b'.\r\n':
+					in_data = False
+					with self.server.lock:
+						self.server.num_messages += 1
+					self.wfile.write(b'250 OK\r\n')
+			elif line[:4].upper() == b'DATA':
+				in_data = True
+				self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+			elif line[:4].upper() == b'QUIT':
+				self.wfile.write(b'221 Bye\r\n')
+				return
+			else:
+				self.wfile.write(b'250 OK\r\n')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+
+	def __init__(self, connect_delay=0):
+		super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+		self.connect_delay = connect_delay
+		self.num_messages = 0
+		self.lock = threading.Lock()
+
+
+class Command(BaseCommand):
+	help = 'Measures the messages/second of notification emails sent by ZooUser.notify_users to a local SMTP sink, against a connection per message'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--recipients', type=int, default=500, help='Number of users notified')
+		parser.add_argument('--connect-delay', type=float, default=0, help='Seconds the sink takes to accept each connection')
+
+	def handle(self, *args, **options):
+		users = [
+			ZooUser(email=f'keeper{i}@zooverse.org', notification_method=ZooUser.NotificationMethod.EMAIL)
+			for i in range(options['recipients'])
+		] # not saved, as only their emails and preferences are needed
+		html_message = '<p><b>Keeper</b> added a comment to <b>#1 - Lion roars twice</b></p>' * 20
+
+		with SMTPSink(options['connect_delay']) as sink:
+			threading.Thread(target=sink.serve_forever, daemon=True).start()
+			with override_settings(
+				EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1', EMAIL_PORT=sink.server_address[1],
+				EMAIL_USE_SSL=False, EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''
+			):
+				self.benchmark('connection per message', sink, len(users), lambda: [
+					self.create_message(user, html_message).send() for user in users
+				])
+				self.benchmark('notify_users', sink, len(users), lambda: ZooUser.notify_users(
+					users, subject='Lion roars twice', html_message=html_message, notify_admins=False
+				))
+			sink.shutdown()
+
+	@staticmethod
+	def create_message(user, html_message):
+		email_message = EmailMultiAlternatives(subject='Lion roars twice', body=html_message, to=[user.email])
+		email_message.attach_alternative(html_message, 'text/html')
+		return email_message
+
+	def benchmark(self, name, sink, num_messages, send_func):
+		sink.num_messages = 0
+		start_time = time.perf_counter()
+		send_func()
+		seconds = time.perf_counter() - start_time
+		self.stdout.write(f'{name}: {num_messages / seconds:.0f} messages/s ({sink.num_messages} of {num_messages} received in {seconds:.2f} s)')
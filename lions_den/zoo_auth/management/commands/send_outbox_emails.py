@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from zoo_auth.models import OutboxEmail
+
+STALE_SENDING_TIMEOUT = 600 # seconds after which an email being sent is assumed to have lost its worker
+
+
+def run_dispatcher(batch_size, poll_interval, max_attempts, retry_delay, once):
+	""" Sends the due outbox emails until none are due (if once) or forever, returning the number of emails sent and failed """
+	num_sent = num_failed = 0
+	while True:
+		OutboxEmail.objects.requeue_stale(STALE_SENDING_TIMEOUT)
+		batch_sent, batch_failed = OutboxEmail.objects.send_due(batch_size=batch_size, max_attempts=max_attempts, retry_delay=retry_delay)
+		num_sent, num_failed = num_sent + batch_sent, num_failed + batch_failed
+		if not OutboxEmail.objects.due().exists():
+			if once:
+				return num_sent, num_failed
+			time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+	help = 'Sends the notification emails queued in the outbox, in batches sharing a connection to the mail server, retrying failures with backoff'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=100, help='Number of emails sent over each connection')
+		parser.add_argument('--poll-interval', type=float, default=5, help='Seconds to wait when there are no emails due')
+		parser.add_argument('--max-attempts', type=int, default=5, help='Number of times an email is tried before it is marked as failed')
+		parser.add_argument('--retry-delay', type=float, default=60, help='Seconds before the first retry of an email, doubled on each retry')
+		parser.add_argument('--once', action='store_true', help='Exit once no emails are due, instead of polling (emails waiting to be retried are left for later)')
+
+	def handle(self, *args, **options):
+		num_sent, num_failed = run_dispatcher(
+			options['batch_size'], options['poll_interval'], options['max_attempts'], options['retry_delay'], options['once']
+		)
+		self.stdout.write(f'{num_sent} emails sent, {num_failed} failed')
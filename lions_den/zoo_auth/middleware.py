@@ -0,0 +1,11 @@
+from .models import Zoo
+
+
+class ZooCacheMiddleware:
+	""" Scopes the zoo identity map (see ZooManager) to each request """
+	def __init__(self, get_response):
+		self.get_response = get_response
+	
+	def __call__(self, request):
+		with Zoo.objects.request_scope():
+			return self.get_response(request)
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zoo_auth', '0006_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='zoouser',
+            name='notification_method',
+            field=models.CharField(choices=[('NONE', 'None'), ('APP', 'Bell icon'), ('EMAIL', 'E-mail'), ('A&E', 'Both'), ('DIG_H', 'Hourly e-mail digest'), ('DIG_D', 'Daily e-mail digest')], default='APP', max_length=5, verbose_name='Notification Method'),
+        ),
+    ]
@@ -1,14 +1,33 @@
 import datetime
-import html2text
+import contextlib
 
+from asgiref.local import Local
+from django.conf import settings
 from django.db import models
+from django.db.models import F
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import get_user_model
 from django.template.loader import render_to_string
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 
+from .mail import html_to_text, send_messages
+
+
+ZOO_ACCESS_VERSION_KEY = 'accessible_zoos:version'
+# Changes to zoo access invalidate the cache, but other processes only see that once their entries expire (unless
+# CACHES is shared between them), so this bounds how long access revoked elsewhere lasts
+ZOO_ACCESS_CACHE_TIMEOUT = 60
+NOTIFIED_ADMINS_KEY = 'notified_admins'
+# Saving or deleting a user invalidates the cached admins, but neither QuerySet.update() nor the other processes (unless
+# CACHES is shared between them) do, so this bounds how long a stale list of admins is notified
+NOTIFIED_ADMINS_CACHE_TIMEOUT = 60
+
 
 class ZooUserManager(BaseUserManager):
 	""" Custom user model manager where email is the unique identifier for authentication """
@@ -49,6 +68,8 @@ class ZooUser(AbstractUser):
 		APP = 'APP', _('Bell icon')
 		EMAIL = 'EMAIL', _('E-mail')
 		APP_AND_EMAIL = 'A&E', _('Both')
+		HOURLY_DIGEST = 'DIG_H', _('Hourly e-mail digest')
+		DAILY_DIGEST = 'DIG_D', _('Daily e-mail digest')
 	
 	notification_method = models.CharField(max_length=5, choices=NotificationMethod.choices, verbose_name='Notification Method', blank=False, default=NotificationMethod.APP)
 	
@@ -71,14 +92,34 @@ class ZooUser(AbstractUser):
 	def zoos(self):
 		return Zoo.objects.all() if self.is_superuser else self._zoos.all()
 	
+	@property
+	def accessible_zoos(self):
+		"""
+			Ids and names of the zoos of the user (rather than the zoos themselves, with their encryption keys),
+			cached briefly so they can be used on every request at no cost, e.g. for access checks and the navbar
+		"""
+		if '_accessible_zoos' not in self.__dict__:
+			cache_key = get_accessible_zoos_cache_key(self.pk)
+			self._accessible_zoos = cache.get(cache_key)
+			if self._accessible_zoos is None:
+				self._accessible_zoos = list(self.zoos.values('id', 'name'))
+				cache.set(cache_key, self._accessible_zoos, timeout=ZOO_ACCESS_CACHE_TIMEOUT)
+			self._accessible_zoo_ids = frozenset(zoo['id'] for zoo in self._accessible_zoos)
+		return self._accessible_zoos
+	
+	@property
+	def accessible_zoo_ids(self):
+		self.accessible_zoos # makes sure the ids are loaded
+		return self._accessible_zoo_ids
+	
 	def has_access(self, zoo_id):
-		return any(zoo.id==zoo_id for zoo in self.zoos)
+		return zoo_id in self.accessible_zoo_ids
 	
-	def notify(self, subject, text_message=None, html_message=None, ignore_preferences=False):
-		type(self).notify_users([self], subject, text_message, html_message, notify_admins=False, ignore_preferences=ignore_preferences)
+	def notify(self, subject, text_message=None, html_message=None, ignore_preferences=False, queue=False):
+		type(self).notify_users([self], subject, text_message, html_message, notify_admins=False, ignore_preferences=ignore_preferences, queue=queue)
 	
 	@classmethod
-	def notify_users(cls, users, subject, text_message=None, html_message=None, notify_separately=True, notify_admins=True, ignore_preferences=False):
+	def notify_users(cls, users, subject, text_message=None, html_message=None, notify_separately=True, notify_admins=True, ignore_preferences=False, queue=False):
 		"""
 		Sends an email to the relevant users
 		:param users: queryset of users meant to be notified
@@ -87,16 +128,18 @@ class ZooUser(AbstractUser):
 		:param html_message: HTML contents of the email
 		:param notify_separately: if False, a single email will be sent with all users in To field, with admins in BCC
 		:param notify_admins: if True, admins will be notified even if not in users
+		:param queue: if True, the emails are added to the outbox (as part of the current transaction) for the send_outbox_emails
+			command to send, instead of being sent before returning
 		:return: None
 		"""
 		
 		if not text_message and not html_message:
 			raise ValueError('Notification email cannot be sent without content')
 		if not text_message:
-			text_message = html2text.html2text(html_message)
+			text_message = html_to_text(html_message)
 		
 		users = [user for user in users if user.wants_email_notifications() or ignore_preferences]
-		admins = [user for user in ZooUser.admins.all() if user.wants_email_notifications()]
+		admins = cls.get_notified_admins() if notify_admins else []
 		bcc_users = []
 		
 		if notify_admins:
@@ -110,6 +153,7 @@ class ZooUser(AbstractUser):
 			if notify_admins:
 				bcc_users = admins
 		
+		email_messages = []
 		for mailing_list in mailing_lists:
 			email_message = EmailMultiAlternatives(
 				subject=subject,
@@ -119,7 +163,21 @@ class ZooUser(AbstractUser):
 			)
 			if html_message:
 				email_message.attach_alternative(html_message, 'text/html')
-			email_message.send(fail_silently=True)
+			email_messages.append(email_message)
+		
+		if queue:
+			OutboxEmail.objects.add(email_messages)
+		else:
+			send_messages(email_messages, fail_silently=True)
+	
+	@classmethod
+	def get_notified_admins(cls):
+		""" Admins who want email notifications, cached until any user is saved or deleted, or for NOTIFIED_ADMINS_CACHE_TIMEOUT at most """
+		admins = cache.get(NOTIFIED_ADMINS_KEY)
+		if admins is None:
+			admins = [user for user in cls.admins.all() if user.wants_email_notifications()]
+			cache.set(NOTIFIED_ADMINS_KEY, admins, timeout=NOTIFIED_ADMINS_CACHE_TIMEOUT)
+		return admins
 	
 	@classmethod
 	def notify_admins(cls, subject, text_message=None, html_message=None):
@@ -137,6 +195,152 @@ class ZooUser(AbstractUser):
 	
 	def wants_app_notifications(self):
 		return self.notification_method in (self.NotificationMethod.APP, self.NotificationMethod.APP_AND_EMAIL)
+	
+	def wants_digest_notifications(self):
+		""" Whether notifications are collected into a periodic email (see the send_digests command) rather than sent one by one """
+		return self.notification_method in (self.NotificationMethod.HOURLY_DIGEST, self.NotificationMethod.DAILY_DIGEST)
+
+
+class OutboxEmailManager(models.Manager):
+	def add(self, email_messages):
+		""" Queues EmailMultiAlternatives for the send_outbox_emails command to send, once the current transaction commits """
+		outbox_emails = []
+		for email_message in email_messages:
+			if not email_message.recipients():
+				continue
+			html_bodies = [content for content, mimetype in email_message.alternatives if mimetype == 'text/html']
+			outbox_emails.append(OutboxEmail(
+				subject=email_message.subject,
+				body=email_message.body,
+				html_body=html_bodies[0] if html_bodies else '',
+				to=email_message.to,
+				bcc=email_message.bcc,
+			))
+		return self.bulk_create(outbox_emails)
+	
+	def due(self):
+		return self.filter(status=OutboxEmail.Status.PENDING, next_attempt__lte=timezone.now())
+	
+	def claim_due(self, limit):
+		""" Marks up to limit emails due to be sent as sending and returns them, oldest first; safe across worker processes """
+		claimed_emails = []
+		for email in self.due().order_by('next_attempt', 'id')[:limit]:
+			if self.filter(id=email.id, status=OutboxEmail.Status.PENDING).update(status=OutboxEmail.Status.SENDING, attempts=F('attempts') + 1, updated=timezone.now()):
+				email.refresh_from_db()
+				claimed_emails.append(email)
+		return claimed_emails
+	
+	def requeue_stale(self, timeout):
+		""" Puts back emails left sending for longer than timeout seconds, e.g. by a worker which was killed """
+		stale_time = timezone.now() - datetime.timedelta(seconds=timeout)
+		return self.filter(status=OutboxEmail.Status.SENDING, updated__lt=stale_time).update(status=OutboxEmail.Status.PENDING, updated=timezone.now())
+	
+	def send_due(self, batch_size, max_attempts, retry_delay):
+		"""
+			Sends a batch of the emails due over a single connection to the mail server
+			Emails which fail are retried after retry_delay seconds, doubled on each attempt, until they fail max_attempts times
+			:return: number of emails sent, and number of emails which failed for good
+		"""
+		emails = self.claim_due(batch_size)
+		if not emails:
+			return 0, 0
+		num_sent = num_failed = 0
+		try:
+			with get_connection() as connection:
+				for email in emails:
+					try:
+						connection.send_messages([email.as_email_message()])
+					except Exception as e:
+						num_failed += not email.retry_later(e, max_attempts, retry_delay)
+					else:
+						email.delete()
+						num_sent += 1
+		except Exception as e: # e.g. the mail server is unreachable, in which case none of the batch could be sent
+			for email in emails:
+				if email.status == OutboxEmail.Status.SENDING and email.pk is not None:
+					num_failed += not email.retry_later(e, max_attempts, retry_delay)
+		return num_sent, num_failed
+
+
+class OutboxEmail(models.Model):
+	""" Email queued by notify_users as part of the transaction which caused it, sent by the send_outbox_emails command """
+	class Status(models.TextChoices):
+		PENDING = 'pending'
+		SENDING = 'sending'
+		FAILED = 'failed' # sent emails are deleted
+	
+	subject = models.TextField()
+	body = models.TextField()
+	html_body = models.TextField(blank=True)
+	to = models.JSONField(default=list)
+	bcc = models.JSONField(default=list)
+	status = models.CharField(max_length=8, choices=Status.choices, default=Status.PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	next_attempt = models.DateTimeField(default=timezone.now)
+	error = models.TextField(blank=True)
+	created = models.DateTimeField(auto_now_add=True)
+	updated = models.DateTimeField(auto_now=True)
+	
+	objects = OutboxEmailManager()
+	
+	class Meta:
+		indexes = [models.Index(fields=['status', 'next_attempt'], name='outbox_email_due')]
+	
+	def __str__(self):
+		return f'{self.subject} ({", ".join(self.to + self.bcc)})'
+	
+	def as_email_message(self):
+		email_message = EmailMultiAlternatives(subject=self.subject, body=self.body, to=self.to, bcc=self.bcc)
+		if self.html_body:
+			email_message.attach_alternative(self.html_body, 'text/html')
+		return email_message
+	
+	def retry_later(self, error, max_attempts, retry_delay):
+		"""
+			Puts the email back to be retried with exponential backoff, or fails it after max_attempts
+			:return: whether it will be retried
+		"""
+		self.status = self.Status.FAILED if self.attempts >= max_attempts else self.Status.PENDING
+		self.next_attempt = timezone.now() + datetime.timedelta(seconds=retry_delay * 2 ** (self.attempts - 1))
+		self.error = repr(error)
+		self.save()
+		return self.status == self.Status.PENDING
+
+
+class ZooManager(models.Manager):
+	"""
+		Keeps an identity map of zoos, so that each zoo is only fetched once per request (see ZooCacheMiddleware),
+		or once per process if ZOO_CACHE_PROCESS_WIDE is set, in which case saving a zoo invalidates it
+	"""
+	_request_zoos = Local()
+	_process_zoos = {}
+	
+	def get_cached(self, zoo_id):
+		zoos = self._get_identity_map()
+		if zoos is None: # outside of a request
+			return self.filter(id=zoo_id).first()
+		if zoo_id not in zoos:
+			zoos[zoo_id] = self.filter(id=zoo_id).first()
+		return zoos[zoo_id]
+	
+	@contextlib.contextmanager
+	def request_scope(self):
+		self._request_zoos.zoos = {}
+		try:
+			yield
+		finally:
+			del self._request_zoos.zoos
+	
+	def invalidate(self, zoo_id):
+		self._process_zoos.pop(zoo_id, None)
+		request_zoos = getattr(self._request_zoos, 'zoos', None)
+		if request_zoos is not None:
+			request_zoos.pop(zoo_id, None)
+	
+	def _get_identity_map(self):
+		if getattr(settings, 'ZOO_CACHE_PROCESS_WIDE', False):
+			return self._process_zoos
+		return getattr(self._request_zoos, 'zoos', None)
 
 
 class Zoo(models.Model):
@@ -150,6 +354,8 @@ class Zoo(models.Model):
 	
 	users = models.ManyToManyField(get_user_model(), related_name='_zoos')
 	
+	objects = ZooManager()
+	
 	def __str__(self):
 		return self.name
 	
@@ -174,4 +380,47 @@ class Zoo(models.Model):
 			self.last_commit_date = datetime.date.today()
 			self.save()
 		else:
-			raise Exception('You cannot make any commits within 30 days of each other.\nLast commit: ' + str(self.last_commit_date))
\ No newline at end of file
+			raise Exception('You cannot make any commits within 30 days of each other.\nLast commit: ' + str(self.last_commit_date))
+
+
+@receiver(post_save, sender=Zoo)
+@receiver(post_delete, sender=Zoo)
+def invalidate_cached_zoo(sender, instance, **kwargs):
+	Zoo.objects.invalidate(instance.id)
+	invalidate_accessible_zoos()
+
+
+@receiver(post_save, sender=ZooUser)
+@receiver(post_delete, sender=ZooUser)
+def invalidate_notified_admins(sender, instance, **kwargs):
+	cache.delete(NOTIFIED_ADMINS_KEY) # staff status or notification method may have changed
+
+
+@receiver(post_save, sender=ZooUser)
+def invalidate_user_accessible_zoos(sender, instance, **kwargs):
+	cache.delete(get_accessible_zoos_cache_key(instance.pk)) # superuser status may have changed
+	instance.__dict__.pop('_accessible_zoos', None)
+
+
+@receiver(m2m_changed, sender=Zoo.users.through)
+def invalidate_users_accessible_zoos(sender, instance, action, reverse, pk_set, **kwargs):
+	if action not in ('post_add', 'post_remove', 'post_clear'):
+		return
+	if reverse: # user._zoos changed
+		cache.delete(get_accessible_zoos_cache_key(instance.pk))
+		instance.__dict__.pop('_accessible_zoos', None)
+	elif pk_set:
+		cache.delete_many([get_accessible_zoos_cache_key(user_pk) for user_pk in pk_set])
+	else: # zoo.users cleared, so the affected users are no longer known
+		invalidate_accessible_zoos()
+
+
+# Zoo access cache-----------------------------------------------------------
+def get_accessible_zoos_cache_key(user_pk):
+	return f'accessible_zoos:{cache.get_or_set(ZOO_ACCESS_VERSION_KEY, 0, timeout=None)}:{user_pk}'
+
+
+def invalidate_accessible_zoos():
+	""" Invalidates the cached zoos of all users, by moving on to a new version of the cache keys """
+	cache.get_or_set(ZOO_ACCESS_VERSION_KEY, 0, timeout=None)
+	cache.incr(ZOO_ACCESS_VERSION_KEY)
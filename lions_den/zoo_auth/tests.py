@@ -1,3 +1,90 @@
+import time
+import smtplib
+import datetime
+from unittest import mock
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
 from django.test import TestCase
+from django.utils import timezone
+
+from .mail import html_to_text
+from .models import ZooUser, OutboxEmail, NOTIFIED_ADMINS_CACHE_TIMEOUT
+from .management.commands.send_outbox_emails import run_dispatcher
+
+
+class OutboxTests(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.keepers = [
+			ZooUser.objects.create_user(email=f'keeper{i}@zooverse.org', password='password', notification_method=ZooUser.NotificationMethod.EMAIL)
+			for i in range(3)
+		]
+
+	def queue_notification(self):
+		ZooUser.notify_users(self.keepers, subject='Lion fed', html_message='<p>The lion was <b>fed</b></p>', notify_admins=False, queue=True)
+
+	def test_queued_emails_sent_by_dispatcher(self):
+		self.queue_notification()
+		self.assertEqual(len(mail.outbox), 0)
+		self.assertEqual(OutboxEmail.objects.count(), 3)
+
+		self.assertEqual(run_dispatcher(batch_size=2, poll_interval=0, max_attempts=3, retry_delay=60, once=True), (3, 0))
+		self.assertEqual(sorted(message.to[0] for message in mail.outbox), [keeper.email for keeper in self.keepers])
+		self.assertEqual(mail.outbox[0].alternatives, [('<p>The lion was <b>fed</b></p>', 'text/html')])
+		self.assertFalse(OutboxEmail.objects.exists())
+
+	def test_failed_emails_retried_with_backoff(self):
+		self.queue_notification()
+		with mock.patch.object(EmailBackend, 'send_messages', side_effect=smtplib.SMTPServerDisconnected('Connection unexpectedly closed')):
+			self.assertEqual(run_dispatcher(batch_size=10, poll_interval=0, max_attempts=2, retry_delay=60, once=True), (0, 0))
+			email = OutboxEmail.objects.first()
+			self.assertEqual((email.status, email.attempts), (OutboxEmail.Status.PENDING, 1))
+			self.assertGreater(email.next_attempt, timezone.now() + datetime.timedelta(seconds=50))
+
+			OutboxEmail.objects.update(next_attempt=timezone.now())
+			self.assertEqual(run_dispatcher(batch_size=10, poll_interval=0, max_attempts=2, retry_delay=60, once=True), (0, 3))
+		self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.Status.FAILED).count(), 3)
+		self.assertIn('SMTPServerDisconnected', OutboxEmail.objects.first().error)
+
+
+class NotificationDeliveryTests(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		cls.admin = ZooUser.objects.create_user(email='admin@zooverse.org', password='password', is_staff=True, notification_method=ZooUser.NotificationMethod.EMAIL)
+		cls.keepers = [
+			ZooUser.objects.create_user(email=f'keeper{i}@zooverse.org', password='password', notification_method=ZooUser.NotificationMethod.EMAIL)
+			for i in range(3)
+		]
+
+	def setUp(self):
+		cache.clear() # the cached admins would otherwise outlive the rolled back test data
+
+	def test_messages_sent_over_one_connection(self):
+		with mock.patch.object(EmailBackend, 'send_messages', autospec=True, side_effect=lambda backend, messages: len(messages)) as send_messages:
+			ZooUser.notify_users(self.keepers, subject='Lion fed', html_message='<p>The lion was <b>fed</b></p>')
+		send_messages.assert_called_once()
+		self.assertEqual([message.to for message in send_messages.call_args[0][1]], [[keeper.email] for keeper in self.keepers] + [[self.admin.email]])
+
+	def test_text_rendering_memoised(self):
+		html_to_text.cache_clear()
+		for _ in range(2):
+			ZooUser.notify_users(self.keepers, subject='Lion fed', html_message='<p>The lion was <b>fed</b></p>', notify_admins=False)
+		self.assertEqual((html_to_text.cache_info().hits, html_to_text.cache_info().misses), (1, 1))
+		self.assertEqual(mail.outbox[0].body.strip(), 'The lion was **fed**')
 
-# Create your tests here.
+	def test_admins_cached_until_users_change(self):
+		self.assertEqual(ZooUser.get_notified_admins(), [self.admin])
+		with self.assertNumQueries(0):
+			self.assertEqual(ZooUser.get_notified_admins(), [self.admin])
+		self.keepers[0].is_staff = True
+		self.keepers[0].save()
+		self.assertEqual(set(ZooUser.get_notified_admins()), {self.admin, self.keepers[0]})
+	
+	def test_admins_changed_without_signals_expire(self):
+		self.assertEqual(ZooUser.get_notified_admins(), [self.admin])
+		ZooUser.objects.filter(pk=self.admin.pk).update(notification_method=ZooUser.NotificationMethod.NONE)
+		self.assertEqual(ZooUser.get_notified_admins(), [self.admin])
+		with mock.patch('time.time', return_value=time.time() + NOTIFIED_ADMINS_CACHE_TIMEOUT + 1):
+			self.assertEqual(ZooUser.get_notified_admins(), [])
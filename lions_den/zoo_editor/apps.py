@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class ZooEditorConfig(AppConfig):
     name = 'zoo_editor'
     verbose_name = 'Zoo Editor'
+
+    def ready(self):
+        from .zoo_schema import check_schema_on_first_connection
+        connection_created.connect(check_schema_on_first_connection)
@@ -1,6 +1,7 @@
 import datetime
 
 from django import forms
+from django.conf import settings
 from django.forms.models import modelformset_factory
 
 from .models import Species, Individual, Group, AttributeCategory
@@ -39,6 +40,11 @@ class BaseSubjectForm(BaseModelForm):
 			""")
 		super().__init__(*args, **kwargs)
 
+	def save(self, commit=True):
+		""" Leaves the renditions of uploaded images to the image jobs worker, if there is one, so the request does not wait for them """
+		self.instance.queue_renditions = settings.IMAGE_RENDITIONS_IN_WORKER
+		return super().save(commit)
+
 
 class SpeciesForm(BaseSubjectForm):
 	image = ImageBlobField()
@@ -0,0 +1,34 @@
+import timeit
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from zoo_editor.utils import encryption
+
+
+class Command(BaseCommand):
+	help = (
+		'Compares the speed of the QR code encryption implementations: cryptography, which production installs from requirements.txt, '
+		'and the pure-Python fallback'
+	)
+	
+	PLAINTEXT = 'zoo=test&type=species&id=123'
+	PASSWORD = '123456789012345678901234567890'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('-n', '--number', type=int, default=200, help='Number of encryptions per implementation')
+	
+	def handle(self, *args, **options):
+		if encryption.Cipher is not None:
+			self.benchmark('cryptography', encryption.encrypt, options['number'])
+		else:
+			self.stdout.write('cryptography is not installed, so QR codes are encrypted by the pure-Python fallback')
+		with mock.patch.object(encryption, 'Cipher', None):
+			encryption.get_cipher.cache_clear()
+			self.benchmark('pure Python', encryption.encrypt, options['number'])
+		encryption.get_cipher.cache_clear()
+	
+	def benchmark(self, name, encrypt, number):
+		timer = timeit.Timer(lambda: encrypt(self.PLAINTEXT, self.PASSWORD))
+		seconds = min(timer.repeat(repeat=3, number=number)) / number
+		self.stdout.write(f'{name:>16}: {seconds * 1000:10.3f} ms per encryption')
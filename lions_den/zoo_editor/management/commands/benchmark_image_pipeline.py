@@ -0,0 +1,111 @@
+import io
+import os
+import time
+import tempfile
+import functools
+import multiprocessing
+
+from PIL import Image
+
+from django.core.management.base import BaseCommand
+
+from zoo_editor.utils import image_pipeline
+
+SUBJECT_IMAGE_SIZE = (256, 192)
+
+LEGACY_TRANSPOSE_SEQUENCES = {
+	2: [Image.FLIP_LEFT_RIGHT], 3: [Image.ROTATE_180], 4: [Image.FLIP_TOP_BOTTOM], 5: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_90],
+	6: [Image.ROTATE_270], 7: [Image.FLIP_TOP_BOTTOM, Image.ROTATE_90], 8: [Image.ROTATE_90]
+}
+
+
+def legacy_orient(img):
+	return functools.reduce(type(img).transpose, LEGACY_TRANSPOSE_SEQUENCES.get(image_pipeline.get_orientation(img), []), img)
+
+
+def legacy_normalise_image(data, size, format):
+	""" Subject image normalisation as previously done, copying pixels through Python tuples to strip metadata """
+	img = legacy_orient(Image.open(io.BytesIO(data)).convert('RGBA'))
+	img = img.crop(image_pipeline.get_cover_box(img.size, size)).resize(size, Image.LANCZOS)
+	img_data = list(img.getdata())
+	img = Image.new(img.mode, img.size)
+	img.putdata(img_data)
+	output_file = io.BytesIO()
+	img.save(output_file, format=format)
+	return output_file.getvalue()
+
+
+def legacy_strip_exif(data, format):
+	img = legacy_orient(Image.open(io.BytesIO(data)))
+	img_data = list(img.getdata())
+	img = Image.new(img.mode, img.size)
+	img.putdata(img_data)
+	output_file = io.BytesIO()
+	img.save(output_file, format=format)
+	return output_file.getvalue()
+
+
+IMPLEMENTATIONS = (
+	('legacy', 'normalise', functools.partial(legacy_normalise_image, size=SUBJECT_IMAGE_SIZE, format='PNG')),
+	('pipeline', 'normalise', functools.partial(image_pipeline.normalise_image, size=SUBJECT_IMAGE_SIZE, format='PNG')),
+	('legacy', 'strip EXIF', functools.partial(legacy_strip_exif, format='PNG')),
+	('pipeline', 'strip EXIF', functools.partial(image_pipeline.strip_exif, format='PNG')),
+)
+
+
+def get_memory_kib(field):
+	with open('/proc/self/status') as status_file:
+		for line in status_file:
+			if line.startswith(field + ':'):
+				return int(line.split()[1])
+
+
+def run_implementation(process_image, paths):
+	""" Processes the images in a fresh process, returning the time taken and the peak memory above the initial one """
+	with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+		clear_refs_file.write('5') # resets the peak resident set size
+	initial_memory = get_memory_kib('VmRSS')
+	start_time = time.perf_counter()
+	for path in paths:
+		with open(path, 'rb') as image_file:
+			process_image(image_file.read())
+	return time.perf_counter() - start_time, get_memory_kib('VmHWM') - initial_memory
+
+
+class Command(BaseCommand):
+	help = 'Compares the time and peak memory of the subject image pipeline with the previous per-pixel implementation'
+
+	def add_arguments(self, parser):
+		parser.add_argument('corpus', nargs='?', help='Directory of JPEGs to process (defaults to generated 12 megapixel photos)')
+		parser.add_argument('--count', type=int, default=3, help='Number of images to generate if no corpus is given')
+
+	def handle(self, *args, **options):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			if options['corpus']:
+				paths = sorted(
+					os.path.join(options['corpus'], file_name) for file_name in os.listdir(options['corpus'])
+					if file_name.lower().endswith(('.jpg', '.jpeg'))
+				)
+			else:
+				paths = [self.create_photo(os.path.join(temp_dir, f'photo-{i}.jpg')) for i in range(options['count'])]
+			if not paths:
+				self.stdout.write('No JPEGs to process')
+				return
+
+			self.stdout.write(f'{len(paths)} images')
+			for implementation, operation, process_image in IMPLEMENTATIONS:
+				with multiprocessing.get_context('fork').Pool(1) as pool:
+					seconds, peak_memory_kib = pool.apply(run_implementation, (process_image, paths))
+				self.stdout.write(
+					f'{implementation:>8} {operation:<10}: {seconds * 1000 / len(paths):8.1f} ms per image, '
+					f'{peak_memory_kib / 1024:8.1f} MiB peak memory'
+				)
+
+	@staticmethod
+	def create_photo(path, size=(4032, 3024)):
+		""" Phone-sized photo with noise (so it compresses like a real one) and an EXIF orientation """
+		img = Image.merge('RGB', [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)])
+		exif = Image.Exif()
+		exif[image_pipeline.EXIF_ORIENTATION_TAG] = 6
+		img.save(path, format='JPEG', quality=90, exif=exif.tobytes())
+		return path
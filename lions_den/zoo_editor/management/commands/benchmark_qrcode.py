@@ -0,0 +1,45 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+# noinspection PyUnresolvedReferences
+from zoo_auth.models import Zoo
+
+from zoo_editor.models import Species, Individual, Group
+from zoo_editor.utils.encryption import get_cipher
+from zoo_editor.utils.qrcode_export import iter_qrcodes
+
+
+class Command(BaseCommand):
+	help = "Measures cold and warm QR code generation times for a zoo's subjects, and the throughput of exporting them all"
+	
+	def add_arguments(self, parser):
+		parser.add_argument('zoo_id')
+		parser.add_argument('--export-processes', type=int, nargs='*', default=[], help='Numbers of worker processes to time the export with')
+	
+	def handle(self, *args, **options):
+		subjects = [subject for model in (Species, Individual, Group) for subject in model.objects.using(options['zoo_id']).defer('image')]
+		if not subjects:
+			self.stdout.write('The zoo has no subjects')
+			return
+		
+		cache.clear()
+		get_cipher.cache_clear()
+		self.benchmark('cold', subjects)
+		self.benchmark('warm', subjects)
+		
+		zoo = Zoo.objects.get(id=options['zoo_id'])
+		for processes in options['export_processes']:
+			start_time = time.perf_counter()
+			num_codes = sum(1 for _ in iter_qrcodes(zoo, processes=processes))
+			seconds = time.perf_counter() - start_time
+			self.stdout.write(f'export with {processes} processes: {num_codes / seconds:.0f} QR codes/s ({num_codes} in {seconds:.2f} s)')
+	
+	def benchmark(self, name, subjects):
+		start_time = time.perf_counter()
+		for subject in subjects:
+			subject.__dict__.pop('qr_code', None) # drop the per-instance cached value
+			subject.qr_code
+		seconds = time.perf_counter() - start_time
+		self.stdout.write(f'{name}: {seconds * 1000 / len(subjects):.3f} ms per QR code ({len(subjects)} subjects)')
@@ -0,0 +1,79 @@
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+
+# noinspection PyUnresolvedReferences
+from main.databases import apply_pragmas, DEFAULT_PRAGMAS, DEFAULT_BUSY_TIMEOUT
+
+NUM_ROWS = 200
+CONFIGURATIONS = (
+	# name, pragmas, busy timeout; stock is what django.db.backends.sqlite3 does out of the box
+	('stock', {}, 5),
+	('tuned', DEFAULT_PRAGMAS, DEFAULT_BUSY_TIMEOUT),
+)
+
+
+def run_worker(path, pragmas, busy_timeout, is_writer, seconds):
+	""" Reads blobs or updates rows of random subjects for the given time, returning (number of operations, number of lock errors) """
+	connection = sqlite3.connect(path, timeout=busy_timeout)
+	apply_pragmas(connection, pragmas)
+	num_operations = num_errors = 0
+	end_time = time.monotonic() + seconds
+	while time.monotonic() < end_time:
+		subject_id = random.randint(1, NUM_ROWS)
+		try:
+			if is_writer:
+				with connection:
+					connection.execute('UPDATE SUBJECTS SET name = ? WHERE id = ?', (f'Subject {time.time()}', subject_id))
+			else:
+				connection.execute('SELECT image FROM SUBJECTS WHERE id = ?', (subject_id,)).fetchone()
+			num_operations += 1
+		except sqlite3.OperationalError:
+			num_errors += 1
+	connection.close()
+	return num_operations, num_errors
+
+
+class Command(BaseCommand):
+	help = 'Measures reader/writer throughput of concurrent processes on a zoo-like database, with stock and tuned SQLite settings'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--readers', type=int, default=4, help='Number of reader processes')
+		parser.add_argument('--writers', type=int, default=2, help='Number of writer processes')
+		parser.add_argument('--seconds', type=float, default=3, help='Duration of each run')
+		parser.add_argument('--blob-kib', type=int, default=256, help='Size of the blob read by each read')
+
+	def handle(self, *args, **options):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			for name, pragmas, busy_timeout in CONFIGURATIONS:
+				path = os.path.join(temp_dir, f'{name}.sqlite3')
+				self.create_database(path, pragmas, options['blob_kib'])
+
+				workers = [(path, pragmas, busy_timeout, False, options['seconds'])] * options['readers']
+				workers += [(path, pragmas, busy_timeout, True, options['seconds'])] * options['writers']
+				with multiprocessing.Pool(len(workers)) as pool:
+					results = pool.starmap(run_worker, workers)
+
+				reads, read_errors = map(sum, zip(*results[:options['readers']])) if options['readers'] else (0, 0)
+				writes, write_errors = map(sum, zip(*results[options['readers']:])) if options['writers'] else (0, 0)
+				self.stdout.write(
+					f'{name:>6}: {reads / options["seconds"]:10.1f} reads/s, {writes / options["seconds"]:8.1f} writes/s, '
+					f'{read_errors + write_errors} "database is locked" errors'
+				)
+
+	@staticmethod
+	def create_database(path, pragmas, blob_kib):
+		connection = sqlite3.connect(path)
+		apply_pragmas(connection, pragmas)
+		connection.execute('CREATE TABLE SUBJECTS (id INTEGER PRIMARY KEY, name TEXT, image BLOB)')
+		with connection:
+			connection.executemany(
+				'INSERT INTO SUBJECTS (id, name, image) VALUES (?, ?, ?)',
+				((subject_id, f'Subject {subject_id}', os.urandom(blob_kib * 1024)) for subject_id in range(1, NUM_ROWS + 1))
+			)
+		connection.close()
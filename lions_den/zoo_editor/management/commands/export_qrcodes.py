@@ -0,0 +1,28 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+# noinspection PyUnresolvedReferences
+from zoo_auth.models import Zoo
+
+from zoo_editor.utils.qrcode_export import iter_qrcodes_zip
+
+
+class Command(BaseCommand):
+	help = 'Exports the QR codes of all subjects of a zoo to a ZIP file'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('zoo_id')
+		parser.add_argument('output', help='Path of the ZIP file to create')
+		parser.add_argument('--sheets', action='store_true', help='Also include printable sheets of tiled QR codes')
+		parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of worker processes (defaults to the number of CPUs)')
+	
+	def handle(self, *args, **options):
+		zoo = Zoo.objects.filter(id=options['zoo_id']).first()
+		if zoo is None:
+			raise CommandError(f'Zoo {options["zoo_id"]} does not exist')
+		
+		with open(options['output'], 'wb') as output_file:
+			for chunk in iter_qrcodes_zip(zoo, processes=options['processes'], with_sheets=options['sheets']):
+				output_file.write(chunk)
+		self.stdout.write(f'QR codes exported to {options["output"]}')
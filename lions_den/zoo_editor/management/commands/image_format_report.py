@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import Length
+
+from zoo_editor.models import ImageRendition, SUBJECT_MODELS
+from zoo_editor.utils.image_pipeline import get_served_formats
+
+BASELINE_FORMAT = 'PNG' # what renditions were served as before formats were negotiated
+
+
+def get_rendition_bytes(zoo_id, formats):
+	"""
+		Total size of the renditions of the subject images of a zoo in each format, using the stored renditions where there are any
+		and generating the others (one image at a time)
+		:return: number of images, total size of their stored masters, and dict of total rendition sizes by format
+	"""
+	num_images = master_bytes = 0
+	rendition_bytes = dict.fromkeys(formats, 0)
+	for model in SUBJECT_MODELS.values():
+		field = model._meta.get_field('image')
+		subject_ids = model.objects.using(zoo_id).filter(image__isnull=False).values_list('id', flat=True)
+		for subject_id in list(subject_ids):
+			image = model.objects.using(zoo_id).defer(None).only('image').get(id=subject_id).image
+			stored_sizes = {
+				(width, format): size for width, format, size in
+				ImageRendition.objects.using(zoo_id).filter(source_hash=image.content_hash).values_list('width', 'format', Length('data'))
+			}
+			for format in formats:
+				for width in field.renditions:
+					size = stored_sizes.get((width, format))
+					rendition_bytes[format] += size if size is not None else len(field.create_rendition(image, width, format))
+			num_images += 1
+			master_bytes += len(image.getvalue())
+	return num_images, master_bytes, rendition_bytes
+
+
+class Command(BaseCommand):
+	help = f'Reports the bytes saved per zoo by serving subject image renditions in compact formats rather than as {BASELINE_FORMAT}'
+
+	def add_arguments(self, parser):
+		parser.add_argument('zoo_ids', nargs='*', help='Zoos to report on (defaults to all of them)')
+
+	def handle(self, *args, **options):
+		zoo_ids = settings.DATABASES.discover_all()
+		for zoo_id in options['zoo_ids']:
+			if zoo_id not in zoo_ids:
+				raise CommandError(f'Zoo {zoo_id} has no database')
+
+		formats = [BASELINE_FORMAT] + get_served_formats()
+		for zoo_id in options['zoo_ids'] or zoo_ids:
+			num_images, master_bytes, rendition_bytes = get_rendition_bytes(zoo_id, formats)
+			self.stdout.write(f'{zoo_id}: {num_images} images, {master_bytes / 2**20:.1f} MiB of masters')
+			if not num_images:
+				continue
+			baseline_bytes = rendition_bytes[BASELINE_FORMAT]
+			for format in formats:
+				saved = f', {1 - rendition_bytes[format] / baseline_bytes:6.1%} saved' if format != BASELINE_FORMAT else ''
+				self.stdout.write(f'  {format:<5}: {rendition_bytes[format] / 1024:10.1f} KiB of renditions{saved}')
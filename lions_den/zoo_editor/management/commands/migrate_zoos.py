@@ -0,0 +1,49 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from zoo_editor.zoo_schema import LATEST_SCHEMA_VERSION, migrate_zoo, get_hot_queries, explain_query_plan
+
+
+class Command(BaseCommand):
+	help = 'Applies pending schema changes and indexes to zoo databases, and reports the query plans of the most frequent queries'
+
+	def add_arguments(self, parser):
+		parser.add_argument('zoo_ids', nargs='*', help='Zoos to migrate (defaults to all of them)')
+		parser.add_argument('--explain', action='store_true', help='Report which indexes the most frequent queries use')
+		parser.add_argument('--vacuum', action='store_true', help='Rebuild the databases after migrating, returning the space freed to the file system')
+
+	def handle(self, *args, **options):
+		zoo_ids = settings.DATABASES.discover_all()
+		for zoo_id in options['zoo_ids']:
+			if zoo_id not in zoo_ids:
+				raise CommandError(f'Zoo {zoo_id} has no database')
+
+		for zoo_id in options['zoo_ids'] or zoo_ids:
+			applied_changes = migrate_zoo(zoo_id)
+			if applied_changes:
+				for change in applied_changes:
+					self.stdout.write(f'{zoo_id}: applied {change.version} - {change.description}')
+					for report in change.reports:
+						self.stdout.write(f'  {report}')
+			else:
+				self.stdout.write(f'{zoo_id}: already at version {LATEST_SCHEMA_VERSION}')
+
+			if options['vacuum']:
+				self.vacuum(zoo_id)
+
+			if options['explain']:
+				for description, queryset in get_hot_queries(zoo_id).items():
+					self.stdout.write(f'  {description}:')
+					for step in explain_query_plan(queryset):
+						self.stdout.write(f'    {step}')
+
+	def vacuum(self, zoo_id):
+		database_path = settings.DATABASES[zoo_id]['NAME']
+		size_before = os.path.getsize(database_path)
+		with connections[zoo_id].cursor() as cursor:
+			cursor.execute('VACUUM')
+		size_after = os.path.getsize(database_path)
+		self.stdout.write(f'  vacuumed: {size_before / 2**20:.1f} MiB -> {size_after / 2**20:.1f} MiB, {(size_before - size_after) / 2**20:.1f} MiB reclaimed')
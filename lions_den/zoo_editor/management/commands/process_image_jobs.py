@@ -0,0 +1,64 @@
+import os
+import time
+import logging
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, DatabaseError
+
+from zoo_editor.models import ImageJob
+
+STALE_JOB_TIMEOUT = 600 # seconds after which a running job is assumed to have lost its worker
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(zoo_ids, poll_interval, max_attempts, once):
+	""" Runs the pending jobs of all zoos until there are none left (if once) or forever, returning the number of jobs done and failed """
+	num_done = num_failed = 0
+	failing_zoo_ids = set() # logged once, then retried quietly on each poll
+	while True:
+		num_run = 0
+		for zoo_id in zoo_ids or settings.DATABASES.discover_all():
+			try:
+				jobs = ImageJob.objects.db_manager(zoo_id)
+				jobs.requeue_stale(STALE_JOB_TIMEOUT)
+				job = jobs.claim_next()
+				while job is not None:
+					if job.run(max_attempts=max_attempts):
+						num_done += 1
+					elif job.status == ImageJob.Status.FAILED:
+						num_failed += 1
+					num_run += 1
+					job = jobs.claim_next()
+			except DatabaseError:
+				# e.g. a zoo database not migrated to a schema with IMAGE_JOBS yet, which must not stop the other zoos
+				if zoo_id not in failing_zoo_ids:
+					logger.exception('Skipping the image jobs of zoo %s', zoo_id)
+					failing_zoo_ids.add(zoo_id)
+			else:
+				failing_zoo_ids.discard(zoo_id)
+		if not num_run:
+			if once:
+				return num_done, num_failed
+			time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+	help = 'Generates the renditions of images uploaded through subject forms (see IMAGE_RENDITIONS_IN_WORKER), in a pool of worker processes polling the job tables of the zoo databases'
+
+	def add_arguments(self, parser):
+		parser.add_argument('zoo_ids', nargs='*', help='Zoos to process the jobs of (defaults to all of them)')
+		parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+		parser.add_argument('--poll-interval', type=float, default=1, help='Seconds to wait when there are no pending jobs')
+		parser.add_argument('--max-attempts', type=int, default=3, help='Number of times a job is tried before it is marked as failed')
+		parser.add_argument('--once', action='store_true', help='Exit once there are no pending jobs left, instead of polling')
+
+	def handle(self, *args, **options):
+		connections.close_all() # connections must not be shared with the forked workers
+		worker_args = (options['zoo_ids'], options['poll_interval'], options['max_attempts'], options['once'])
+		with multiprocessing.Pool(options['workers']) as pool:
+			results = pool.starmap(run_worker, [worker_args] * options['workers'])
+		num_done, num_failed = map(sum, zip(*results))
+		self.stdout.write(f'{num_done} images processed, {num_failed} failed')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from zoo_editor.utils.rendition_cache import get_rendition_cache
+
+
+class Command(BaseCommand):
+	help = 'Shows the usage of the image rendition cache, optionally clearing it'
+	
+	def add_arguments(self, parser):
+		parser.add_argument('--clear', action='store_true', help='Remove all cached renditions')
+	
+	def handle(self, *args, **options):
+		rendition_cache = get_rendition_cache()
+		if options['clear']:
+			rendition_cache.clear()
+			self.stdout.write('Rendition cache cleared')
+		for stat_name, value in rendition_cache.stats().items():
+			self.stdout.write(f'{stat_name}: {value}')
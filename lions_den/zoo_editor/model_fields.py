@@ -1,119 +1,131 @@
 import io
 import base64
-import functools
+import hashlib
 
 from abc import abstractmethod
-from PIL import Image
 
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.functional import cached_property
+
+from .utils.blob_store import get_content_hash, store_blob, load_blob
+from .utils.image_pipeline import normalise_image, strip_exif, get_content_type
+from .utils.rendition_cache import get_rendition_cache, get_rendition_key
+
+IMAGE_PLACEHOLDER_PATH = 'images/image_placeholder.svg' # shown while an uploaded image is being processed
+PREVIEW_FORMAT = 'JPEG' # much smaller than PNG, and previews are inlined as data URIs
 
 # File-like object classes----------------------------------------------------------------------------------------------
 class BlobObject(io.BytesIO):
 	def __init__(self, bytes, parent_field):
 		super().__init__(bytes)
 		self.parent_field = parent_field
+		self.instance = None # model instance the blob belongs to, set by BlobDescriptor
 	
 	@classmethod
 	def from_file(cls, bytes_file, parent_field):
 		return cls(bytes_file.read(), parent_field)
 	
+	@cached_property
+	def content_hash(self):
+		return get_content_hash(self.getvalue())
+	
 	@property
-	@abstractmethod
 	def url(self):
-		pass
+		""" Blob-serving endpoint URL, versioned by ETag. Blobs not yet saved to a subject are inlined as data URIs instead """
+		if self.instance is None or self.instance.pk is None:
+			return self.data_url
+		return self.parent_field.get_path(self.instance) + f'?v={self.etag}'
+	
+	@property
+	def data_url(self):
+		return f'data:{self.content_type};base64,{base64.b64encode(self.get_served_bytes()).decode()}'
+	
+	@property
+	def etag(self):
+		return self.content_hash
+	
+	@property
+	@abstractmethod
+	def content_type(self): pass
+	
+	def get_served_bytes(self):
+		""" Bytes sent to the browser when displaying the blob """
+		return self.getvalue()
 
 
 class ImageBlob(BlobObject):
 	@property
-	def url(self):
-		return f'data:image/{self.parent_field.format};base64,{base64.b64encode(self._get_normalised_img().getvalue()).decode()}'
-	
-	def _get_normalised_img(self):
-		"""" Rotates the image to correct bad EXIF metadata and normalises it to the defined model form field size """
-		img = Image.open(self).convert('RGBA')
-		img = self._correct_exif_rotation(img)
-		width, height = img.size
-		x_min, x_max, y_min, y_max = 0, width, 0, height
-		aspect_ratio = self.parent_field.size[0] / self.parent_field.size[1]
-		
-		# Crop
-		if width / height < aspect_ratio:  # image too tall
-			new_width, new_height = width, round(width / aspect_ratio)
-			y_min = round((height - new_height) // 2)
-			y_max = y_min + new_height
-		elif width / height > aspect_ratio:  # image too wide
-			new_width, new_height = height * aspect_ratio, height
-			x_min = round((width - new_width) // 2)
-			x_max = x_min + new_width
-		img = img.crop((x_min, y_min, x_max, y_max))
-		
-		# Scale
-		img = img.resize(self.parent_field.size, Image.ANTIALIAS)
-
-		# Remove EXIF data
-		img_data = list(img.getdata())
-		img = Image.new(img.mode, img.size)
-		img.putdata(img_data)
-		
-		# Output
-		output_file = io.BytesIO()
-		img.save(output_file, format=self.parent_field.format)
-		return output_file
-	
-	def _correct_exif_rotation(self, img):
+	def content_type(self):
+		return self.parent_field.content_type
+	
+	@property
+	def etag(self):
+		return self.parent_field.get_rendition_etag(self.content_hash, self.parent_field.size)
+	
+	def get_served_etag(self, format):
+		return self.parent_field.get_rendition_etag(self.content_hash, self.parent_field.size, format)
+	
+	@property
+	def preview_url(self):
 		"""
-		Camera orientation is stored in the image metadata (EXIF data).
-		PIL's Image.open() does not account for this, causing silent image rotation.
-		
-		Apply Image.transpose to ensure 0th row of pixels is at the visual
-		top of the image, and 0th column is the visual left-hand side.
-		Return the original image if unable to determine the orientation.
-		
-		As per CIPA DC-008-2012, the orientation field contains an integer,
-		1 through 8. Other values are reserved.
+			Data URI of a compact JPEG of the image as it will be displayed, for previewing uploads before they are saved
+			Cached by content, so previewing the same file again costs only its hash
 		"""
-		exif_orientation_tag = 0x0112
-		exif_transpose_sequences = [  # Val  0th row  0th col
-			[],  # 0    (reserved)
-			[],  # 1   top      left
-			[Image.FLIP_LEFT_RIGHT],  # 2   top      right
-			[Image.ROTATE_180],  # 3   bottom   right
-			[Image.FLIP_TOP_BOTTOM],  # 4   bottom   left
-			[Image.FLIP_LEFT_RIGHT, Image.ROTATE_90],  # 5   left     top
-			[Image.ROTATE_270],  # 6   right    top
-			[Image.FLIP_TOP_BOTTOM, Image.ROTATE_90],  # 7   right    bottom
-			[Image.ROTATE_90],  # 8   left     bottom
-		]
-		
-		try:
-			seq = exif_transpose_sequences[img._getexif()[exif_orientation_tag]]
-		except:
-			return img
-		else:
-			return functools.reduce(type(img).transpose, seq, img)
-
-	def as_rotated_without_exif(self):
-		"""" Returns the image BytesIO object after adjusting the rotation to correct bad EXIF metadata """
-
-		# Adjust EXIF data by rotating image
-		img = self._correct_exif_rotation(Image.open(self))
-
-		# Remove EXIF data
-		img_data = list(img.getdata())
-		img = Image.new(img.mode, img.size)
-		img.putdata(img_data)
-
-		# Save to BytesIO object
-		output_file = io.BytesIO()
-		img.save(output_file, format=self.parent_field.format)
-		return output_file
+		preview = get_rendition_cache().get_or_create(
+			key=get_rendition_key(self.content_hash, self.parent_field.size, PREVIEW_FORMAT),
+			create_func=lambda: normalise_image(self.getvalue(), self.parent_field.size, PREVIEW_FORMAT)
+		)
+		return f'data:image/{PREVIEW_FORMAT.lower()};base64,{base64.b64encode(preview).decode()}'
+	
+	@property
+	def is_processed(self):
+		""" False for images stored as uploaded, until the image jobs worker has processed them (see ImageJob) """
+		hash_field = self.parent_field.hash_field
+		return self.instance is None or hash_field is None or getattr(self.instance, hash_field.attname) is not None
+	
+	@property
+	def url(self):
+		return super().url if self.is_processed else static(IMAGE_PLACEHOLDER_PATH)
+	
+	@property
+	def status_url(self):
+		""" Endpoint to poll while the image is being processed, None once it is """
+		return None if self.is_processed else self.parent_field.get_status_url(self.instance)
+	
+	@property
+	def srcset(self):
+		""" Stored renditions of the image, for <img srcset>; empty if the field has none or the image is not saved and processed yet """
+		if self.instance is None or self.instance.pk is None or not self.is_processed:
+			return ''
+		return self.parent_field.get_srcset(self.instance, self.content_hash)
+	
+	def get_served_bytes(self, format=None):
+		return self.get_normalised_bytes(format)
+	
+	def get_normalised_bytes(self, format=None):
+		""" Returns the normalised image (in the field's format by default), only generating it if not already in the rendition cache """
+		format = format or self.parent_field.format
+		return get_rendition_cache().get_or_create(
+			key=get_rendition_key(self.content_hash, self.parent_field.size, format),
+			create_func=lambda: normalise_image(self.getvalue(), self.parent_field.size, format)
+		)
+
 
+class ThumbnailBlob(ImageBlob):
+	""" Small copy of an image, stored already normalised so it can be served as is """
+	@property
+	def etag(self):
+		return self.content_hash
+	
+	def get_served_bytes(self):
+		return self.getvalue()
 
 
 class AudioBlob(BlobObject):
-	@property
-	def url(self):
-		return f'data:audio/mp3;base64,{base64.b64encode(self.getvalue()).decode()}'
+	content_type = 'audio/mpeg'
 
 # Field classes---------------------------------------------------------------------------------------------------------
 class DefaultCharField(models.CharField):
@@ -123,29 +135,208 @@ class DefaultCharField(models.CharField):
 		super().__init__(*args, **kwargs)
 
 
+class BlobDescriptor(DeferredAttribute):
+	"""
+		Binds blobs to the model instance they are accessed through, so that they can build their URL
+		Also keeps track of which blobs were assigned since the instance was loaded, in its _changed_blobs
+	"""
+	def __get__(self, instance, cls=None):
+		value = super().__get__(instance, cls)
+		if instance is not None and isinstance(value, BlobObject):
+			value.instance = instance
+		return value
+	
+	def __set__(self, instance, value):
+		if self.field.attname in instance.__dict__ and instance.__dict__[self.field.attname] is value:
+			return # e.g. forms setting back the initial value of a field which was not changed
+		instance.__dict__[self.field.attname] = value
+		instance.__dict__.setdefault('_changed_blobs', set()).add(self.field.attname)
+
+
 class BlobField(models.BinaryField):
+	descriptor_class = BlobDescriptor
+	streamed = False # if True, the blob is served in chunks straight from the blob store, as stored (so it must be content addressed)
+	negotiated = False # if True, the blob is an image served in the most compact format the browser accepts
+	deferred = True # if True, subject querysets only load the blob when it is accessed
+	content_addressed = True # if True, the blob is kept in the zoo's BLOBS table and the row references it by hash (see blob_store)
+	
 	def from_db_value(self, value, expression, connection):
+		""" Loads blobs referenced by hash from the blob store; those stored inline (i.e. not content addressed) are read as they are """
+		if isinstance(value, str):
+			content_hash, value = value, load_blob(connection, value)
+			if value is None:
+				return None
+			blob = self.obj_class(bytes=value, parent_field=self)
+			blob.__dict__['content_hash'] = content_hash # the reference is the hash, so there is no need to rehash the blob
+			return blob
 		return self.obj_class(bytes=value, parent_field=self) if value is not None else None
 	
+	def has_changed(self, model_instance):
+		""" Whether the blob was assigned since the instance was loaded or last saved """
+		return self.attname in model_instance.__dict__.get('_changed_blobs', ())
+	
+	def pre_save(self, model_instance, add):
+		""" Processes newly assigned blobs (unless the instance leaves it for later), replacing them with the blob as it will be stored """
+		value = super().pre_save(model_instance, add)
+		if value and not isinstance(value, BlobObject):
+			bytes = read_from_start(value)
+			if model_instance.process_blobs:
+				bytes = self.process_bytes(bytes)
+			value = self.obj_class(bytes=bytes, parent_field=self)
+			setattr(model_instance, self.attname, value)
+		return value or None
+	
 	def get_db_prep_value(self, value, connection, prepared=False):
-		return value.read() if value else None
+		""" Content-addressed blobs are added to the blob store (unless already there) and replaced by their hash """
+		if not value:
+			return None
+		if isinstance(value, BlobObject): # already processed, or loaded from the database
+			if self.content_addressed:
+				return store_blob(connection, value.getvalue(), value.content_hash)
+			return value.getvalue()
+		bytes = self.process_bytes(read_from_start(value))
+		return store_blob(connection, bytes) if self.content_addressed else bytes
+	
+	def process_bytes(self, bytes):
+		""" Converts the contents of a newly assigned file to the bytes to store """
+		return bytes
 	
 	def from_file(self, bytes_file):
 		""" Used to emulate field display normalisation """
 		return self.obj_class.from_file(bytes_file=bytes_file, parent_field=self)
+	
+	def get_path(self, model_instance, url_name='blob'):
+		""" Path of the blob-serving endpoint (or another blob endpoint) for this field of a saved subject """
+		return reverse(url_name, kwargs={
+			'zoo_id': model_instance._state.db,
+			'model_name': model_instance.get_type_str(),
+			'subject_id': model_instance.pk,
+			'field_name': self.name
+		})
+	
+	def get_status_url(self, model_instance):
+		return self.get_path(model_instance, url_name='blob_status')
 
 
 class ImageBlobField(BlobField):
+	"""
+		Image, stored losslessly in format (without its metadata) and served normalised to size, in the most compact format the browser accepts
+		:param renditions: widths of the scaled copies stored alongside the image (see ImageRendition), with the aspect ratio of size
+	"""
 	obj_class = ImageBlob
+	negotiated = True
 	
 	def __init__(self, *args, **kwargs):
 		self.size = kwargs.pop('size', None)
 		self.format = kwargs.pop('format', None)
+		self.renditions = tuple(kwargs.pop('renditions', ()))
 		super().__init__(*args, **kwargs)
-
-	def get_db_prep_value(self, value, connection, prepared=False):
-			return self.obj_class(bytes=value.read(), parent_field=self).as_rotated_without_exif().getvalue() if value else None
+	
+	@property
+	def content_type(self):
+		return get_content_type(self.format)
+	
+	@cached_property
+	def hash_field(self):
+		""" ContentHashField storing the hash of this image, by which its renditions are stored """
+		for field in self.model._meta.concrete_fields:
+			if isinstance(field, ContentHashField) and field.source == self.name:
+				return field
+		return None
+	
+	def process_bytes(self, bytes):
+		return strip_exif(bytes, self.format)
+	
+	# Renditions-----
+	def get_rendition_size(self, width):
+		return width, round(width * self.size[1] / self.size[0])
+	
+	def get_rendition_etag(self, source_hash, size, format=None):
+		return hashlib.sha256(get_rendition_key(source_hash, size, format or self.format).encode()).hexdigest()
+	
+	def get_url(self, model_instance, source_hash):
+		""" URL of the normalised image with the given hash, i.e. the ImageBlob url, without loading the image """
+		return self.get_path(model_instance) + f'?v={self.get_rendition_etag(source_hash, self.size)}'
+	
+	def create_rendition(self, image, width, format):
+		return normalise_image(image.getvalue(), self.get_rendition_size(width), format)
+	
+	def get_srcset(self, model_instance, source_hash):
+		""" srcset of all the declared renditions of the image with the given hash, versioned by it """
+		path = self.get_path(model_instance)
+		return ', '.join(f'{path}?w={width}&v={source_hash} {width}w' for width in self.renditions)
 
 
 class AudioBlobField(BlobField):
-	obj_class = AudioBlob
\ No newline at end of file
+	obj_class = AudioBlob
+	streamed = True
+
+
+class ThumbnailBlobField(ImageBlobField):
+	""" Normalised copy of another image field, small enough to be loaded along with lists of subjects """
+	obj_class = ThumbnailBlob
+	deferred = False
+	negotiated = False # small enough to be served as stored
+	content_addressed = False # small and derived from the image, so stored inline to be loaded along with its row
+	
+	def __init__(self, source, *args, **kwargs):
+		self.source = source
+		kwargs.setdefault('editable', False)
+		kwargs.setdefault('null', True)
+		super().__init__(*args, **kwargs)
+	
+	def deconstruct(self):
+		name, path, args, kwargs = super().deconstruct()
+		kwargs.update({'source': self.source, 'size': self.size, 'format': self.format})
+		return name, path, args, kwargs
+	
+	def has_changed(self, model_instance):
+		return super().has_changed(model_instance) or model_instance._meta.get_field(self.source).has_changed(model_instance)
+	
+	def pre_save(self, model_instance, add):
+		""" Regenerates the thumbnail if the source image changed (or clears it, if the image is left to be processed later) """
+		if model_instance._meta.get_field(self.source).has_changed(model_instance):
+			thumbnail = self.create_thumbnail(getattr(model_instance, self.source)) if model_instance.process_blobs else None
+			setattr(model_instance, self.attname, thumbnail)
+		return super().pre_save(model_instance, add)
+	
+	def create_thumbnail(self, image):
+		if not image:
+			return None
+		return self.obj_class(bytes=self.process_bytes(read_from_start(image)), parent_field=self)
+	
+	def process_bytes(self, bytes):
+		return normalise_image(bytes, self.size, self.format)
+
+
+class ContentHashField(models.CharField):
+	""" SHA-256 of a blob field, kept up to date on save so that what is derived from the blob can be found without loading it """
+	def __init__(self, source, *args, **kwargs):
+		self.source = source
+		kwargs.setdefault('max_length', 64)
+		kwargs.setdefault('editable', False)
+		kwargs.setdefault('null', True)
+		super().__init__(*args, **kwargs)
+	
+	def deconstruct(self):
+		name, path, args, kwargs = super().deconstruct()
+		kwargs['source'] = self.source
+		return name, path, args, kwargs
+	
+	def pre_save(self, model_instance, add):
+		"""
+			Rehashes the source blob if it changed (it has already been processed, as it is declared before this field)
+			Blobs left to be processed later have no hash until they are
+		"""
+		if model_instance._meta.get_field(self.source).has_changed(model_instance):
+			blob = getattr(model_instance, self.source)
+			setattr(model_instance, self.attname, blob.content_hash if blob and model_instance.process_blobs else None)
+		return super().pre_save(model_instance, add)
+
+
+def read_from_start(file):
+	""" Reads the whole of a file, whatever its current position, leaving it at the start so it can be read again """
+	file.seek(0)
+	bytes = file.read()
+	file.seek(0)
+	return bytes
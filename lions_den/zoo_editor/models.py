@@ -1,17 +1,27 @@
 import enum
+import datetime
 
 from abc import abstractmethod
 
-from django.db import models
+from django.db import models, connections, transaction
+from django.db.models import Q, F, Value
 from django.db.models.functions import Lower
+from django.templatetags.static import static
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 # noinspection PyUnresolvedReferences
 from zoo_auth.models import Zoo
 
-from .model_fields import DefaultCharField, ImageBlobField, AudioBlobField
+from .model_fields import DefaultCharField, BlobField, ImageBlobField, ThumbnailBlobField, AudioBlobField, ContentHashField, IMAGE_PLACEHOLDER_PATH
+from .utils.blob_store import collect_garbage
+from .utils.image_pipeline import get_served_formats
 from .utils.qrcode_creator import create_request_qrcode
 
 
+SUBJECTS_PAGE_SIZE = 24 # even, as subject tables have 2 subjects per row
+
+
 class Gender(enum.Enum):
 	MALE = 'M'
 	FEMALE = 'F'
@@ -20,32 +30,173 @@ class Gender(enum.Enum):
 class AbstractBaseModel(models.Model):
 	id = models.AutoField(db_column='_id', primary_key=True)
 	
+	process_blobs = True # if False, newly assigned blobs are stored as uploaded, for processing outside of the request
+	
 	class Meta:
 		abstract = True
 	
 	@property
 	def zoo(self):
 		assert self._state.db is not None, f'{self} does not belong to any zoo'
-		return Zoo.objects.filter(id=self._state.db).first()
+		return Zoo.objects.get_cached(self._state.db)
+	
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance = super().from_db(db, field_names, values)
+		instance._changed_blobs = set() # blobs were assigned while building the instance, but have not changed
+		return instance
+	
+	def refresh_from_db(self, using=None, fields=None):
+		super().refresh_from_db(using=using, fields=fields)
+		if fields is None:
+			self._changed_blobs = set()
+		else:
+			self.__dict__.get('_changed_blobs', set()).difference_update(fields)
+	
+	def save(self, *args, **kwargs):
+		""" Leaves blobs which have not changed since they were loaded out of UPDATEs, so they are neither re-processed nor rewritten """
+		update_fields = kwargs.get('update_fields')
+		if not args and update_fields is None and not self._state.adding and kwargs.get('using', self._state.db) == self._state.db:
+			unchanged_blobs = {
+				field.attname for field in self._meta.concrete_fields
+				if isinstance(field, BlobField) and field.attname in self.__dict__ and not field.has_changed(self)
+			}
+			if unchanged_blobs:
+				deferred_fields = self.get_deferred_fields()
+				update_fields = kwargs['update_fields'] = [
+					field.attname for field in self._meta.concrete_fields
+					if not field.primary_key and field.attname not in deferred_fields | unchanged_blobs
+				]
+		super().save(*args, **kwargs)
+		
+		if update_fields is None:
+			self._changed_blobs = set()
+		else:
+			self.__dict__.get('_changed_blobs', set()).difference_update(update_fields)
+
+
+class SubjectQuerySet(models.QuerySet):
+	def after(self, cursor=None):
+		""" Subjects ordered by (lower(name), id), starting after the given (lower(name), id) cursor """
+		queryset = self.annotate(lower_name=Lower('name')).order_by('lower_name', 'id')
+		if cursor:
+			lower_name, subject_id = cursor
+			# the redundant lower_name__gte lets the lower(name) index seek straight to the cursor
+			queryset = queryset.filter(Q(lower_name__gt=lower_name) | Q(id__gt=subject_id), lower_name__gte=lower_name)
+		return queryset
+	
+	def page(self, after=None, size=SUBJECTS_PAGE_SIZE):
+		"""
+			Keyset pagination over (lower(name), id), so fetching a page costs the same wherever it is in the list
+			:param after: cursor returned with the previous page, or None for the first one
+			:return: list of subjects in the page, and the cursor of the next page (None if this is the last one)
+		"""
+		subjects = list(self.after(after)[:size + 1])
+		if len(subjects) <= size:
+			return subjects, None
+		subjects = subjects[:size]
+		return subjects, (subjects[-1].lower_name, subjects[-1].id)
 
 
-class SubjectManager(models.Manager):
+class SubjectManager(models.Manager.from_queryset(SubjectQuerySet)):
 	def get_queryset(self):
-		return super().get_queryset().order_by(Lower('name'))
+		""" Subjects without their blobs, which are only loaded when accessed (use defer(None) to load them upfront) """
+		deferred_fields = [field.name for field in self.model._meta.concrete_fields if isinstance(field, BlobField) and field.deferred]
+		return super().get_queryset().defer(*deferred_fields).order_by(Lower('name'), 'id')
 
 
 class Subject(AbstractBaseModel):
 	name = DefaultCharField(unique=True)
-	image = ImageBlobField(size=(256, 192), format='PNG', editable=True, null=True, blank=False)
+	image = ImageBlobField(size=(256, 192), format='PNG', renditions=(64, 128, 256, 512), editable=True, null=True, blank=False)
+	thumbnail = ThumbnailBlobField(source='image', size=(160, 120), format='JPEG')
+	image_hash = ContentHashField(source='image')
 	
 	objects = SubjectManager()
 	
+	queue_renditions = False # if True, the renditions of a newly assigned image are generated by an ImageJob rather than on save
+	
 	class Meta:
 		abstract = True
 	
 	def __str__(self):
 		return self.name
 	
+	def save(self, *args, **kwargs):
+		"""
+			Also stores the renditions of a newly assigned image (or queues an ImageJob to, if queue_renditions or not process_blobs),
+			and deletes those of the image it replaced, as well as replaced blobs, if no longer used
+		"""
+		image_changed = self._meta.get_field('image').has_changed(self)
+		previous_image_hash = self.image_hash if image_changed and not self._state.adding else None
+		blobs_replaced = not self._state.adding and any(
+			field.content_addressed and field.has_changed(self) for field in self._meta.concrete_fields if isinstance(field, BlobField)
+		)
+		with transaction.atomic(using=kwargs.get('using') or self._state.db):
+			super().save(*args, **kwargs)
+			if blobs_replaced:
+				collect_garbage(connections[self._state.db])
+		if image_changed:
+			renditions = ImageRendition.objects.db_manager(self._state.db)
+			if self.image and self.process_blobs and not self.queue_renditions:
+				renditions.create_renditions(self.image)
+			elif self.image:
+				ImageJob.objects.db_manager(self._state.db).enqueue(self)
+			if previous_image_hash and previous_image_hash != self.image_hash:
+				renditions.delete_unused([previous_image_hash])
+	
+	def process_image(self):
+		"""
+			Processes an image stored as uploaded, as saving it would have, unless it was replaced meanwhile
+			:return: whether the image was processed
+		"""
+		raw_image = self.image
+		if not raw_image or self.image_hash:
+			return False
+		image_field, thumbnail_field = self._meta.get_field('image'), self._meta.get_field('thumbnail')
+		image = image_field.obj_class(bytes=image_field.process_bytes(raw_image.getvalue()), parent_field=image_field)
+		thumbnail = thumbnail_field.create_thumbnail(image)
+		
+		# only if the same upload is still waiting (i.e. the row still references it), so that a newer one is neither overwritten nor lost
+		raw_image_ref = Value(raw_image.content_hash, output_field=models.CharField())
+		with transaction.atomic(using=self._state.db):
+			updated = type(self).objects.using(self._state.db).filter(id=self.id, image_hash__isnull=True, image=raw_image_ref).update(
+				image=image, thumbnail=thumbnail, image_hash=image.content_hash
+			)
+			collect_garbage(connections[self._state.db])
+		if updated:
+			ImageRendition.objects.db_manager(self._state.db).create_renditions(image)
+		return bool(updated)
+	
+	def delete(self, *args, **kwargs):
+		""" Also deletes the renditions and blobs no longer used, including those of subjects deleted along with this one """
+		db = self._state.db
+		with transaction.atomic(using=db):
+			result = super().delete(*args, **kwargs)
+			collect_garbage(connections[db])
+		ImageRendition.objects.db_manager(db).delete_unused()
+		return result
+	
+	@property
+	def thumbnail_url(self):
+		""" Falls back to a placeholder while the image is being processed """
+		if self.thumbnail:
+			return self.thumbnail.url
+		return static(IMAGE_PLACEHOLDER_PATH)
+	
+	@property
+	def image_status_url(self):
+		""" Endpoint to poll while the image may be being processed (i.e. it has no thumbnail yet), None otherwise """
+		if self.image_hash or self.thumbnail:
+			return None
+		return self._meta.get_field('image').get_status_url(self)
+	
+	@property
+	def image_srcset(self):
+		""" Renditions of the image for <img srcset>, built from the stored hash so the image itself is not loaded """
+		if not self.image_hash:
+			return ''
+		return self._meta.get_field('image').get_srcset(self, self.image_hash)
+	
 	def has_max_attributes(self):
 		return len(self.attributes.all()) == len(AttributeCategory.objects.using(self.zoo.id).all())
 	
@@ -61,11 +212,13 @@ class Subject(AbstractBaseModel):
 	@abstractmethod
 	def form(self, *args, **kwargs): pass
 	
+	@cached_property
 	def qr_code(self):
+		zoo = self.zoo
 		return create_request_qrcode(
-			zoo=self.zoo,
+			zoo=zoo,
 			request = {
-				'zoo': self.zoo.id,
+				'zoo': zoo.id,
 				'type': self.__class__.get_type_str(),
 				'id': self.id
 			}
@@ -131,6 +284,113 @@ class Group(Subject):
 		return GroupForm(*args, **kwargs)
 
 
+class ImageRenditionManager(models.Manager):
+	def get_data(self, source_hash, width, format):
+		return self.filter(source_hash=source_hash, width=width, format=format).values_list('data', flat=True).first()
+	
+	def create_renditions(self, image, widths=None, format=None):
+		"""
+			Generates and stores the renditions of a saved image which are not stored yet
+			:param widths: widths to generate (defaults to all those declared by the image field)
+			:param format: format to generate them in (defaults to the most compact one served; others are generated when first requested)
+			:return: dict of the bytes of the generated renditions, by width
+		"""
+		field = image.parent_field
+		widths = field.renditions if widths is None else widths
+		format = format or get_served_formats()[0]
+		stored_widths = set(self.filter(source_hash=image.content_hash, format=format, width__in=widths).values_list('width', flat=True))
+		renditions = [
+			self.model(source_hash=image.content_hash, width=width, format=format, data=field.create_rendition(image, width, format))
+			for width in widths if width not in stored_widths
+		]
+		self.bulk_create(renditions, ignore_conflicts=True) # the same renditions may have just been stored by another request
+		return {rendition.width: rendition.data for rendition in renditions}
+	
+	def delete_unused(self, source_hashes=None):
+		""" Deletes the renditions of the given images (defaults to all of them) which no subject uses anymore """
+		queryset = self.all() if source_hashes is None else self.filter(source_hash__in=source_hashes)
+		for model in (Species, Individual, Group):
+			queryset = queryset.exclude(source_hash__in=model.objects.using(self.db).filter(image_hash__isnull=False).values('image_hash'))
+		return queryset.delete()
+
+
+class ImageRendition(AbstractBaseModel):
+	""" Scaled copy of a subject image, stored by the hash of the image so subjects with the same image share it """
+	source_hash = models.CharField(max_length=64)
+	width = models.PositiveIntegerField()
+	format = models.CharField(max_length=8)
+	data = models.BinaryField()
+	
+	objects = ImageRenditionManager()
+	
+	class Meta:
+		db_table = 'IMAGE_RENDITIONS'
+		unique_together = (('source_hash', 'width', 'format'),)
+
+
+class ImageJobManager(models.Manager):
+	def enqueue(self, subject):
+		""" Queues the processing of the image of a subject, unless already queued (the job processes whichever upload is latest) """
+		return self.get_or_create(subject_type=subject.get_type_str(), subject_id=subject.id, status=ImageJob.Status.PENDING)[0]
+	
+	def get_for_subject(self, subject_type, subject_id):
+		return self.filter(subject_type=subject_type, subject_id=subject_id).order_by('-id').first()
+	
+	def claim_next(self):
+		""" Marks the oldest pending job as running and returns it, or None if there are none; safe across worker processes """
+		for job in self.filter(status=ImageJob.Status.PENDING).order_by('id')[:10]:
+			if self.filter(id=job.id, status=ImageJob.Status.PENDING).update(status=ImageJob.Status.RUNNING, attempts=F('attempts') + 1, updated=timezone.now()):
+				job.refresh_from_db()
+				return job
+		return None
+	
+	def requeue_stale(self, timeout):
+		""" Puts back jobs left running for longer than timeout seconds, e.g. by a worker which was killed """
+		stale_time = timezone.now() - datetime.timedelta(seconds=timeout)
+		return self.filter(status=ImageJob.Status.RUNNING, updated__lt=stale_time).update(status=ImageJob.Status.PENDING, updated=timezone.now())
+
+
+class ImageJob(AbstractBaseModel):
+	""" Renditions (and processing, if stored as uploaded) of a subject image, done by the process_image_jobs command rather than on save """
+	class Status(models.TextChoices):
+		PENDING = 'pending'
+		RUNNING = 'running'
+		FAILED = 'failed' # done jobs are deleted
+	
+	subject_type = models.CharField(max_length=16)
+	subject_id = models.IntegerField()
+	status = models.CharField(max_length=8, choices=Status.choices, default=Status.PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	error = models.TextField(blank=True)
+	created = models.DateTimeField(auto_now_add=True)
+	updated = models.DateTimeField(auto_now=True)
+	
+	objects = ImageJobManager()
+	
+	class Meta:
+		db_table = 'IMAGE_JOBS'
+		indexes = [
+			models.Index(fields=['status', 'id'], name='IMAGE_JOBS_STATUS'),
+			models.Index(fields=['subject_type', 'subject_id'], name='IMAGE_JOBS_SUBJECT'),
+		]
+	
+	def run(self, max_attempts):
+		""" Processes the image, deleting the job if done, or putting it back (or failing it after max_attempts) if not """
+		model = SUBJECT_MODELS[self.subject_type]
+		try:
+			subject = model.objects.using(self._state.db).defer(None).filter(id=self.subject_id).first()
+			# else the subject was deleted meanwhile; processing an image stored as uploaded also generates its renditions
+			if subject is not None and not subject.process_image() and subject.image_hash:
+				ImageRendition.objects.db_manager(self._state.db).create_renditions(subject.image)
+		except Exception as e:
+			self.status = self.Status.FAILED if self.attempts >= max_attempts else self.Status.PENDING
+			self.error = repr(e)
+			self.save()
+			return False
+		self.delete()
+		return True
+
+
 class AttributeCategory(AbstractBaseModel):
 	name = DefaultCharField()
 	position = models.PositiveIntegerField(unique=True)
@@ -178,3 +438,6 @@ class GroupAttribute(AbstractAttribute):
 	
 	class Meta:
 		db_table = 'GROUPS_ATTRIBUTES'
+
+
+SUBJECT_MODELS = {model.get_type_str(): model for model in (Species, Individual, Group)}
@@ -1,3 +1,777 @@
-from django.test import TestCase
+import io
+import time
+import itertools
+import base64
+import zipfile
+import datetime
+import tempfile
+import threading
+from unittest import mock, skipUnless
+from pathlib import Path
+from PIL import Image
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections, OperationalError
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+# noinspection PyUnresolvedReferences
+from main.databases import ZooDatabases, DEFAULT_PRAGMAS, close_idle_zoo_connections
+# noinspection PyUnresolvedReferences
+from main.test_runner import TEST_ZOO_ID
+# noinspection PyUnresolvedReferences
+from zoo_auth.models import Zoo, ZooUser, ZOO_ACCESS_CACHE_TIMEOUT, get_accessible_zoos_cache_key
+
+from .models import Species, Group, ImageRendition, ImageJob
+from .model_fields import ImageBlobField
+from . import zoo_schema
+from .management.commands.process_image_jobs import run_worker
+from .utils import blob_response, encryption, image_pipeline, qrcode_creator, qrcode_export
+from .utils.blob_store import BLOBS_TABLE
+from .utils.blob_stream import SQLiteBlobReader
+from .utils.rendition_cache import RenditionCache
+
+
+class ImagePipelineTests(SimpleTestCase):
+	@staticmethod
+	def create_jpeg(size=(1600, 1200), orientation=None):
+		""" JPEG with a red left half and a blue right half, with the given EXIF orientation """
+		img = Image.new('RGB', size, (0, 0, 255))
+		img.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+		exif = Image.Exif()
+		if orientation:
+			exif[image_pipeline.EXIF_ORIENTATION_TAG] = orientation
+		jpeg_file = io.BytesIO()
+		img.save(jpeg_file, format='JPEG', exif=exif.tobytes(), comment=b'metadata')
+		return jpeg_file.getvalue()
+	
+	def test_normalise_image(self):
+		img = Image.open(io.BytesIO(image_pipeline.normalise_image(self.create_jpeg(), (256, 192), 'PNG')))
+		self.assertEqual((img.size, img.mode), ((256, 192), 'RGBA'))
+		self.assertGreater(img.getpixel((10, 96))[0], 250) # red, give or take JPEG artifacts
+		self.assertGreater(img.getpixel((246, 96))[2], 250)
+		self.assertNotIn('exif', img.info)
+	
+	def test_exif_orientation_applied(self):
+		# orientation 6 means the image must be rotated clockwise, so the red half ends up on top
+		data = self.create_jpeg(orientation=6)
+		img = Image.open(io.BytesIO(image_pipeline.strip_exif(data, 'PNG')))
+		self.assertEqual(img.size, (1200, 1600))
+		self.assertGreater(img.getpixel((600, 10))[0], 250)
+		self.assertFalse(img.getexif())
+		
+		img = Image.open(io.BytesIO(image_pipeline.normalise_image(data, (160, 120), 'JPEG')))
+		self.assertEqual((img.size, img.mode), ((160, 120), 'RGB'))
+		self.assertGreater(img.getpixel((80, 5))[0], 200)
+		self.assertGreater(img.getpixel((80, 115))[2], 200)
+	
+	def test_jpeg_decoded_at_reduced_scale(self):
+		img = image_pipeline.open_image(self.create_jpeg(), min_size=(256, 192))
+		img.load()
+		self.assertEqual(img.size, (400, 300))
+	
+	def test_served_format_chosen_by_accept_header(self):
+		with mock.patch.object(image_pipeline, 'get_served_formats', return_value=['AVIF', 'WEBP', 'JPEG']):
+			self.assertEqual(image_pipeline.choose_served_format('image/avif,image/webp,image/apng,image/*,*/*;q=0.8'), 'AVIF')
+			self.assertEqual(image_pipeline.choose_served_format('image/webp,*/*'), 'WEBP')
+			self.assertEqual(image_pipeline.choose_served_format('image/avif;q=0, image/webp'), 'WEBP')
+			self.assertEqual(image_pipeline.choose_served_format('image/png,image/*;q=0.8'), 'JPEG')
+			self.assertEqual(image_pipeline.choose_served_format(None), 'JPEG')
+
+
+class RenditionCacheTests(SimpleTestCase):
+	def test_concurrent_creations_coalesced(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			rendition_cache = RenditionCache(path=f'{temp_dir}/renditions.sqlite3')
+			create_func = mock.Mock(side_effect=lambda: time.sleep(0.1) or b'rendition')
+			results = []
+			threads = [threading.Thread(target=lambda: results.append(rendition_cache.get_or_create('key', create_func))) for _ in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			
+			self.assertEqual(results, [b'rendition'] * 4)
+			create_func.assert_called_once()
+			self.assertFalse(rendition_cache._creation_locks)
+	
+	def test_memory_tier_evicts_least_recently_used(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			rendition_cache = RenditionCache(path=f'{temp_dir}/renditions.sqlite3', max_memory_items=2)
+			rendition_cache.set('lion', b'roar')
+			rendition_cache.set('tiger', b'growl')
+			self.assertEqual(rendition_cache.get('lion'), b'roar')
+			rendition_cache.set('wolf', b'howl') # evicts the tiger, which was used the longest ago, from memory only
+			
+			self.assertEqual(list(rendition_cache._memory), ['lion', 'wolf'])
+			self.assertEqual(rendition_cache.get('tiger'), b'growl')
+			self.assertIsNone(rendition_cache.get('bear'))
+			self.assertEqual(rendition_cache.stats(), {
+				'memory_hits': 1, 'disk_hits': 1, 'misses': 1, 'memory_items': 2, 'disk_items': 3, 'disk_bytes': 13,
+			})
+	
+	def test_disk_tier_shared_and_evicted_by_last_access(self):
+		with tempfile.TemporaryDirectory() as temp_dir, mock.patch('time.time', side_effect=itertools.count()):
+			rendition_cache = RenditionCache(path=f'{temp_dir}/renditions.sqlite3', max_memory_items=0, max_disk_bytes=25)
+			rendition_cache.set('lion', b'0' * 10)
+			rendition_cache.set('tiger', b'1' * 10)
+			self.assertEqual(rendition_cache.get('lion'), b'0' * 10) # now accessed more recently than the tiger
+			rendition_cache.set('wolf', b'2' * 10)
+			
+			other_process_cache = RenditionCache(path=f'{temp_dir}/renditions.sqlite3')
+			self.assertEqual([other_process_cache.get(key) for key in ('lion', 'tiger', 'wolf')], [b'0' * 10, None, b'2' * 10])
+			self.assertEqual(
+				{key: other_process_cache.stats()[key] for key in ('disk_hits', 'misses', 'disk_items', 'disk_bytes')},
+				{'disk_hits': 2, 'misses': 1, 'disk_items': 2, 'disk_bytes': 20}
+			)
+
+
+class ZooDatabasesTests(SimpleTestCase):
+	def setUp(self):
+		temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(temp_dir.cleanup)
+		self.zoos_dir = Path(temp_dir.name) / 'zoos'
+		self.zoos_dir.mkdir()
+		for zoo_id in ('lion', 'tiger'):
+			(self.zoos_dir / f'{zoo_id}.sqlite3').touch()
+		(self.zoos_dir.parent / 'secret.sqlite3').touch()
+	
+	def create_zoo_databases(self, **kwargs):
+		return ZooDatabases(databases={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}, zoos_dir=self.zoos_dir, **kwargs)
+	
+	def connect(self, zoo_databases, zoo_id):
+		""" Connects to a zoo database through connections of its own, as django.db.connections would with zoo_databases as DATABASES """
+		zoo_connections = ConnectionHandler(zoo_databases)
+		self.addCleanup(zoo_connections.close_all)
+		with zoo_connections[zoo_id].cursor() as cursor:
+			cursor.execute('SELECT 1')
+		return zoo_connections
+	
+	def test_zoos_discovered_on_first_use(self):
+		zoo_databases = self.create_zoo_databases()
+		self.assertEqual(list(zoo_databases), ['default'])
+		self.assertIn('lion', zoo_databases)
+		self.assertEqual((zoo_databases['lion']['ENGINE'], zoo_databases['lion']['NAME']), ('main.zoo_sqlite3', self.zoos_dir / 'lion.sqlite3'))
+		self.assertEqual(list(zoo_databases), ['default', 'lion'])
+		
+		self.assertNotIn('bear', zoo_databases)
+		self.assertIsNone(zoo_databases.get('bear'))
+		with self.assertRaises(KeyError):
+			zoo_databases['bear']
+		self.assertEqual(zoo_databases.discover_all(), ['lion', 'tiger'])
+	
+	def test_invalid_aliases_rejected(self):
+		zoo_databases = self.create_zoo_databases()
+		for alias in ('../secret', 'lion.sqlite3', 'lion/', '', None, 1):
+			with self.subTest(alias=alias):
+				self.assertNotIn(alias, zoo_databases)
+				self.assertIsNone(zoo_databases.discover(alias))
+	
+	def test_idle_connections_closed(self):
+		zoo_connections = self.connect(self.create_zoo_databases(idle_timeout=300), 'lion')
+		zoo_connections['default'].ensure_connection()
+		with mock.patch('django.db.connections', zoo_connections):
+			close_idle_zoo_connections()
+			self.assertIsNotNone(zoo_connections['lion'].connection)
+			with mock.patch('time.monotonic', return_value=time.monotonic() + 301):
+				close_idle_zoo_connections()
+		self.assertIsNone(zoo_connections['lion'].connection)
+		self.assertIsNotNone(zoo_connections['default'].connection) # has no IDLE_TIMEOUT
+	
+	def get_pragmas(self, zoo_connections, zoo_id):
+		with zoo_connections[zoo_id].cursor() as cursor:
+			return {
+				name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+				for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout')
+			}
+	
+	def test_pragmas_applied_on_connection(self):
+		zoo_connections = self.connect(self.create_zoo_databases(busy_timeout=20), 'lion')
+		self.assertEqual(self.get_pragmas(zoo_connections, 'lion'), {
+			'journal_mode': 'wal', 'synchronous': 1, 'mmap_size': DEFAULT_PRAGMAS['mmap_size'], 'cache_size': DEFAULT_PRAGMAS['cache_size'],
+			'busy_timeout': 20000,
+		}) # synchronous=NORMAL is 1
+	
+	def test_zoo_overrides_applied(self):
+		zoo_databases = self.create_zoo_databases(zoo_overrides={'lion': {'PRAGMAS': {'cache_size': -64 * 1024}, 'OPTIONS': {'timeout': 5}}})
+		zoo_connections = self.connect(zoo_databases, 'lion')
+		lion_pragmas = self.get_pragmas(zoo_connections, 'lion')
+		self.assertEqual((lion_pragmas['cache_size'], lion_pragmas['busy_timeout'], lion_pragmas['journal_mode']), (-64 * 1024, 5000, 'wal'))
+		self.assertEqual(self.get_pragmas(zoo_connections, 'tiger')['cache_size'], DEFAULT_PRAGMAS['cache_size'])
+
+
+class ZooTestCase(TestCase):
+	""" Provides a zoo with its own database and a user with access to it """
+	databases = {'default', TEST_ZOO_ID}
+	
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = ZooUser.objects.create_user(email='keeper@zooverse.org', password='password')
+		cls.zoo = Zoo.objects.create(id=TEST_ZOO_ID, name='Test Zoo', encryption_key='0' * 30, image='zoo.png', last_commit_date=datetime.date.today())
+		cls.zoo.users.add(cls.user)
+		zoo_schema.migrate_zoo(TEST_ZOO_ID) # e.g. for the blob store, which has no model
+	
+	def setUp(self):
+		cache.clear() # cached zoo access would otherwise outlive the rolled back test data
+		self.client.force_login(self.user)
+
+
+class ZooCacheTests(ZooTestCase):
+	def test_subject_page_default_db_queries(self):
+		species = Species(name='Lion')
+		species.save(using=TEST_ZOO_ID)
+		
+		# session, user, zoo, bell icon notifications (the user's zoos are cached from the first request)
+		self.client.get(f'/zoos/{TEST_ZOO_ID}/species/{species.id}')
+		with self.assertNumQueries(4, using='default'):
+			response = self.client.get(f'/zoos/{TEST_ZOO_ID}/species/{species.id}')
+		self.assertEqual(response.status_code, 200)
+	
+	def test_zoo_fetched_once_per_request(self):
+		species = Species(name='Lion')
+		species.save(using=TEST_ZOO_ID)
+		
+		with Zoo.objects.request_scope():
+			self.assertIs(species.zoo, species.zoo)
+		self.assertIsNot(species.zoo, species.zoo)
+	
+	def test_zoo_invalidated_on_save(self):
+		with Zoo.objects.request_scope():
+			zoo = Zoo.objects.get_cached(TEST_ZOO_ID)
+			zoo.save()
+			self.assertIsNot(Zoo.objects.get_cached(TEST_ZOO_ID), zoo)
+
+
+class QRCodeCacheTests(ZooTestCase):
+	def get_qr_code(self, species_id):
+		return Species.objects.using(TEST_ZOO_ID).get(id=species_id).qr_code # a new instance, so its cached_property is not reused
+	
+	def test_qr_code_cached_per_request_and_key(self):
+		lion, tiger = Species(name='Lion'), Species(name='Tiger')
+		lion.save(using=TEST_ZOO_ID)
+		tiger.save(using=TEST_ZOO_ID)
+		with mock.patch.object(qrcode_creator, 'create_request_qrcode_png', wraps=qrcode_creator.create_request_qrcode_png) as create_png:
+			lion_qr_code = self.get_qr_code(lion.id)
+			self.assertEqual(self.get_qr_code(lion.id), lion_qr_code)
+			self.assertNotEqual(self.get_qr_code(tiger.id), lion_qr_code)
+		self.assertEqual(create_png.call_count, 2)
+	
+	def test_qr_codes_invalidated_when_key_changes(self):
+		species = Species(name='Lion')
+		species.save(using=TEST_ZOO_ID)
+		qr_code = self.get_qr_code(species.id)
+		self.zoo.encryption_key = '1' * 30
+		self.zoo.save()
+		self.assertNotEqual(self.get_qr_code(species.id), qr_code)
+
+
+class QRCodeExportTests(ZooTestCase):
+	def create_subjects(self):
+		species = [Species(name=f'Species {i:02}') for i in range(12)]
+		for subject in species:
+			subject.save(using=TEST_ZOO_ID)
+		group = Group(name='Pride')
+		group.save(using=TEST_ZOO_ID)
+		return species, group
+	
+	def test_zip_with_sheets(self):
+		species, group = self.create_subjects()
+		response = self.client.get(f'/zoos/{TEST_ZOO_ID}/qrcodes/?sheets')
+		self.assertEqual(response['Content-Disposition'], f'attachment; filename="QR-codes-{TEST_ZOO_ID}.zip"')
+		zip_file = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+		
+		self.assertEqual(zip_file.namelist(), [
+			*(f'species/{subject.id}-Species_{i:02}.png' for i, subject in enumerate(species)),
+			'sheets/sheet-001.png', # written as soon as the 12 species fill it
+			f'group/{group.id}-Pride.png',
+			'sheets/sheet-002.png',
+		])
+		self.assertEqual(
+			zip_file.read(f'group/{group.id}-Pride.png'),
+			qrcode_creator.create_request_qrcode_png(self.zoo.encryption_key, {'zoo': TEST_ZOO_ID, 'type': 'group', 'id': group.id})
+		)
+		for name in ('sheets/sheet-001.png', 'sheets/sheet-002.png'):
+			self.assertEqual(Image.open(io.BytesIO(zip_file.read(name))).size, qrcode_export.SHEET_SIZE)
+	
+	def test_process_pool_keeps_order(self):
+		self.create_subjects()
+		self.assertEqual(list(qrcode_export.iter_qrcodes(self.zoo, processes=2)), list(qrcode_export.iter_qrcodes(self.zoo)))
+
+
+class SubjectsPaginationTests(ZooTestCase):
+	def test_pages_cover_all_subjects_in_order(self):
+		names = [f'{prefix}{i:02}' for i in range(30) for prefix in ('lion', 'Lion')]
+		for name in names:
+			Species(name=name).save(using=TEST_ZOO_ID)
+		
+		subjects, after = [], None
+		while True:
+			page, after = Species.objects.using(TEST_ZOO_ID).page(after=after, size=8)
+			subjects += page
+			if after is None:
+				break
+		self.assertEqual([subject.name for subject in subjects], [species.name for species in Species.objects.using(TEST_ZOO_ID)])
+		self.assertEqual(len(subjects), len(names))
+	
+	def test_load_more(self):
+		for i in range(30):
+			Species(name=f'Species {i:02}').save(using=TEST_ZOO_ID)
+		
+		response = self.client.get(f'/zoos/{TEST_ZOO_ID}/species/')
+		self.assertEqual(len(response.context['subjects']), 24)
+		response = self.client.get(
+			f'/zoos/{TEST_ZOO_ID}/species/?subjects_page&{response.context["next_page_query"]}',
+			HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+		)
+		self.assertEqual(response.json()['rows'].count('<td>'), 6)
+		self.assertIsNone(response.json()['next_page_query'])
+
+
+class SubjectImageTestCase(ZooTestCase):
+	""" Provides image files to save as subject images """
+	@staticmethod
+	def create_image_file(size=(1200, 900), color=(200, 100, 50), exif=False):
+		image_file = io.BytesIO()
+		metadata = Image.Exif()
+		if exif:
+			metadata[0x010F] = 'Zoo Camera' # Make
+		Image.new('RGB', size, color).save(image_file, format='JPEG', exif=metadata.tobytes())
+		image_file.seek(0)
+		return image_file
+
+
+class SubjectThumbnailTests(SubjectImageTestCase):
+	def test_thumbnail_generated_on_save(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		self.assertEqual(Image.open(species.thumbnail).size, (160, 120))
+		self.assertEqual(Image.open(species.image).size, (1200, 900))
+	
+	def test_subject_lists_defer_blobs(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		self.assertEqual(species.get_deferred_fields(), {'image', 'audio'})
+		with self.assertNumQueries(0, using=TEST_ZOO_ID):
+			self.assertIn('/thumbnail?v=', species.thumbnail_url)
+
+
+class BlobChangeTrackingTests(SubjectImageTestCase):
+	def test_unchanged_blobs_not_rewritten(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion')
+		species.weight = '190kg'
+		with mock.patch.object(ImageBlobField, 'process_bytes') as process_bytes, CaptureQueriesContext(connections[TEST_ZOO_ID]) as queries:
+			species.save()
+		process_bytes.assert_not_called()
+		self.assertNotIn('"image"', queries[-1]['sql'])
+		self.assertNotIn('"thumbnail"', queries[-1]['sql'])
+	
+	def test_changed_image_saved(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion')
+		old_thumbnail_hash = species.thumbnail.content_hash
+		species.image = self.create_image_file(size=(600, 900), color=(50, 100, 200))
+		species.save()
+		
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion')
+		self.assertEqual(Image.open(species.image).size, (600, 900))
+		self.assertNotEqual(species.thumbnail.content_hash, old_thumbnail_hash)
+	
+	def test_form_without_new_image(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion')
+		form = Species.form(data={'name': 'Lion', 'weight': '190kg', 'size': ''}, files={}, instance=species)
+		self.assertTrue(form.is_valid(), form.errors)
+		with mock.patch.object(ImageBlobField, 'process_bytes') as process_bytes:
+			form.save()
+		process_bytes.assert_not_called()
+		self.assertEqual(Species.objects.using(TEST_ZOO_ID).get(name='Lion').weight, '190kg')
+
+
+class BlobViewTests(SubjectImageTestCase):
+	def setUp(self):
+		super().setUp()
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		self.species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		self.url = self.species.thumbnail_url
+		self.etag = f'"{self.species.thumbnail.etag}"'
+	
+	def test_cached_and_revalidated(self):
+		response = self.client.get(self.url)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual((response['ETag'], response['Cache-Control']), (self.etag, blob_response.CACHE_CONTROL))
+		self.assertEqual(b''.join(response.streaming_content), self.species.thumbnail.getvalue())
+		
+		response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"other", {self.etag}')
+		self.assertEqual((response.status_code, response['ETag'], response['Cache-Control']), (304, self.etag, blob_response.CACHE_CONTROL))
+		self.assertEqual(response.content, b'')
+		self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+	
+	def test_unversioned_or_stale_url_revalidated(self):
+		path = self.url.split('?')[0]
+		for url in (path, f'{path}?v=stale'):
+			response = self.client.get(url)
+			self.assertEqual((response.status_code, response['Cache-Control']), (200, blob_response.REVALIDATE_CACHE_CONTROL))
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=self.etag)
+			self.assertEqual((response.status_code, response['Cache-Control']), (304, blob_response.REVALIDATE_CACHE_CONTROL))
+	
+	def test_negotiated_image_cached_by_versioned_url(self):
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion')
+		response = self.client.get(species.image.url, HTTP_ACCEPT='image/webp,*/*')
+		self.assertEqual((response.status_code, response['Cache-Control']), (200, blob_response.CACHE_CONTROL))
+		path = f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/image'
+		self.assertEqual(self.client.get(f'{path}?w=128')['Cache-Control'], blob_response.REVALIDATE_CACHE_CONTROL)
+		self.assertEqual(self.client.get(f'{path}?w=128&v={species.image_hash}')['Cache-Control'], blob_response.CACHE_CONTROL)
+	
+	def test_single_range(self):
+		data, length = self.species.thumbnail.getvalue(), len(self.species.thumbnail.getvalue())
+		response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+		self.assertEqual((response.status_code, response['Content-Range'], response['Content-Length']), (206, f'bytes 10-19/{length}', '10'))
+		self.assertEqual(b''.join(response.streaming_content), data[10:20])
+		
+		response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+		self.assertEqual(b''.join(response.streaming_content), data[-5:])
+		self.assertEqual(self.client.get(self.url, HTTP_RANGE=f'bytes={length}-').status_code, 416)
+		self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1,5-6').status_code, 200) # multiple ranges are served whole
+	
+	def test_url_versioned_by_content(self):
+		self.assertTrue(self.url.endswith(f'?v={self.species.thumbnail.etag}'))
+		self.species.image = self.create_image_file(color=(50, 100, 200))
+		self.species.save()
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		self.assertNotEqual(species.thumbnail_url, self.url)
+		self.assertEqual(self.client.get(species.thumbnail_url)['ETag'], f'"{species.thumbnail.etag}"')
+
+
+class ImagePreviewTests(SubjectImageTestCase):
+	def test_preview_cached_by_content(self):
+		Species(name='Lion').save(using=TEST_ZOO_ID)
+		image_data = self.create_image_file(size=(4032, 3024)).getvalue()
+		with tempfile.TemporaryDirectory() as temp_dir, \
+				mock.patch('zoo_editor.model_fields.get_rendition_cache', return_value=RenditionCache(path=f'{temp_dir}/renditions.sqlite3')), \
+				mock.patch('zoo_editor.model_fields.normalise_image', wraps=image_pipeline.normalise_image) as normalise_image:
+			for _ in range(2):
+				response = self.client.post(
+					f'/zoos/{TEST_ZOO_ID}/species/',
+					{'update_image_display': '', 'image': SimpleUploadedFile('lion.jpg', image_data)},
+					HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+				)
+				header, preview = response.json()['image_src'].split(',')
+				self.assertEqual(header, 'data:image/jpeg;base64')
+				self.assertEqual(Image.open(io.BytesIO(base64.b64decode(preview))).size, (256, 192))
+		normalise_image.assert_called_once()
+
+
+class ImageRenditionTests(SubjectImageTestCase):
+	def test_renditions_stored_on_save(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		renditions = ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=species.image_hash)
+		self.assertEqual(
+			{rendition.width: Image.open(io.BytesIO(rendition.data)).size for rendition in renditions},
+			{64: (64, 48), 128: (128, 96), 256: (256, 192), 512: (512, 384)}
+		)
+		with self.assertNumQueries(0, using=TEST_ZOO_ID):
+			self.assertEqual(species.image_srcset.count('?w='), 4)
+	
+	def test_missing_rendition_generated_when_requested(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		ImageRendition.objects.using(TEST_ZOO_ID).filter(width=128).delete() # as if 128 was declared after the image was saved
+		
+		response = self.client.get(f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/image?w=128&v={species.image_hash}')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(Image.open(io.BytesIO(b''.join(response.streaming_content))).size, (128, 96))
+		self.assertTrue(ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=species.image_hash, width=128).exists())
+		self.assertEqual(self.client.get(f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/image?w=100').status_code, 404)
+	
+	@skipUnless('WEBP' in image_pipeline.get_served_formats(), 'Pillow was built without WebP support')
+	def test_rendition_format_negotiated(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		url = f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/image?w=256&v={species.image_hash}'
+		webp_response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+		jpeg_response = self.client.get(url, HTTP_ACCEPT='image/png,*/*')
+		
+		self.assertEqual((webp_response['Content-Type'], jpeg_response['Content-Type']), ('image/webp', 'image/jpeg'))
+		self.assertIn('Accept', webp_response['Vary'])
+		self.assertNotEqual(webp_response['ETag'], jpeg_response['ETag'])
+		self.assertEqual(
+			set(ImageRendition.objects.using(TEST_ZOO_ID).filter(width=256).values_list('format', flat=True)),
+			{image_pipeline.get_served_formats()[0], 'JPEG'}
+		)
+	
+	def test_replaced_image_renditions_deleted(self):
+		Species(name='Lion', image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		species = Species.objects.using(TEST_ZOO_ID).get(name='Lion')
+		old_image_hash = species.image_hash
+		species.image = self.create_image_file(color=(50, 100, 200))
+		species.save()
+		
+		self.assertNotEqual(species.image_hash, old_image_hash)
+		self.assertFalse(ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=old_image_hash).exists())
+		species.delete()
+		self.assertFalse(ImageRendition.objects.using(TEST_ZOO_ID).exists())
+
+
+@override_settings(IMAGE_RENDITIONS_IN_WORKER=True)
+class ImageJobTests(SubjectImageTestCase):
+	def save_form_upload(self, species=None):
+		image_file = SimpleUploadedFile('lion.jpg', self.create_image_file(exif=True).getvalue(), content_type='image/jpeg')
+		form_kwargs = {'instance': species} if species else {'zoo_id': TEST_ZOO_ID}
+		form = Species.form(data={'name': 'Lion', 'weight': '', 'size': ''}, files={'image': image_file}, **form_kwargs)
+		self.assertTrue(form.is_valid(), form.errors)
+		with mock.patch.object(ImageBlobField, 'create_rendition') as create_rendition:
+			species = form.save()
+		create_rendition.assert_not_called()
+		return species
+	
+	def test_upload_stripped_and_renditions_queued(self):
+		species = self.save_form_upload()
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(id=species.id)
+		self.assertFalse(Image.open(species.image).getexif()) # the GPS position of the camera is not stored
+		self.assertEqual(Image.open(species.thumbnail).size, (160, 120))
+		self.assertEqual(species.image_hash, species.image.content_hash)
+		self.assertFalse(ImageRendition.objects.using(TEST_ZOO_ID).exists())
+		
+		self.assertEqual(run_worker([TEST_ZOO_ID], poll_interval=0, max_attempts=3, once=True), (1, 0))
+		self.assertEqual(ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=species.image_hash).count(), 4)
+		self.assertFalse(ImageJob.objects.using(TEST_ZOO_ID).exists())
+	
+	@override_settings(IMAGE_RENDITIONS_IN_WORKER=False)
+	def test_renditions_generated_in_request_without_worker(self):
+		image_file = SimpleUploadedFile('lion.jpg', self.create_image_file(exif=True).getvalue(), content_type='image/jpeg')
+		form = Species.form(data={'name': 'Lion', 'weight': '', 'size': ''}, files={'image': image_file}, zoo_id=TEST_ZOO_ID)
+		self.assertTrue(form.is_valid(), form.errors)
+		species = form.save()
+		self.assertEqual(ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=species.image_hash).count(), 4)
+		self.assertFalse(ImageJob.objects.using(TEST_ZOO_ID).exists())
+	
+	def test_upload_stored_as_uploaded_processed_by_worker(self):
+		species = Species(name='Lion', image=self.create_image_file())
+		species.process_blobs = False
+		species.save(using=TEST_ZOO_ID)
+		self.assertIn('image_placeholder', species.thumbnail_url)
+		status_url = f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/image/status'
+		self.assertEqual(self.client.get(status_url).json(), {'status': 'pending'})
+		
+		self.assertEqual(run_worker([TEST_ZOO_ID], poll_interval=0, max_attempts=3, once=True), (1, 0))
+		species = Species.objects.using(TEST_ZOO_ID).defer(None).get(id=species.id)
+		self.assertEqual(Image.open(species.thumbnail).size, (160, 120))
+		self.assertEqual(ImageRendition.objects.using(TEST_ZOO_ID).filter(source_hash=species.image_hash).count(), 4)
+		self.assertEqual(self.client.get(status_url).json()['status'], 'done')
+	
+	def test_failing_zoo_skipped_by_worker(self):
+		self.save_form_upload()
+		requeue_stale = ImageJob.objects.requeue_stale
+		def requeue_stale_or_fail(manager, timeout):
+			if manager.db == 'oldzoo':
+				raise OperationalError('no such table: IMAGE_JOBS')
+			return requeue_stale.__func__(manager, timeout)
+		
+		with mock.patch.object(type(ImageJob.objects), 'requeue_stale', autospec=True, side_effect=requeue_stale_or_fail), self.assertLogs('zoo_editor.management.commands.process_image_jobs') as logs:
+			self.assertEqual(run_worker(['oldzoo', TEST_ZOO_ID], poll_interval=0, max_attempts=3, once=True), (1, 0))
+		self.assertEqual(len(logs.records), 1)
+		self.assertIn('oldzoo', logs.output[0])
+	
+	def test_replaced_upload_not_overwritten(self):
+		species = Species(name='Lion', image=self.create_image_file())
+		species.process_blobs = False
+		species.save(using=TEST_ZOO_ID)
+		stale_species = Species.objects.using(TEST_ZOO_ID).defer(None).get(id=species.id)
+		species.image = self.create_image_file(color=(50, 100, 200))
+		species.save()
+		
+		self.assertFalse(stale_species.process_image())
+		self.assertTrue(Species.objects.using(TEST_ZOO_ID).defer(None).get(id=species.id).process_image())
+	
+	def test_failing_job_retried_then_failed(self):
+		self.save_form_upload()
+		with mock.patch.object(ImageBlobField, 'create_rendition', side_effect=OSError('cannot identify image file')):
+			self.assertEqual(run_worker([TEST_ZOO_ID], poll_interval=0, max_attempts=2, once=True), (0, 1))
+		job = ImageJob.objects.using(TEST_ZOO_ID).get()
+		self.assertEqual((job.status, job.attempts), (ImageJob.Status.FAILED, 2))
+
+
+class BlobStoreTests(SubjectImageTestCase):
+	def get_stored_blobs(self):
+		with connections[TEST_ZOO_ID].cursor() as cursor:
+			cursor.execute(f'SELECT hash, refcount FROM "{BLOBS_TABLE}" ORDER BY hash')
+			return cursor.fetchall()
+	
+	def test_identical_blobs_stored_once(self):
+		lion = Species(name='Lion', image=self.create_image_file(), audio=io.BytesIO(b'roar'))
+		lion.save(using=TEST_ZOO_ID)
+		Species(name='Tiger', image=self.create_image_file(), audio=io.BytesIO(b'roar')).save(using=TEST_ZOO_ID)
+		image_hash = Species.objects.using(TEST_ZOO_ID).get(name='Tiger').image_hash
+		self.assertEqual(self.get_stored_blobs(), sorted([(image_hash, 2), (lion.audio.content_hash, 2)]))
+		
+		lion.delete()
+		tiger = Species.objects.using(TEST_ZOO_ID).get(name='Tiger')
+		tiger.audio = io.BytesIO(b'growl')
+		tiger.save()
+		self.assertEqual(self.get_stored_blobs(), sorted([(image_hash, 1), (tiger.audio.content_hash, 1)]))
+		self.assertEqual(Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Tiger').audio.getvalue(), b'growl')
+	
+	def test_audio_streamed_from_store(self):
+		species = Species(name='Lion', image=self.create_image_file(), audio=io.BytesIO(b'roar' * 1000))
+		species.save(using=TEST_ZOO_ID)
+		response = self.client.get(f'/zoos/{TEST_ZOO_ID}/blobs/species/{species.id}/audio')
+		self.assertEqual(b''.join(response.streaming_content), b'roar' * 1000)
+		self.assertIn(species.audio.content_hash, response['ETag'])
+	
+	def test_inline_blobs_moved_to_store(self):
+		for name in ('Lion', 'Tiger'):
+			Species(name=name, image=self.create_image_file()).save(using=TEST_ZOO_ID)
+		with connections[TEST_ZOO_ID].cursor() as cursor:
+			cursor.execute('UPDATE "SPECIES" SET "audio" = %s', (b'roar' * 1000,)) # as stored before the blob store
+		
+		report = zoo_schema.move_blobs_to_store(TEST_ZOO_ID)
+		self.assertIn('2 inline blobs moved to the blob store (1 not already there)', report)
+		self.assertIn('(4000 bytes)', report)
+		audio = Species.objects.using(TEST_ZOO_ID).defer(None).get(name='Lion').audio
+		self.assertEqual(audio.getvalue(), b'roar' * 1000)
+		self.assertIn((audio.content_hash, 2), self.get_stored_blobs())
+
+
+class AudioStreamingTests(ZooTestCase):
+	def setUp(self):
+		super().setUp()
+		self.species = Species(name='Lion', audio=io.BytesIO(bytes(range(256)) * 1000))
+		self.species.save(using=TEST_ZOO_ID)
+		self.url = f'/zoos/{TEST_ZOO_ID}/blobs/species/{self.species.id}/audio'
+		self.etag = f'"{self.species.audio.content_hash}"'
+	
+	def test_range_served(self):
+		with mock.patch.object(SQLiteBlobReader, 'iter_chunks', autospec=True, side_effect=SQLiteBlobReader.iter_chunks) as iter_chunks:
+			response = self.client.get(self.url, HTTP_RANGE='bytes=1000-1099')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual((response['Content-Range'], response['Content-Length'], response['ETag']), ('bytes 1000-1099/256000', '100', self.etag))
+		self.assertEqual(b''.join(response.streaming_content), bytes(range(256))[232:] + bytes(range(256))[:76])
+		iter_chunks.assert_called_once_with(mock.ANY, 1000, 1099) # only the range is read, not the whole clip to hash it
+	
+	def test_unsatisfiable_range(self):
+		response = self.client.get(self.url, HTTP_RANGE='bytes=256000-')
+		self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */256000'))
+	
+	def test_not_modified_without_reading(self):
+		with mock.patch.object(SQLiteBlobReader, 'iter_chunks') as iter_chunks:
+			response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+		self.assertEqual((response.status_code, response['ETag']), (304, self.etag))
+		iter_chunks.assert_not_called()
+	
+	def test_range_of_other_version_served_whole(self):
+		response = self.client.get(self.url, HTTP_RANGE='bytes=0-99', HTTP_IF_RANGE='"stale"')
+		self.assertEqual((response.status_code, response['Content-Length']), (200, '256000'))
+	
+	def test_cached_only_by_versioned_url(self):
+		self.assertEqual(self.client.get(self.url)['Cache-Control'], blob_response.REVALIDATE_CACHE_CONTROL)
+		self.assertEqual(self.client.get(f'{self.url}?v=stale')['Cache-Control'], blob_response.REVALIDATE_CACHE_CONTROL)
+		self.assertEqual(self.client.get(self.species.audio.url)['Cache-Control'], blob_response.CACHE_CONTROL)
+
+
+class ZooSchemaTests(ZooTestCase):
+	def test_migrate_zoo(self):
+		with connections[TEST_ZOO_ID].cursor() as cursor:
+			cursor.execute(f'DELETE FROM "{zoo_schema.SCHEMA_VERSION_TABLE}"') # changes are applied by setUpTestData already, and can be reapplied
+		self.assertEqual([change.version for change in zoo_schema.migrate_zoo(TEST_ZOO_ID)], [change.version for change in zoo_schema.SCHEMA_CHANGES])
+		self.assertEqual(zoo_schema.get_schema_version(TEST_ZOO_ID), zoo_schema.LATEST_SCHEMA_VERSION)
+		self.assertEqual(zoo_schema.migrate_zoo(TEST_ZOO_ID), [])
+	
+	def test_outdated_schema_logged_on_first_connection(self):
+		with connections[TEST_ZOO_ID].cursor() as cursor:
+			cursor.execute(f'DELETE FROM "{zoo_schema.SCHEMA_VERSION_TABLE}" WHERE version > 1')
+		with mock.patch.object(zoo_schema, '_checked_zoo_ids', set()), mock.patch.object(zoo_schema, 'migrate_zoo') as migrate_zoo:
+			with self.assertLogs('zoo_editor.zoo_schema', level='ERROR') as logs:
+				zoo_schema.check_schema_on_first_connection(sender=None, connection=connections[TEST_ZOO_ID])
+				zoo_schema.check_schema_on_first_connection(sender=None, connection=connections[TEST_ZOO_ID])
+		self.assertEqual(len(logs.records), 1)
+		self.assertIn(f'{TEST_ZOO_ID} is at schema version 1', logs.output[0])
+		migrate_zoo.assert_not_called()
+		self.assertEqual(zoo_schema.get_schema_version(TEST_ZOO_ID), 1) # left to migrate_zoos
+	
+	def test_subject_lists_use_indexes(self):
+		zoo_schema.migrate_zoo(TEST_ZOO_ID)
+		for description, queryset in zoo_schema.get_hot_queries(TEST_ZOO_ID).items():
+			with self.subTest(description):
+				self.assertIn('USING INDEX', ' '.join(zoo_schema.explain_query_plan(queryset)))
+
+
+class ZooAccessTests(ZooTestCase):
+	def test_access_checked_without_queries(self):
+		self.assertTrue(self.user.has_access(TEST_ZOO_ID))
+		user = ZooUser.objects.get(pk=self.user.pk)
+		with self.assertNumQueries(0):
+			self.assertTrue(user.has_access(TEST_ZOO_ID))
+			self.assertFalse(user.has_access('otherzoo'))
+	
+	def test_access_invalidated_on_zoo_users_change(self):
+		other_zoo = Zoo.objects.create(id='otherzoo', name='Other Zoo', encryption_key='1' * 30, image='zoo.png', last_commit_date=datetime.date.today())
+		self.assertFalse(ZooUser.objects.get(pk=self.user.pk).has_access(other_zoo.id))
+		
+		other_zoo.users.add(self.user)
+		self.assertTrue(ZooUser.objects.get(pk=self.user.pk).has_access(other_zoo.id))
+		
+		self.user._zoos.remove(other_zoo)
+		self.assertFalse(ZooUser.objects.get(pk=self.user.pk).has_access(other_zoo.id))
+		
+		other_zoo.users.add(self.user)
+		other_zoo.users.clear()
+		self.assertFalse(ZooUser.objects.get(pk=self.user.pk).has_access(other_zoo.id))
+	
+	def test_superuser_access_invalidated_on_new_zoo(self):
+		self.user.is_superuser = True
+		self.user.save()
+		self.assertFalse(ZooUser.objects.get(pk=self.user.pk).has_access('otherzoo'))
+		Zoo.objects.create(id='otherzoo', name='Other Zoo', encryption_key='1' * 30, image='zoo.png', last_commit_date=datetime.date.today())
+		self.assertTrue(ZooUser.objects.get(pk=self.user.pk).has_access('otherzoo'))
+	
+	def test_access_revoked_elsewhere_expires(self):
+		self.assertTrue(self.user.has_access(TEST_ZOO_ID))
+		self.assertEqual(cache.get(get_accessible_zoos_cache_key(self.user.pk)), [{'id': TEST_ZOO_ID, 'name': 'Test Zoo'}]) # no encryption keys
+		Zoo.users.through.objects.filter(zoouser=self.user).delete() # without signals, as seen by the other processes
+		self.assertTrue(ZooUser.objects.get(pk=self.user.pk).has_access(TEST_ZOO_ID))
+		with mock.patch('time.time', return_value=time.time() + ZOO_ACCESS_CACHE_TIMEOUT + 1):
+			self.assertFalse(ZooUser.objects.get(pk=self.user.pk).has_access(TEST_ZOO_ID))
+
+
+class EncryptionTests(SimpleTestCase):
+	# (plaintext, password, ciphertext) produced by the original JavaScript implementation
+	GOLDEN_VECTORS = (
+		('zoo=test&type=species&id=1', '123456789012345678901234567890', 'AAAAAAAAAABN9JhTTgiWBEhA78gSKvXVBeeQWbmjcoKVqA=='),
+		('zoo=test2&type=individual&id=42', '123456789012345678901234567891', 'AAAAAAAAAADwlFBTqC4ly7dwAfIXjJLscctaulbdvi6mgq6NaH4p'),
+		('', 'password', 'AAAAAAAAAAA='),
+		('a', '', 'AAAAAAAAAAD1'),
+		('exactly sixteen!', 'k', 'AAAAAAAAAAAjIloJ0Eg4oeDzXI7GE+UX'),
+		(
+			'zoo=test&type=group&id=7' * 20,
+			'a much longer password that exceeds thirty-two bytes',
+			'AAAAAAAAAAAhiYBWMp0j7979kK13i3HFjBnsFEA2/Tugp+ERK3Z/JYXUVSGAg2TrXH+5FWRDSvaf5wz6MmyMIJWc6dnZBwBU5h8Enxa3uB4cfs+h'
+			'e5pCBvrPKCAnO0RyA3cU3FLQ0RGRSSjvwaUwaN+sLqG8uOwP1EReHbmSj6duKBKjqhIOK/xZwd75yTp3wyYTxbuX3vGiZ1Vb0AjrkWRoKL9heVy3'
+			'DL2Ti+dEyssoec28Jd+OM3uAQJBwvIlVF8+cNbi4lm69tioSDgqo+9BdvvTrJntSb6b9W35k+YEJRo3j2F1KTdEqB+J+jOSwu4+WRWcY1b2O6ceC'
+			'W90VBFMmdaCT0bKj1iLtMxCFOOErOKg5pt7VZVmNumpAOGgHZ793inZrY6ye4TRPIZxevRqhVG+hoUBqtusyCn+7K2LJWAfWjr7h4h68BL6sThE8'
+			'sfUpIiMxfxKEbLdKYrKQq0X0bqc72+rcNdk8pKP7sVgeJDXqfM2M6xTyD2sSgVlpUG42BNo4jsS6wgKe9tJl14VV6s9prUZ1aEu1ZDOOgl1ghv+P'
+			'tuCUCOhHGWLwjpjiA9+OeCpsXDk2iUtJkSbeYMa32LYWAmUEeQLOgVZT9gzuxnwo37t98ENU6MZymN/AuyQdBXTUZ3Q='
+		),
+		('café ünïcödé € 日本', 'pässwörd€', 'AAAAAAAAAADghQ5cXTKSkJOU7OLRxnHe+xHUowaq0LpGoK5l'),
+		('emoji 🦁 lion', 'key🦁', 'AAAAAAAAAABiwgQWN/eqHbCTcT8lhE7Psg=='),
+	)
+	
+	def test_golden_vectors(self):
+		for plaintext, password, ciphertext in self.GOLDEN_VECTORS:
+			with self.subTest(plaintext=plaintext, password=password):
+				self.assertEqual(encryption.encrypt(plaintext, password), ciphertext)
+	
+	def test_golden_vectors_pure_python(self):
+		with mock.patch.object(encryption, 'Cipher', None):
+			for plaintext, password, ciphertext in self.GOLDEN_VECTORS:
+				with self.subTest(plaintext=plaintext, password=password):
+					self.assertEqual(encryption.encrypt(plaintext, password), ciphertext)
+	
+	def test_fips_197_block(self):
+		# AES-256 example vector from FIPS-197, appendix C.3
+		key = bytes(range(32))
+		block = bytes.fromhex('00112233445566778899aabbccddeeff')
+		self.assertEqual(encryption.encrypt_block(block, encryption.expand_key(key)).hex(), '8ea2b7ca516745bfeafc49904b496089')
@@ -1,9 +1,10 @@
 from django.urls import path
-from .views import ZoosIndexView, ZooHomeView, SpeciesPageView, IndividualPageView, GroupPageView, SpeciesListView, IndividualsListView, GroupsListView, AttributeCategoryListView
+from .views import ZoosIndexView, ZooHomeView, SpeciesPageView, IndividualPageView, GroupPageView, SpeciesListView, IndividualsListView, GroupsListView, AttributeCategoryListView, BlobView, BlobStatusView, QRCodesExportView
 
 urlpatterns = [
 	path('', ZoosIndexView.as_view(), name='zoo_index'),
 	path('<str:zoo_id>/', ZooHomeView.as_view(), name='zoo'),
+	path('<str:zoo_id>/qrcodes/', QRCodesExportView.as_view(), name='qrcodes_export'),
 	
 	path('<str:zoo_id>/species/', SpeciesListView.as_view(), name='species_list'),
 	path('<str:zoo_id>/species/<str:subject_id>', SpeciesPageView.as_view()),
@@ -15,4 +16,7 @@ urlpatterns = [
 	path('<str:zoo_id>/groups/<str:subject_id>', GroupPageView.as_view()),
 	
 	path('<str:zoo_id>/attributes/', AttributeCategoryListView.as_view(), name='attribute_categories_list'),
+	
+	path('<str:zoo_id>/blobs/<str:model_name>/<int:subject_id>/<str:field_name>', BlobView.as_view(), name='blob'),
+	path('<str:zoo_id>/blobs/<str:model_name>/<int:subject_id>/<str:field_name>/status', BlobStatusView.as_view(), name='blob_status'),
 ]
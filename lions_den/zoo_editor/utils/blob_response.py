@@ -0,0 +1,78 @@
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+
+RANGE_HEADER_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+CACHE_CONTROL = 'private, max-age=31536000, immutable'  # blob URLs are versioned by content, so they never go stale
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'  # for unversioned or stale URLs, whose blob may change without the URL changing
+
+
+def parse_range_header(range_header, content_length):
+	"""
+		Parses a single-range "Range: bytes=start-end" header into an inclusive (start, end) tuple
+		Returns None if the header is absent or malformed (i.e. the whole content should be served),
+		and raises ValueError if the range cannot be satisfied
+	"""
+	match = RANGE_HEADER_REGEX.match(range_header.strip()) if range_header else None
+	if not match or match.groups() == ('', ''):
+		return None
+
+	start_str, end_str = match.groups()
+	if not start_str: # suffix range, i.e. the last N bytes
+		start, end = max(content_length - int(end_str), 0), content_length - 1
+	else:
+		start = int(start_str)
+		end = min(int(end_str), content_length - 1) if end_str else content_length - 1
+
+	if start >= content_length or start > end:
+		raise ValueError(f'Range {range_header} not satisfiable for content of length {content_length}')
+	return start, end
+
+
+def blob_response(request, data, content_type, etag, versioned=False):
+	"""
+		Serves an in-memory blob with a strong ETag, honouring If-None-Match and single byte ranges
+		Only cached for good if versioned, i.e. requested by a URL carrying the blob's current version, and otherwise revalidated
+	"""
+	return streaming_blob_response(
+		request=request,
+		length=len(data),
+		iter_chunks=lambda start, end: [data[start:end + 1]],
+		content_type=content_type,
+		etag=etag,
+		versioned=versioned
+	)
+
+
+def streaming_blob_response(request, length, iter_chunks, content_type, etag, versioned=False):
+	"""
+		Same as blob_response, but streaming the blob contents
+		:param length: total length of the blob in bytes
+		:param iter_chunks: function taking an inclusive (start, end) byte range and returning an iterable of byte chunks
+	"""
+	etag = f'"{etag}"'
+	if etag in (tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')):
+		response = HttpResponseNotModified()
+	else:
+		byte_range = None
+		if request.META.get('HTTP_IF_RANGE', etag) == etag: # only serve a range of the current version of the blob
+			try:
+				byte_range = parse_range_header(request.META.get('HTTP_RANGE'), length)
+			except ValueError:
+				response = HttpResponse(status=416)
+				response['Content-Range'] = f'bytes */{length}'
+				return response
+
+		if byte_range:
+			start, end = byte_range
+			response = StreamingHttpResponse(iter_chunks(start, end), content_type=content_type, status=206)
+			response['Content-Range'] = f'bytes {start}-{end}/{length}'
+		else:
+			start, end = 0, length - 1
+			response = StreamingHttpResponse(iter_chunks(start, end) if length else [], content_type=content_type)
+		response['Content-Length'] = end - start + 1
+		response['Accept-Ranges'] = 'bytes'
+
+	response['ETag'] = etag
+	response['Cache-Control'] = CACHE_CONTROL if versioned else REVALIDATE_CACHE_CONTROL
+	return response
@@ -0,0 +1,48 @@
+"""
+	Content-addressed store for the images and audio of subjects, in the BLOBS table of each zoo database.
+	Subject rows reference blobs by the SHA-256 of their contents, so identical media is stored once, and the hash doubles as its ETag.
+	Reference counts are kept by triggers on the subject tables (see zoo_schema), and unreferenced blobs are deleted by collect_garbage.
+"""
+import hashlib
+
+BLOBS_TABLE = 'BLOBS'
+
+
+def get_content_hash(data):
+	return hashlib.sha256(data).hexdigest()
+
+
+def store_blob(connection, data, content_hash=None):
+	""" Stores the blob unless already stored, returning its hash; it is unreferenced (and so collectable) until a subject row references it """
+	content_hash = content_hash or get_content_hash(data)
+	with connection.cursor() as cursor:
+		cursor.execute(f'INSERT OR IGNORE INTO "{BLOBS_TABLE}" (hash, data, refcount) VALUES (%s, %s, 0)', (content_hash, data))
+	return content_hash
+
+
+def load_blob(connection, content_hash):
+	with connection.cursor() as cursor:
+		cursor.execute(f'SELECT data FROM "{BLOBS_TABLE}" WHERE hash = %s', (content_hash,))
+		row = cursor.fetchone()
+	return row[0] if row else None
+
+
+def find_blob(connection, table, column, subject_id):
+	""" rowid in BLOBS (e.g. to read it incrementally) and hash of the blob referenced by a subject row, or None if it references none """
+	with connection.cursor() as cursor:
+		cursor.execute(
+			f'SELECT "{BLOBS_TABLE}".rowid, "{BLOBS_TABLE}".hash FROM "{BLOBS_TABLE}" JOIN "{table}" ON "{BLOBS_TABLE}".hash = "{table}"."{column}" WHERE "{table}".rowid = %s',
+			(subject_id,)
+		)
+		row = cursor.fetchone()
+	return tuple(row) if row else None
+
+
+def collect_garbage(connection):
+	""" Deletes the blobs no longer referenced by any subject, returning how many were deleted and their total size """
+	with connection.cursor() as cursor:
+		cursor.execute(f'SELECT COUNT(*), COALESCE(SUM(length(data)), 0) FROM "{BLOBS_TABLE}" WHERE refcount <= 0')
+		num_blobs, num_bytes = cursor.fetchone()
+		if num_blobs:
+			cursor.execute(f'DELETE FROM "{BLOBS_TABLE}" WHERE refcount <= 0')
+	return num_blobs, num_bytes
@@ -0,0 +1,35 @@
+CHUNK_SIZE = 64 * 1024
+
+
+class SQLiteBlobReader:
+	"""
+		Reads a BLOB column of a single row in fixed-size chunks, so memory use is bounded by the chunk size rather than the blob size
+		Uses SQLite's incremental blob I/O where available (Python 3.11+), falling back to substr() queries otherwise
+	"""
+	def __init__(self, connection, table, column, rowid, chunk_size=CHUNK_SIZE):
+		connection.ensure_connection()
+		self.connection = connection.connection # raw sqlite3 connection
+		self.table = table
+		self.column = column
+		self.rowid = rowid
+		self.chunk_size = chunk_size
+
+		row = self.connection.execute(f'SELECT length("{column}") FROM "{table}" WHERE rowid = ?', (rowid,)).fetchone()
+		self.length = row[0] if row else None
+
+	def exists(self):
+		return self.length is not None
+
+	def iter_chunks(self, start=0, end=None):
+		""" Yields the bytes from start to end (inclusive) """
+		end = self.length - 1 if end is None else end
+		if hasattr(self.connection, 'blobopen'):
+			with self.connection.blobopen(self.table, self.column, self.rowid, readonly=True) as blob:
+				blob.seek(start)
+				for offset in range(start, end + 1, self.chunk_size):
+					yield blob.read(min(self.chunk_size, end + 1 - offset))
+		else:
+			query = f'SELECT substr("{self.column}", ?, ?) FROM "{self.table}" WHERE rowid = ?'
+			for offset in range(start, end + 1, self.chunk_size):
+				yield self.connection.execute(query, (offset + 1, min(self.chunk_size, end + 1 - offset), self.rowid)).fetchone()[0]
+
@@ -0,0 +1,125 @@
+"""
+	Image processing for subject images, working on whole pixel buffers rather than per-pixel Python objects:
+		- JPEGs are decoded at a reduced scale (Image.draft) when only a smaller output is needed
+		- EXIF orientation is applied with a single transpose, and only if needed
+		- cropping and resizing are a single resize() of the crop box
+		- metadata is stripped by dropping it from the image info, without copying pixels
+	so peak memory is proportional to the output size plus the (reduced) decoded image.
+	Images are served in the most compact format the browser accepts (see choose_served_format).
+"""
+import io
+import math
+
+from PIL import Image, ImageOps
+
+try:
+	import pillow_avif # registers AVIF support with Pillow
+except ImportError:
+	pillow_avif = None
+
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8) # orientations which swap width and height
+KEPT_INFO_KEYS = ('transparency',) # image info which affects how pixels are displayed, so is not metadata
+RESIZE_REDUCING_GAP = 3.0 # reduce by integer factors first when downscaling a lot, which is faster and just as good
+COMPACT_FORMATS = ('AVIF', 'WEBP') # most compact first, served to browsers which accept them (if Pillow can save them)
+FALLBACK_FORMAT = 'JPEG' # accepted by all browsers
+
+
+def open_image(data, min_size=None):
+	"""
+		Opens an image from bytes, decoding JPEGs at the smallest scale which still covers min_size
+		:param min_size: (width, height) the displayed (i.e. EXIF-oriented) image must cover, if the image will be scaled down
+	"""
+	img = Image.open(io.BytesIO(data))
+	if min_size and img.format == 'JPEG':
+		width, height = img.size
+		if get_orientation(img) in TRANSPOSED_ORIENTATIONS:
+			min_size = min_size[::-1]
+		scale = max(min_size[0] / width, min_size[1] / height)
+		if scale < 1:
+			img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+	return img
+
+
+def get_orientation(img):
+	try:
+		return img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+	except Exception: # corrupt EXIF data
+		return 1
+
+
+def apply_exif_orientation(img):
+	""" Transposes the image so it is displayed the right way up without its EXIF orientation """
+	if get_orientation(img) in (1, None):
+		return img
+	try:
+		return ImageOps.exif_transpose(img)
+	except Exception: # corrupt EXIF data
+		return img
+
+
+def strip_metadata(img):
+	""" Drops EXIF, ICC profiles, comments, etc, in place, keeping the pixels as they are """
+	img.info = {key: value for key, value in img.info.items() if key in KEPT_INFO_KEYS}
+	return img
+
+
+def get_cover_box(image_size, size):
+	""" Centred crop box of image_size with the aspect ratio of size """
+	width, height = image_size
+	aspect_ratio = size[0] / size[1]
+	if width / height < aspect_ratio: # image too tall
+		crop_height = width / aspect_ratio
+		return 0, (height - crop_height) / 2, width, (height + crop_height) / 2
+	crop_width = height * aspect_ratio
+	return (width - crop_width) / 2, 0, (width + crop_width) / 2, height
+
+
+def save_image(img, format):
+	output_file = io.BytesIO()
+	strip_metadata(img).save(output_file, format=format)
+	return output_file.getvalue()
+
+
+def normalise_image(data, size, format):
+	""" Returns the image, the right way up and without metadata, cropped to the aspect ratio of size and scaled to it """
+	img = apply_exif_orientation(open_image(data, min_size=size))
+	if img.mode not in ('RGB', 'RGBA'):
+		img = img.convert('RGBA')
+	img = img.resize(size, Image.LANCZOS, box=get_cover_box(img.size, size), reducing_gap=RESIZE_REDUCING_GAP)
+
+	if format == 'JPEG' and img.mode == 'RGBA': # flatten transparency onto a white background
+		background = Image.new('RGB', img.size, (255, 255, 255))
+		background.paste(img, mask=img.getchannel('A'))
+		img = background
+	elif format != 'JPEG' and img.mode == 'RGB':
+		img = img.convert('RGBA')
+	return save_image(img, format)
+
+
+def get_served_formats():
+	""" Formats images may be served in, most compact first """
+	Image.init()
+	return [format for format in COMPACT_FORMATS if format in Image.SAVE] + [FALLBACK_FORMAT]
+
+
+def get_content_type(format):
+	return f'image/{format.lower()}'
+
+
+def choose_served_format(accept_header):
+	""" Most compact format accepted by the Accept header of a request, ignoring types it gives a q=0 """
+	accepted_types = set()
+	for media_range in (accept_header or '').split(','):
+		content_type, *params = [part.strip() for part in media_range.split(';')]
+		if not any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for param in params):
+			accepted_types.add(content_type.lower())
+	for format in get_served_formats()[:-1]:
+		if get_content_type(format) in accepted_types:
+			return format
+	return FALLBACK_FORMAT
+
+
+def strip_exif(data, format):
+	""" Returns the image at full size, the right way up and without metadata """
+	return save_image(apply_exif_orientation(open_image(data)), format)
@@ -1,12 +1,29 @@
+import hashlib
 from io import BytesIO
 import qrcode, base64
+
+from django.core.cache import cache
+
 from .encryption import encrypt
 
 BASE_URL = 'https://zooverse.org?'
+CACHE_TIMEOUT = 7 * 24 * 60 * 60
 
-def create_request_qrcode(zoo, request):
-	request_str = '&'.join((f'{key}={value}' for key,value in request.items()))
-	url = BASE_URL + encrypt(request_str, zoo.encryption_key)
+def get_request_str(request):
+	return '&'.join((f'{key}={value}' for key,value in request.items()))
+
+def create_request_qrcode_png(encryption_key, request):
+	""" Returns the PNG bytes of the QR code for the request. Doesn't rely on Django, so it can run in worker processes """
+	url = BASE_URL + encrypt(get_request_str(request), encryption_key)
 	qrcode_string = BytesIO()
 	qrcode.make(url).save(qrcode_string, 'png')
-	return base64.b64encode(qrcode_string.getvalue()).decode()
+	return qrcode_string.getvalue()
+
+def create_request_qrcode(zoo, request):
+	# Cached per encryption key as well, so that changing a zoo's key invalidates its QR codes
+	cache_key = f'qrcode:{get_request_str(request)}:{hashlib.sha256(zoo.encryption_key.encode()).hexdigest()}'
+	qrcode_b64 = cache.get(cache_key)
+	if qrcode_b64 is None:
+		qrcode_b64 = base64.b64encode(create_request_qrcode_png(zoo.encryption_key, request)).decode()
+		cache.set(cache_key, qrcode_b64, CACHE_TIMEOUT)
+	return qrcode_b64
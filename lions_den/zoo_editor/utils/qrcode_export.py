@@ -0,0 +1,128 @@
+import io
+import zipfile
+import collections
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+
+from django.utils.text import get_valid_filename
+
+from ..models import Species, Individual, Group
+from .qrcode_creator import create_request_qrcode_png
+
+SHEET_SIZE = (1240, 1754) # A4 at 150 DPI
+SHEET_GRID = (3, 4) # columns, rows
+SHEET_LABEL_HEIGHT = 30
+
+
+class _StreamBuffer:
+	""" Write-only file-like object, so zipfile can write to a stream whose contents are collected with pop() """
+	def __init__(self):
+		self._chunks = []
+
+	def write(self, data):
+		self._chunks.append(bytes(data))
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def pop(self):
+		data = b''.join(self._chunks)
+		self._chunks = []
+		return data
+
+
+class QRCodeSheetBuilder:
+	""" Tiles QR codes with their subject names onto printable pages """
+	def __init__(self):
+		self.page = None
+		self.num_codes = 0
+		self.cell_width, self.cell_height = SHEET_SIZE[0] // SHEET_GRID[0], SHEET_SIZE[1] // SHEET_GRID[1]
+		self.font = ImageFont.load_default()
+
+	def add(self, label, png):
+		""" Adds a QR code to the current page, returning the page as PNG bytes if it is now full """
+		if self.page is None:
+			self.page = Image.new('L', SHEET_SIZE, color=255)
+
+		col, row = self.num_codes % SHEET_GRID[0], self.num_codes // SHEET_GRID[0]
+		code_size = min(self.cell_width, self.cell_height - SHEET_LABEL_HEIGHT)
+		code = Image.open(io.BytesIO(png)).convert('L').resize((code_size, code_size), Image.NEAREST)
+		x, y = col * self.cell_width + (self.cell_width - code_size) // 2, row * self.cell_height
+		self.page.paste(code, (x, y))
+		draw = ImageDraw.Draw(self.page)
+		left, top, right, bottom = draw.textbbox((0, 0), label, font=self.font)
+		label_width, label_height = right - left, bottom - top
+		draw.text((x + (code_size - label_width) // 2, y + code_size + (SHEET_LABEL_HEIGHT - label_height) // 2), label, fill=0, font=self.font)
+
+		self.num_codes += 1
+		if self.num_codes == SHEET_GRID[0] * SHEET_GRID[1]:
+			return self.finish()
+		return None
+
+	def finish(self):
+		""" Returns the current page as PNG bytes, if it has any QR codes """
+		if self.page is None:
+			return None
+		page_file = io.BytesIO()
+		self.page.save(page_file, format='PNG')
+		self.page, self.num_codes = None, 0
+		return page_file.getvalue()
+
+
+def iter_qrcode_requests(zoo):
+	""" Yields (subject name, file name, QR code request) for all subjects of the zoo """
+	for model in (Species, Individual, Group):
+		for subject_id, subject_name in model.objects.using(zoo.id).order_by('id').values_list('id', 'name'):
+			request = {'zoo': zoo.id, 'type': model.get_type_str(), 'id': subject_id}
+			yield subject_name, f'{model.get_type_str()}/{get_valid_filename(f"{subject_id}-{subject_name}")}.png', request
+
+
+def iter_qrcodes(zoo, processes=1):
+	"""
+		Yields (subject name, file name, PNG bytes) for the QR codes of all subjects of the zoo, in this process or, if processes
+		is more than 1, by a process pool (which only the export_qrcodes command uses, rather than starting one per request)
+		Only a bounded number of QR codes is pending at any time, so memory use doesn't grow with the number of subjects
+	"""
+	if processes == 1:
+		for subject_name, file_name, request in iter_qrcode_requests(zoo):
+			yield subject_name, file_name, create_request_qrcode_png(zoo.encryption_key, request)
+		return
+	
+	with ProcessPoolExecutor(max_workers=processes) as executor:
+		pending = collections.deque()
+		
+		def pop_pending():
+			subject_name, file_name, future = pending.popleft()
+			return subject_name, file_name, future.result()
+		
+		for subject_name, file_name, request in iter_qrcode_requests(zoo):
+			pending.append((subject_name, file_name, executor.submit(create_request_qrcode_png, zoo.encryption_key, request)))
+			if len(pending) >= 8 * processes:
+				yield pop_pending()
+		while pending:
+			yield pop_pending()
+
+
+def iter_qrcodes_zip(zoo, processes=1, with_sheets=False):
+	""" Yields the bytes of a ZIP file with the QR codes of all subjects of the zoo, and optionally printable sheets of them """
+	stream = _StreamBuffer()
+	sheet_builder = QRCodeSheetBuilder() if with_sheets else None
+	num_sheets = 0
+
+	def add_sheet(sheet_png):
+		nonlocal num_sheets
+		if sheet_png:
+			num_sheets += 1
+			zip_file.writestr(f'sheets/sheet-{num_sheets:03}.png', sheet_png)
+
+	with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+		for subject_name, file_name, png in iter_qrcodes(zoo, processes=processes):
+			zip_file.writestr(file_name, png)
+			if sheet_builder:
+				add_sheet(sheet_builder.add(subject_name, png))
+			yield stream.pop()
+		if sheet_builder:
+			add_sheet(sheet_builder.finish())
+	yield stream.pop()
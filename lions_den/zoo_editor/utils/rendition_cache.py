@@ -0,0 +1,152 @@
+import time
+import sqlite3
+import threading
+import contextlib
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def get_rendition_key(content_hash, size, format):
+	""" Identifies a rendition by the content hash of the source blob and the target size/format """
+	return f'{content_hash}:{size[0]}x{size[1]}:{format}'
+
+
+class RenditionCache:
+	"""
+		Two-tier cache for normalised image renditions:
+			- an in-memory LRU, local to the process
+			- a persistent SQLite file shared by all processes, evicted by least recent access once above max_disk_bytes
+	"""
+	def __init__(self, path, max_memory_items=512, max_disk_bytes=256 * 1024 * 1024):
+		self.path = str(path)
+		self.max_memory_items = max_memory_items
+		self.max_disk_bytes = max_disk_bytes
+
+		self._memory = OrderedDict()
+		self._lock = threading.Lock()
+		self._creation_locks = {} # key -> [lock, number of threads using it], while renditions are being created
+		self._connection = None
+
+		self.memory_hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+
+	@property
+	def connection(self):
+		if self._connection is None:
+			self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+			self._connection.execute("""
+				CREATE TABLE IF NOT EXISTS RENDITIONS (
+					key TEXT PRIMARY KEY,
+					data BLOB NOT NULL,
+					size INTEGER NOT NULL,
+					last_access REAL NOT NULL
+				)
+			""")
+			self._connection.execute('CREATE INDEX IF NOT EXISTS RENDITIONS_LAST_ACCESS ON RENDITIONS (last_access)')
+		return self._connection
+
+	def get(self, key):
+		with self._lock:
+			if key in self._memory:
+				self._memory.move_to_end(key)
+				self.memory_hits += 1
+				return self._memory[key]
+
+			row = self.connection.execute('SELECT data FROM RENDITIONS WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			self.connection.execute('UPDATE RENDITIONS SET last_access = ? WHERE key = ?', (time.time(), key))
+			self.disk_hits += 1
+			self._remember(key, row[0])
+			return row[0]
+
+	def set(self, key, data):
+		with self._lock:
+			self._remember(key, data)
+			self.connection.execute(
+				'INSERT OR REPLACE INTO RENDITIONS (key, data, size, last_access) VALUES (?, ?, ?, ?)',
+				(key, data, len(data), time.time())
+			)
+			self._evict_from_disk()
+
+	def get_or_create(self, key, create_func):
+		"""
+			Returns the cached rendition for key, calling create_func() to build and store it if not cached yet
+			Concurrent calls for the same key in this process wait for the first one to create it, rather than creating it again
+		"""
+		data = self.get(key)
+		if data is None:
+			with self._creation_lock(key):
+				with self._lock:
+					data = self._memory.get(key) # created while waiting for the lock
+				if data is None:
+					data = create_func()
+					self.set(key, data)
+		return data
+
+	def clear(self):
+		with self._lock:
+			self._memory.clear()
+			self.connection.execute('DELETE FROM RENDITIONS')
+
+	def stats(self):
+		with self._lock:
+			disk_items, disk_bytes = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM RENDITIONS').fetchone()
+			return {
+				'memory_hits': self.memory_hits,
+				'disk_hits': self.disk_hits,
+				'misses': self.misses,
+				'memory_items': len(self._memory),
+				'disk_items': disk_items,
+				'disk_bytes': disk_bytes,
+			}
+
+	@contextlib.contextmanager
+	def _creation_lock(self, key):
+		with self._lock:
+			lock_users = self._creation_locks.setdefault(key, [threading.Lock(), 0])
+			lock_users[1] += 1
+		try:
+			with lock_users[0]:
+				yield
+		finally:
+			with self._lock:
+				lock_users[1] -= 1
+				if not lock_users[1]:
+					del self._creation_locks[key]
+
+	def _remember(self, key, data):
+		self._memory[key] = data
+		self._memory.move_to_end(key)
+		while len(self._memory) > self.max_memory_items:
+			self._memory.popitem(last=False)
+
+	def _evict_from_disk(self):
+		total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM RENDITIONS').fetchone()[0]
+		if total_size <= self.max_disk_bytes:
+			return
+
+		keys_to_evict = []
+		for key, size in self.connection.execute('SELECT key, size FROM RENDITIONS ORDER BY last_access'):
+			keys_to_evict.append((key,))
+			total_size -= size
+			if total_size <= self.max_disk_bytes:
+				break
+		self.connection.executemany('DELETE FROM RENDITIONS WHERE key = ?', keys_to_evict)
+
+
+_rendition_cache = None
+
+def get_rendition_cache():
+	global _rendition_cache
+	if _rendition_cache is None:
+		_rendition_cache = RenditionCache(
+			path=settings.RENDITION_CACHE['PATH'],
+			max_memory_items=settings.RENDITION_CACHE['MAX_MEMORY_ITEMS'],
+			max_disk_bytes=settings.RENDITION_CACHE['MAX_DISK_BYTES']
+		)
+	return _rendition_cache
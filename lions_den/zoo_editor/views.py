@@ -1,24 +1,37 @@
 import json
 
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
 from django.contrib import messages
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.http import HttpResponseRedirect, JsonResponse, Http404, StreamingHttpResponse, QueryDict
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 
 # noinspection PyUnresolvedReferences
 from zoo_auth.models import Zoo
 
-from .models import Species, Individual, Group, AttributeCategory
+from .models import Species, Individual, Group, AttributeCategory, ImageRendition, ImageJob, SUBJECT_MODELS
 from .forms import get_attributes_formset, get_attribute_categories_formset, AvailableSubjectAttributeCategoriesForm
+from .model_fields import BlobField, ImageBlobField
+from .utils.blob_response import blob_response, streaming_blob_response
+from .utils.blob_store import BLOBS_TABLE, find_blob
+from .utils.blob_stream import SQLiteBlobReader
+from .utils.image_pipeline import choose_served_format, get_content_type
+from .utils.qrcode_export import iter_qrcodes_zip
 
 
 # Base Views---------------------------------------------------------
 class BaseZooView(LoginRequiredMixin, View):
 	@method_decorator(never_cache)
 	def dispatch(self, request, *args, **kwargs):
+		return self._dispatch(request, *args, **kwargs)
+	
+	def _dispatch(self, request, *args, **kwargs):
 		""" Restrict access to view only to logged-in users with access to the specific zoo """
 		# Get request and zoo_id arguments
 		zoo_id = kwargs['zoo_id'] if 'zoo_id' in kwargs else args[0]
@@ -38,7 +51,10 @@ class BaseZooView(LoginRequiredMixin, View):
 		return handler(request, *args, **kwargs)
 	
 	def get_zoo(self, zoo_id):
-		return Zoo.objects.filter(id=zoo_id).get()
+		zoo = Zoo.objects.get_cached(zoo_id)
+		if zoo is None:
+			raise Zoo.DoesNotExist(f'Zoo {zoo_id} does not exist')
+		return zoo
 	
 	def redirect_to_self(self, request):
 		return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
@@ -48,7 +64,7 @@ class SubjectPageView(BaseZooView):
 	template_name = 'zoo_editor/subject.html'
 	
 	def get_subject(self, zoo_id, subject_id):
-		return self.model.objects.using(zoo_id).filter(id=subject_id).get()
+		return self.model.objects.using(zoo_id).defer(None).filter(id=subject_id).get()
 	
 	def get_forms(self, request, subject):
 		request_data = request.POST if request.POST else None
@@ -113,7 +129,7 @@ class SubjectPageView(BaseZooView):
 	def post_ajax(self, request, zoo_id, subject_id):
 		if 'update_image_display' in request.POST:
 			try:
-				return JsonResponse({'image_src': self.model.image.field.from_file(request.FILES["image"]).url })
+				return JsonResponse({'image_src': self.model.image.field.from_file(request.FILES["image"]).preview_url })
 			except:
 				return JsonResponse({})
 		elif 'add_new_attribute' in request.POST:
@@ -129,15 +145,38 @@ class SubjectPageView(BaseZooView):
 
 
 class SubjectsListView(BaseZooView):
+	subjects_filter_params = () # GET parameters get_subjects filters by, which later pages must keep
+	
 	def get(self, request, zoo_id):
 		return render(
 			request=request,
 			template_name=self.template_name,
 			context={
 				'zoo': self.get_zoo(zoo_id),
-				'subjects': self.model.objects.using(zoo_id).all()
+				**self.get_subjects_page_context(request, zoo_id)
 			}
 		)
+	
+	def get_subjects(self, request, zoo_id):
+		return self.model.objects.using(zoo_id)
+	
+	def get_subjects_page_context(self, request, zoo_id):
+		""" Context for rendering the page of subjects after the cursor given by the after_name and after_id GET parameters """
+		after = None
+		if request.GET.get('after_id'):
+			try:
+				after = (request.GET.get('after_name', ''), int(request.GET['after_id']))
+			except ValueError:
+				raise Http404('Invalid page')
+		subjects, next_after = self.get_subjects(request, zoo_id).page(after=after)
+		
+		next_page_query = None
+		if next_after:
+			next_page_query = QueryDict(mutable=True)
+			next_page_query.update({param: request.GET[param] for param in self.subjects_filter_params if param in request.GET})
+			next_page_query['after_name'], next_page_query['after_id'] = next_after
+			next_page_query = next_page_query.urlencode()
+		return {'subjects': subjects, 'next_page_query': next_page_query}
 
 	def get_ajax(self, request, zoo_id, form=None):
 		if 'modal_new_subject' in request.GET:
@@ -161,6 +200,12 @@ class SubjectsListView(BaseZooView):
 					'subject': self.model.objects.using(zoo_id).filter(id=request.GET.get('subject_id')).get()
 				}
 			)
+		elif 'subjects_page' in request.GET:
+			context = self.get_subjects_page_context(request, zoo_id)
+			return JsonResponse({
+				'rows': render_to_string('zoo_editor/subject_table_rows.html', context, request=request),
+				'next_page_query': context['next_page_query']
+			})
 		else:
 			return self.get_ajax_sub(request, zoo_id)
 
@@ -179,7 +224,7 @@ class SubjectsListView(BaseZooView):
 	def post_ajax(self, request, zoo_id):
 		if 'update_image_display' in request.POST:
 			try:
-				return JsonResponse({'image_src': self.model.image.field.from_file(request.FILES["image"]).url})
+				return JsonResponse({'image_src': self.model.image.field.from_file(request.FILES["image"]).preview_url})
 			except:
 				return JsonResponse({})
 		elif 'modal_new_subject' in request.POST:
@@ -192,15 +237,140 @@ class SubjectsListView(BaseZooView):
 				return self.get_ajax(request, zoo_id, form=new_subject_form)
 
 
+class BlobView(BaseZooView):
+	""" Serves the images and audio of subjects, so they don't have to be inlined in every page that displays them """
+	def dispatch(self, request, *args, **kwargs):
+		# Blob URLs are versioned by content, so unlike other zoo views their responses may be cached (for good if the version is current)
+		return self._dispatch(request, *args, **kwargs)
+	
+	@staticmethod
+	def is_versioned(request, version):
+		""" Whether the blob was requested by a URL carrying its current version, rather than no or a stale one """
+		return request.GET.get('v') == version
+	
+	def get_blob_field(self, model_name, field_name):
+		try:
+			model = SUBJECT_MODELS[model_name]
+			field = model._meta.get_field(field_name)
+		except (KeyError, FieldDoesNotExist):
+			field = None
+		if not isinstance(field, BlobField):
+			raise Http404(f'{model_name} has no blob field {field_name}')
+		return model, field
+	
+	def get(self, request, zoo_id, model_name, subject_id, field_name):
+		model, field = self.get_blob_field(model_name, field_name)
+		if 'w' in request.GET:
+			return self.get_rendition(request, zoo_id, model, field, subject_id, request.GET['w'])
+		if field.streamed:
+			return self.get_streamed(request, zoo_id, model, field, subject_id)
+		
+		subject = model.objects.using(zoo_id).defer(None).only(field.attname).filter(id=subject_id).first()
+		blob = getattr(subject, field_name) if subject else None
+		if blob is None:
+			raise Http404(f'No {field_name} found for {model_name} {subject_id}')
+		if field.negotiated:
+			format = choose_served_format(request.META.get('HTTP_ACCEPT'))
+			response = blob_response(
+				request,
+				data=blob.get_served_bytes(format),
+				content_type=get_content_type(format),
+				etag=blob.get_served_etag(format),
+				versioned=self.is_versioned(request, blob.etag) # the URL is versioned by the image, whichever format is served
+			)
+			patch_vary_headers(response, ('Accept',))
+			return response
+		return blob_response(
+			request,
+			data=blob.get_served_bytes(),
+			content_type=blob.content_type,
+			etag=blob.etag,
+			versioned=self.is_versioned(request, blob.etag)
+		)
+	
+	def get_rendition(self, request, zoo_id, model, field, subject_id, width):
+		""" Serves a stored rendition of an image, generating and storing it first if its width was declared since the image was saved """
+		if not (isinstance(field, ImageBlobField) and width.isdigit() and int(width) in field.renditions and field.hash_field):
+			raise Http404(f'{model.get_type_str()} {field.name} has no rendition of width {width}')
+		width = int(width)
+		source_hash = model.objects.using(zoo_id).filter(id=subject_id).values_list(field.hash_field.attname, flat=True).first()
+		if not source_hash:
+			raise Http404(f'No {field.name} found for {model.get_type_str()} {subject_id}')
+		
+		format = choose_served_format(request.META.get('HTTP_ACCEPT'))
+		renditions = ImageRendition.objects.db_manager(zoo_id)
+		data = renditions.get_data(source_hash, width, format)
+		if data is None:
+			subject = model.objects.using(zoo_id).defer(None).only(field.attname).get(id=subject_id)
+			data = renditions.create_renditions(getattr(subject, field.name), widths=[width], format=format).get(width)
+			data = data or renditions.get_data(source_hash, width, format) # stored by another request meanwhile
+		response = blob_response(
+			request,
+			data=data,
+			content_type=get_content_type(format),
+			etag=field.get_rendition_etag(source_hash, field.get_rendition_size(width), format),
+			versioned=self.is_versioned(request, source_hash) # see ImageBlobField.get_srcset
+		)
+		patch_vary_headers(response, ('Accept',))
+		return response
+	
+	def get_streamed(self, request, zoo_id, model, field, subject_id):
+		"""
+			Streams the blob straight from the blob store in chunks, without loading it whole into memory
+			Its ETag is the hash it is stored under, so conditional and range requests don't read the blob to hash it
+		"""
+		blob = find_blob(connections[zoo_id], table=model._meta.db_table, column=field.column, subject_id=subject_id)
+		if blob is None:
+			raise Http404(f'No {field.name} found for {model.get_type_str()} {subject_id}')
+		blob_rowid, etag = blob
+		reader = SQLiteBlobReader(connections[zoo_id], table=BLOBS_TABLE, column='data', rowid=blob_rowid)
+		return streaming_blob_response(
+			request=request,
+			length=reader.length,
+			iter_chunks=reader.iter_chunks,
+			content_type=field.obj_class.content_type,
+			etag=etag,
+			versioned=self.is_versioned(request, etag)
+		)
+
+
+class BlobStatusView(BlobView):
+	""" Processing status of an uploaded image, polled by pages showing its placeholder until it can be replaced by the image """
+	@method_decorator(never_cache)
+	def dispatch(self, request, *args, **kwargs):
+		return self._dispatch(request, *args, **kwargs)
+	
+	def get(self, request, zoo_id, model_name, subject_id, field_name):
+		model, field = self.get_blob_field(model_name, field_name)
+		subject = model.objects.using(zoo_id).filter(id=subject_id).first()
+		if subject is None or not isinstance(field, ImageBlobField) or field.hash_field is None:
+			raise Http404(f'No {field_name} found for {model_name} {subject_id}')
+		
+		job = ImageJob.objects.db_manager(zoo_id).get_for_subject(model_name, subject_id)
+		source_hash = getattr(subject, field.hash_field.attname)
+		if job is not None and not source_hash:
+			return JsonResponse({'status': job.status})
+		return JsonResponse({
+			'status': 'done',
+			'image_src': field.get_url(subject, source_hash) if source_hash else None,
+			'thumbnail_src': subject.thumbnail_url,
+			'srcset': field.get_srcset(subject, source_hash) if source_hash else '',
+		})
+	
+	def get_ajax(self, request, *args, **kwargs):
+		return self.get(request, *args, **kwargs)
+
+
 # Renderable Views---------------------------------------------------
 class ZoosIndexView(LoginRequiredMixin, View):
 	def get(self, request):
-		if len(request.user.zoos) == 1:
-			return redirect(request.user.zoos[0].id + '/')
+		zoos = list(request.user.zoos)
+		if len(zoos) == 1:
+			return redirect(zoos[0].id + '/')
 		return render(
 			request=request,
 			template_name = 'zoo_editor/zoos_list.html',
-			context={'zoos': request.user.zoos}
+			context={'zoos': zoos}
 		)
 
 
@@ -231,6 +401,17 @@ class ZooHomeView(BaseZooView):
 		return self.get(request, zoo_id)
 
 
+class QRCodesExportView(BaseZooView):
+	def get(self, request, zoo_id):
+		response = StreamingHttpResponse(
+			# Single process: forking a pool from a serving worker costs more than it saves, unlike the export_qrcodes command
+			iter_qrcodes_zip(self.get_zoo(zoo_id), with_sheets='sheets' in request.GET),
+			content_type='application/zip'
+		)
+		response['Content-Disposition'] = f'attachment; filename="QR-codes-{zoo_id}.zip"'
+		return response
+
+
 class SpeciesListView(SubjectsListView):
 	model = Species
 	template_name = 'zoo_editor/species_list.html'
@@ -239,6 +420,7 @@ class SpeciesListView(SubjectsListView):
 class IndividualsListView(SubjectsListView):
 	model = Individual
 	template_name = 'zoo_editor/individuals_list.html'
+	subjects_filter_params = ('species_id',)
 	
 	def get(self, request, zoo_id):
 		return render(
@@ -246,36 +428,29 @@ class IndividualsListView(SubjectsListView):
 			template_name=self.template_name,
 			context={
 				'zoo': self.get_zoo(zoo_id),
-				'subjects': Individual.objects.using(zoo_id),
+				**self.get_subjects_page_context(request, zoo_id),
 				'species_list': Species.objects.using(zoo_id)
 			}
 		)
 	
+	def get_subjects(self, request, zoo_id):
+		individuals = super().get_subjects(request, zoo_id)
+		if request.GET.get('species_id'):
+			individuals = individuals.filter(species__id=request.GET['species_id'])
+		return individuals
+	
 	def get_ajax_sub(self, request, zoo_id):
 		if 'species_filter' in request.GET:
-			individuals_shown = Individual.objects.using(zoo_id)
-			if request.GET.get('species_id'):
-				individuals_shown = individuals_shown.filter(species__id=request.GET['species_id'])
 			return render(
 				request=request,
 				template_name='zoo_editor/subject_table.html',
-				context={'subjects': individuals_shown}
+				context=self.get_subjects_page_context(request, zoo_id)
 			)
 
 
 class GroupsListView(SubjectsListView):
 	model = Group
 	template_name = 'zoo_editor/groups_list.html'
-	
-	def get(self, request, zoo_id):
-		return render(
-			request=request,
-			template_name=self.template_name,
-			context={
-				'zoo': self.get_zoo(zoo_id),
-				'subjects': Group.objects.using(zoo_id)
-			}
-		)
 
 
 class SpeciesPageView(SubjectPageView):
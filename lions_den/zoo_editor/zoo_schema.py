@@ -0,0 +1,247 @@
+"""
+	Versioned schema changes for zoo databases. These are created outside of Lion's Den and so have no Django migrations:
+	each database records the version of the last change applied to it in its SCHEMA_VERSION table instead.
+	To change the schema, append a SchemaChange with the next version number to SCHEMA_CHANGES.
+"""
+import logging
+import datetime
+import threading
+import collections
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from .models import Species, Individual, Group, SpeciesAttribute, SUBJECTS_PAGE_SIZE
+from .utils.blob_store import BLOBS_TABLE, store_blob
+
+SCHEMA_VERSION_TABLE = 'SCHEMA_VERSION'
+
+logger = logging.getLogger(__name__)
+
+# Operations are SQL statements, or functions taking the database alias for anything more involved (which may return a report of what they did)
+SchemaChange = collections.namedtuple('SchemaChange', ('version', 'description', 'operations'))
+AppliedSchemaChange = collections.namedtuple('AppliedSchemaChange', SchemaChange._fields + ('reports',))
+
+
+def add_column(table, column, definition):
+	""" Operation adding a column, unless the database was created with it already """
+	def operation(zoo_id):
+		with connections[zoo_id].cursor() as cursor:
+			cursor.execute(f'PRAGMA table_info("{table}")')
+			if column not in (row[1] for row in cursor.fetchall()):
+				cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+	return operation
+
+
+def generate_thumbnails(zoo_id):
+	""" Fills in the thumbnails of subjects saved before thumbnails existed, loading one image at a time """
+	for model in (Species, Individual, Group):
+		subject_ids = model.objects.using(zoo_id).filter(thumbnail__isnull=True, image__isnull=False).values_list('id', flat=True)
+		for subject_id in list(subject_ids):
+			subject = model.objects.using(zoo_id).defer(None).only('image').get(id=subject_id)
+			subject.thumbnail = model.thumbnail.field.create_thumbnail(subject.image)
+			subject.save(update_fields=['thumbnail'])
+
+
+def store_image_hashes(zoo_id):
+	""" Fills in the image hashes of subjects saved before images had renditions, which are then generated when first requested """
+	for model in (Species, Individual, Group):
+		subject_ids = model.objects.using(zoo_id).filter(image_hash__isnull=True, image__isnull=False).values_list('id', flat=True)
+		for subject_id in list(subject_ids):
+			subject = model.objects.using(zoo_id).defer(None).only('image').get(id=subject_id)
+			subject.image_hash = subject.image.content_hash
+			subject.save(update_fields=['image_hash'])
+
+
+# Subject columns referencing the blob store, as of the schema change which introduced it
+BLOB_COLUMNS = (('SPECIES', 'image'), ('SPECIES', 'audio'), ('INDIVIDUAL', 'image'), ('_GROUP_', 'image'), ('_GROUP_', 'audio'))
+
+
+def create_blob_refcount_triggers(table, column):
+	""" Operations creating the triggers which keep the reference counts of the blob store up to date with a subject column """
+	increment = f'UPDATE "{BLOBS_TABLE}" SET refcount = refcount + 1 WHERE hash = NEW."{column}";'
+	decrement = f'UPDATE "{BLOBS_TABLE}" SET refcount = refcount - 1 WHERE hash = OLD."{column}";'
+	name = f'{table}_{column}_BLOB_REFS'
+	return (
+		f'CREATE TRIGGER IF NOT EXISTS "{name}_INSERT" AFTER INSERT ON "{table}" BEGIN {increment} END',
+		f'CREATE TRIGGER IF NOT EXISTS "{name}_UPDATE" AFTER UPDATE OF "{column}" ON "{table}" '
+			f'WHEN OLD."{column}" IS NOT NEW."{column}" BEGIN {decrement} {increment} END',
+		f'CREATE TRIGGER IF NOT EXISTS "{name}_DELETE" AFTER DELETE ON "{table}" BEGIN {decrement} END',
+	)
+
+
+def move_blobs_to_store(zoo_id):
+	"""
+		Moves the images and audio stored inline in subject rows to the blob store, loading one blob at a time,
+		then recounts the references to each stored blob
+		:return: report of the space taken by duplicates, which is reclaimed once the database is vacuumed
+	"""
+	connection = connections[zoo_id]
+	num_blobs = inline_bytes = 0
+	with connection.cursor() as cursor:
+		cursor.execute(f'SELECT hash FROM "{BLOBS_TABLE}"')
+		stored_hashes = {row[0] for row in cursor.fetchall()}
+		added_sizes = {} # by hash, of the blobs which were not in the store already
+		for table, column in BLOB_COLUMNS:
+			cursor.execute(f'SELECT "_id" FROM "{table}" WHERE typeof("{column}") = \'blob\'')
+			for (subject_id,) in cursor.fetchall():
+				cursor.execute(f'SELECT "{column}" FROM "{table}" WHERE "_id" = %s', (subject_id,))
+				data = cursor.fetchone()[0]
+				content_hash = store_blob(connection, data)
+				cursor.execute(f'UPDATE "{table}" SET "{column}" = %s WHERE "_id" = %s', (content_hash, subject_id))
+				if content_hash not in stored_hashes:
+					added_sizes[content_hash] = len(data)
+				num_blobs += 1
+				inline_bytes += len(data)
+		
+		references = ' + '.join(f'(SELECT COUNT(*) FROM "{table}" WHERE "{column}" = "{BLOBS_TABLE}".hash)' for table, column in BLOB_COLUMNS)
+		cursor.execute(f'UPDATE "{BLOBS_TABLE}" SET refcount = {references}')
+	reclaimed_bytes = inline_bytes - sum(added_sizes.values())
+	return (
+		f'{num_blobs} inline blobs moved to the blob store ({len(added_sizes)} not already there), '
+		f'{reclaimed_bytes / 2**20:.1f} MiB of duplicates removed ({reclaimed_bytes} bytes)'
+	)
+
+
+SCHEMA_CHANGES = (
+	SchemaChange(1, 'Indexes for subject lists and attributes', (
+		'CREATE INDEX IF NOT EXISTS "SPECIES_LOWER_NAME" ON "SPECIES" (lower("name"))',
+		'CREATE INDEX IF NOT EXISTS "INDIVIDUAL_LOWER_NAME" ON "INDIVIDUAL" (lower("name"))',
+		'CREATE INDEX IF NOT EXISTS "_GROUP__LOWER_NAME" ON "_GROUP_" (lower("name"))',
+		'CREATE INDEX IF NOT EXISTS "INDIVIDUAL_SPECIES_LOWER_NAME" ON "INDIVIDUAL" ("species_id", lower("name"))',
+		'CREATE INDEX IF NOT EXISTS "SPECIES_ATTRIBUTES_SUBJECT_CATEGORY" ON "SPECIES_ATTRIBUTES" ("subject_id", "category_id")',
+		'CREATE INDEX IF NOT EXISTS "INDIVIDUALS_ATTRIBUTES_SUBJECT_CATEGORY" ON "INDIVIDUALS_ATTRIBUTES" ("subject_id", "category_id")',
+		'CREATE INDEX IF NOT EXISTS "GROUPS_ATTRIBUTES_SUBJECT_CATEGORY" ON "GROUPS_ATTRIBUTES" ("subject_id", "category_id")',
+	)),
+	SchemaChange(2, 'Subject thumbnails', (
+		add_column('SPECIES', 'thumbnail', 'BLOB NULL'),
+		add_column('INDIVIDUAL', 'thumbnail', 'BLOB NULL'),
+		add_column('_GROUP_', 'thumbnail', 'BLOB NULL'),
+		generate_thumbnails,
+	)),
+	SchemaChange(3, 'Subject image renditions', (
+		add_column('SPECIES', 'image_hash', 'varchar(64) NULL'),
+		add_column('INDIVIDUAL', 'image_hash', 'varchar(64) NULL'),
+		add_column('_GROUP_', 'image_hash', 'varchar(64) NULL'),
+		'CREATE TABLE IF NOT EXISTS "IMAGE_RENDITIONS" ('
+			'"_id" integer NOT NULL PRIMARY KEY AUTOINCREMENT, "source_hash" varchar(64) NOT NULL, '
+			'"width" integer unsigned NOT NULL CHECK ("width" >= 0), "format" varchar(8) NOT NULL, "data" BLOB NOT NULL, '
+			'UNIQUE ("source_hash", "width", "format")'
+		')',
+		store_image_hashes,
+	)),
+	SchemaChange(4, 'Image processing jobs', (
+		'CREATE TABLE IF NOT EXISTS "IMAGE_JOBS" ('
+			'"_id" integer NOT NULL PRIMARY KEY AUTOINCREMENT, "subject_type" varchar(16) NOT NULL, "subject_id" integer NOT NULL, '
+			'"status" varchar(8) NOT NULL, "attempts" integer unsigned NOT NULL CHECK ("attempts" >= 0), "error" text NOT NULL, '
+			'"created" datetime NOT NULL, "updated" datetime NOT NULL'
+		')',
+		'CREATE INDEX IF NOT EXISTS "IMAGE_JOBS_STATUS" ON "IMAGE_JOBS" ("status", "_id")',
+		'CREATE INDEX IF NOT EXISTS "IMAGE_JOBS_SUBJECT" ON "IMAGE_JOBS" ("subject_type", "subject_id")',
+	)),
+	SchemaChange(5, 'Renditions in compact formats', (
+		# renditions are now served as AVIF/WebP/JPEG, which are generated when first requested
+		'DELETE FROM "IMAGE_RENDITIONS" WHERE "format" = \'PNG\'',
+	)),
+	SchemaChange(6, 'Content-addressed blob store', (
+		f'CREATE TABLE IF NOT EXISTS "{BLOBS_TABLE}" ('
+			'"_id" integer NOT NULL PRIMARY KEY, "hash" varchar(64) NOT NULL UNIQUE, "data" BLOB NOT NULL, '
+			'"refcount" integer NOT NULL DEFAULT 0'
+		')',
+		f'CREATE INDEX IF NOT EXISTS "{BLOBS_TABLE}_UNREFERENCED" ON "{BLOBS_TABLE}" ("hash") WHERE refcount <= 0',
+		move_blobs_to_store,
+		*(trigger for table, column in BLOB_COLUMNS for trigger in create_blob_refcount_triggers(table, column)),
+	)),
+)
+
+LATEST_SCHEMA_VERSION = SCHEMA_CHANGES[-1].version
+
+
+def get_schema_version(zoo_id):
+	with connections[zoo_id].cursor() as cursor:
+		cursor.execute(f'CREATE TABLE IF NOT EXISTS "{SCHEMA_VERSION_TABLE}" (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied TEXT NOT NULL)')
+		cursor.execute(f'SELECT MAX(version) FROM "{SCHEMA_VERSION_TABLE}"')
+		return cursor.fetchone()[0] or 0
+
+
+def migrate_zoo(zoo_id):
+	"""
+		Applies the pending schema changes to a zoo database, each in its own transaction, and updates its statistics
+		:return: list of AppliedSchemaChange, with the reports of their operations
+	"""
+	applied_changes = []
+	for change in SCHEMA_CHANGES:
+		if change.version <= get_schema_version(zoo_id):
+			continue
+		reports = []
+		with transaction.atomic(using=zoo_id), connections[zoo_id].cursor() as cursor:
+			for operation in change.operations:
+				if callable(operation):
+					report = operation(zoo_id)
+					if report:
+						reports.append(report)
+				else:
+					cursor.execute(operation)
+			cursor.execute(
+				f'INSERT INTO "{SCHEMA_VERSION_TABLE}" (version, description, applied) VALUES (%s, %s, %s)',
+				(change.version, change.description, datetime.datetime.now().isoformat(timespec='seconds'))
+			)
+		applied_changes.append(AppliedSchemaChange(*change, reports))
+
+	with connections[zoo_id].cursor() as cursor:
+		cursor.execute('ANALYZE')
+	return applied_changes
+
+
+# Schema check on first connection----------------------------------------------------------
+# Zoo databases whose schema version this process has checked
+_checked_zoo_ids = set()
+_checked_zoo_ids_lock = threading.Lock()
+
+
+def check_schema_on_first_connection(sender, connection, **kwargs):
+	"""
+		Logs an error the first time this process connects to a zoo database behind the latest schema version, which the views
+		will fail on until the migrate_zoos command is run (migrating here would hold up the request, and lock the zoo for others)
+	"""
+	zoo_id = connection.alias
+	if zoo_id == DEFAULT_DB_ALIAS or zoo_id in _checked_zoo_ids:
+		return
+	with connection.cursor() as cursor:
+		cursor.execute(
+			'SELECT name FROM sqlite_master WHERE type = \'table\' AND name IN (%s, %s)', (Species._meta.db_table, SCHEMA_VERSION_TABLE)
+		)
+		tables = {row[0] for row in cursor.fetchall()}
+		if Species._meta.db_table not in tables:
+			return # not a zoo database, or one whose tables are yet to be created (e.g. a test database)
+		version = 0
+		if SCHEMA_VERSION_TABLE in tables:
+			cursor.execute(f'SELECT MAX(version) FROM "{SCHEMA_VERSION_TABLE}"')
+			version = cursor.fetchone()[0] or 0
+	with _checked_zoo_ids_lock:
+		if zoo_id in _checked_zoo_ids:
+			return
+		_checked_zoo_ids.add(zoo_id)
+	if version < LATEST_SCHEMA_VERSION:
+		logger.error('Zoo %s is at schema version %s rather than %s, run the migrate_zoos command', zoo_id, version, LATEST_SCHEMA_VERSION)
+
+
+# Query plans----------------------------------------------------------
+def get_hot_queries(zoo_id):
+	""" Querysets of the most frequent queries on zoo databases, by description """
+	return {
+		'Species list': Species.objects.using(zoo_id).after()[:SUBJECTS_PAGE_SIZE + 1],
+		'Species list, later page': Species.objects.using(zoo_id).after(('m', 1))[:SUBJECTS_PAGE_SIZE + 1],
+		'Individuals list': Individual.objects.using(zoo_id).after()[:SUBJECTS_PAGE_SIZE + 1],
+		'Individuals list, by species': Individual.objects.using(zoo_id).filter(species__id=1).after()[:SUBJECTS_PAGE_SIZE + 1],
+		'Groups list': Group.objects.using(zoo_id).after()[:SUBJECTS_PAGE_SIZE + 1],
+		'Subject attributes': SpeciesAttribute.objects.using(zoo_id).filter(subject_id=1).order_by('id'),
+		'Subject attribute by category': SpeciesAttribute.objects.using(zoo_id).filter(subject_id=1, category_id=1),
+	}
+
+
+def explain_query_plan(queryset):
+	""" Returns the details of each step of the query plan of a queryset, e.g. SEARCH SPECIES USING INDEX ... """
+	sql, params = queryset.query.sql_with_params()
+	with connections[queryset.db].cursor() as cursor:
+		cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+		return [row[-1] for row in cursor.fetchall()]